@@ -1,7 +1,8 @@
 from fastapi import APIRouter
 
 from app.api.api_v1.endpoints import (auth, files, jobs, machines, microscopes,
-                                      notebooks, notifications, scans)
+                                      notebooks, notifications, scans,
+                                      uploads)
 
 api_router = APIRouter()
 
@@ -15,3 +16,4 @@ api_router.include_router(
     microscopes.router, prefix="/microscopes", tags=["microscopes"]
 )
 api_router.include_router(notebooks.router, prefix="/notebooks", tags=["notebooks"])
+api_router.include_router(uploads.router, prefix="/uploads", tags=["uploads"])
@@ -3,19 +3,21 @@ import datetime
 import re
 import shutil
 from pathlib import Path
+from typing import List
 
 import aiofiles
 from fastapi import APIRouter, Depends, File, HTTPException, UploadFile
 from fastapi.security.api_key import APIKey
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import schemas
 from app.api import deps
-from app.api.utils import upload_to_file
+from app.api.utils import get_completed_upload, remove_upload, upload_to_file
 from app.core.config import settings
 from app.core.logging import logger
-from app.crud import scan as scan_crud
+from app.crud.aio import scan as scan_crud
 from app.kafka.producer import (send_filesystem_event_to_kafka,
+                                send_filesystem_events_to_kafka,
                                 send_haadf_event_to_kafka,
                                 send_log_file_sync_event_to_kafka,
                                 send_scan_event_to_kafka,
@@ -33,6 +35,13 @@ async def file_events(
     return event
 
 
+@router.post("/batch")
+async def file_events_batch(
+    events: List[schemas.FileSystemEvent], api_key: APIKey = Depends(deps.get_api_key)
+):
+    await send_filesystem_events_to_kafka(events)
+
+
 @router.post("/sync")
 async def sync_events(
     event: schemas.SyncEvent, api_key: APIKey = Depends(deps.get_api_key)
@@ -46,15 +55,19 @@ async def sync_events(
     return event
 
 
-async def upload_haadf_dm4(file: UploadFile) -> None:
+def haadf_dm4_scan_id(filename: str) -> str:
     scan_regex = re.compile(r"^scan([0-9]*)\.dm4")
 
     # Extract out the scan ids
-    match = scan_regex.match(file.filename)
+    match = scan_regex.match(filename)
     if not match:
         raise HTTPException(status_code=400, detail="Can't extract scan id.")
 
-    scan_id = match.group(1)
+    return match.group(1)
+
+
+async def upload_haadf_dm4(file: UploadFile) -> None:
+    scan_id = haadf_dm4_scan_id(file.filename)
     upload_path = Path(settings.SCAN_FILE_UPLOAD_DIR) / f"scan{scan_id}.dm4"
     async with aiofiles.open(upload_path, "wb") as fp:
         await upload_to_file(file, fp)
@@ -64,7 +77,7 @@ async def upload_haadf_dm4(file: UploadFile) -> None:
     )
 
 
-async def upload_haadf_image(db: Session, file: UploadFile) -> None:
+async def upload_haadf_image(db: AsyncSession, file: UploadFile) -> None:
     format = settings.IMAGE_FORMAT
     scan_regex = re.compile(f"^([0-9]*)\.{format}")
 
@@ -83,7 +96,7 @@ async def upload_haadf_image(db: Session, file: UploadFile) -> None:
         hours=settings.HAADF_SCAN_AGE_LIMIT
     )
 
-    scans = scan_crud.get_scans(
+    scans = await scan_crud.get_scans(
         db, scan_id=scan_id, has_image=False, start=created_since
     )
 
@@ -100,7 +113,9 @@ async def upload_haadf_image(db: Session, file: UploadFile) -> None:
         )
 
         image_path = f"{settings.IMAGE_URL_PREFIX}/{scan.id}.{format}"
-        (updated, _) = scan_crud.update_scan(db, scan.id, image_path=image_path)
+        (updated, _) = await scan_crud.update_scan(
+            db, scan.id, image_path=image_path
+        )
 
         if updated:
             await send_scan_event_to_kafka(
@@ -110,7 +125,7 @@ async def upload_haadf_image(db: Session, file: UploadFile) -> None:
 
 @router.post("/haadf")
 async def upload_haadf(
-    db: Session = Depends(deps.get_db),
+    db: AsyncSession = Depends(deps.get_async_db),
     file: UploadFile = File(...),
     api_key: APIKey = Depends(deps.get_api_key),
 ) -> None:
@@ -122,3 +137,23 @@ async def upload_haadf(
         await upload_haadf_image(db, file)
     else:
         raise HTTPException(status_code=400, detail="Invalid format.")
+
+
+@router.post("/haadf/uploads/{upload_id}")
+async def upload_haadf_from_upload(
+    upload_id: str,
+    api_key: APIKey = Depends(deps.get_api_key),
+) -> None:
+    (upload, data_path) = get_completed_upload(upload_id)
+    if Path(upload.filename).suffix.lower() != ".dm4":
+        raise HTTPException(status_code=400, detail="Invalid format.")
+
+    scan_id = haadf_dm4_scan_id(upload.filename)
+    upload_path = Path(settings.SCAN_FILE_UPLOAD_DIR) / f"scan{scan_id}.dm4"
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, shutil.move, data_path, upload_path)
+    remove_upload(upload_id)
+
+    await send_haadf_event_to_kafka(
+        schemas.HaadfUploaded(path=str(upload_path), scan_id=scan_id)
+    )
@@ -1,13 +1,18 @@
 from datetime import datetime
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app import schemas
-from app.api.deps import get_db, oauth2_password_bearer_or_api_key
+from app.api.deps import (get_async_db, get_db,
+                          oauth2_password_bearer_or_api_key)
+from app.api.utils import decode_cursor, set_next_page_headers
+from app.crud import count as count_crud
 from app.crud import job as crud
-from app.crud import scan as scan_crud
+from app.crud.aio import job as aio_crud
+from app.crud.aio import scan as aio_scan_crud
 from app.kafka.producer import (send_job_event_to_kafka,
                                 send_scan_event_to_kafka)
 from app.schemas import CancelJobEvent, SubmitJobEvent, UpdateJobEvent
@@ -35,6 +40,7 @@ async def create_job(job_create: schemas.JobCreate, db: Session = Depends(get_db
     dependencies=[Depends(oauth2_password_bearer_or_api_key)],
 )
 def read_jobs(
+    request: Request,
     response: Response,
     skip: int = 0,
     limit: int = 100,
@@ -43,7 +49,13 @@ def read_jobs(
     end: Optional[datetime] = None,
     db: Session = Depends(get_db),
     scan_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    count: schemas.CountMode = schemas.CountMode.EXACT,
 ):
+    job_cursor = None
+    if cursor is not None:
+        job_cursor = decode_cursor(cursor, schemas.JobCursor)
+
     db_jobs = crud.get_jobs(
         db,
         skip=skip,
@@ -52,17 +64,25 @@ def read_jobs(
         start=start,
         end=end,
         scan_id=scan_id,
+        cursor=job_cursor,
     )
-    count = crud.get_jobs_count(
+
+    params = dict(job_type=job_type, start=start, end=end, scan_id=scan_id)
+    total = count_crud.get_count(
         db,
-        skip=skip,
-        limit=limit,
-        job_type=job_type,
-        start=start,
-        end=end,
-        scan_id=scan_id,
+        count,
+        "jobs",
+        crud.get_jobs_filters(**params),
+        params,
+        lambda: crud.get_jobs_count(db, **params),
     )
-    response.headers["X-Total-Count"] = str(count)
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
+
+    next_cursor = None
+    if len(db_jobs) == limit and len(db_jobs) > 0:
+        next_cursor = schemas.JobCursor(id=db_jobs[-1].id)
+    set_next_page_headers(request, response, next_cursor)
 
     return [schemas.Job.from_orm(job) for job in db_jobs]
 
@@ -94,20 +114,20 @@ def read_job(response: Response, id: int, db: Session = Depends(get_db)):
     dependencies=[Depends(oauth2_password_bearer_or_api_key)],
 )
 async def update_job(
-    id: int, payload: schemas.JobUpdate, db: Session = Depends(get_db)
+    id: int, payload: schemas.JobUpdate, db: AsyncSession = Depends(get_async_db)
 ):
-    db_job = crud.get_job(db, id=id)
+    db_job = await aio_crud.get_job(db, id=id)
     if db_job is None:
         raise HTTPException(status_code=404, detail="Job not found")
 
-    (updated, job) = crud.update_job(db, id, payload)
+    (updated, job) = await aio_crud.update_job(db, id, payload)
     job = schemas.Job.from_orm(job)
     if updated:
         job_updated_event = UpdateJobEvent(**job.dict())
 
         if payload.scan_id:
             scan_updated_event = schemas.ScanUpdateEvent(id=payload.scan_id)
-            db_scan = scan_crud.get_scan(db, id=payload.scan_id)
+            db_scan = await aio_scan_crud.get_scan(db, id=payload.scan_id)
             scan_updated_event.job_ids = schemas.Scan.from_orm(db_scan).job_ids
             await send_scan_event_to_kafka(scan_updated_event)
 
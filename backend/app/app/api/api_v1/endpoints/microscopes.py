@@ -2,11 +2,14 @@ from typing import List, Optional
 
 from fastapi import APIRouter, Depends
 from fastapi.security.api_key import APIKey
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app import schemas
-from app.api.deps import get_api_key, get_db, oauth2_password_bearer_or_api_key
+from app.api.deps import (get_api_key, get_async_db, get_db,
+                          oauth2_password_bearer_or_api_key)
 from app.crud import microscope as crud
+from app.crud.aio import microscope as aio_crud
 from app.kafka.producer import send_microscope_event_to_kafka
 
 router = APIRouter()
@@ -41,10 +44,12 @@ def read_microscope(id: int, db: Session = Depends(get_db)):
 async def update_microscope(
     id: int,
     payload: schemas.MicroscopeUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     api_key: APIKey = Depends(get_api_key),
 ):
-    (updated, microscope) = crud.update_microscope(db, id=id, state=payload.state)
+    (updated, microscope) = await aio_crud.update_microscope(
+        db, id=id, state=payload.state
+    )
 
     if updated:
         microscope_updated_event = schemas.MicroscopeUpdateEvent(
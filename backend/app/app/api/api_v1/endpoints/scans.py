@@ -12,16 +12,21 @@ from fastapi import (APIRouter, Depends, File, HTTPException, Response,
                      UploadFile, status)
 from fastapi.security.api_key import APIKey
 from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 
 from app import schemas
-from app.api.deps import get_api_key, get_db, oauth2_password_bearer_or_api_key
-from app.api.utils import upload_to_file
+from app.api.deps import (get_api_key, get_async_db, get_db,
+                          oauth2_password_bearer_or_api_key)
+from app.api.utils import (decode_cursor, get_completed_upload, remove_upload,
+                           set_next_page_headers, upload_to_file)
 from app.core.config import settings
 from app.core.logging import logger
-from app.crud import job as job_crud
+from app.crud import count as count_crud
 from app.crud import scan as crud
+from app.crud.aio import job as aio_job_crud
+from app.crud.aio import scan as aio_crud
 from app.kafka.producer import (send_job_event_to_kafka,
                                 send_remove_scan_files_event_to_kafka,
                                 send_scan_event_to_kafka,
@@ -33,8 +38,8 @@ from app.schemas.scan import Scan4DCreate, ScanCreatedEvent
 router = APIRouter()
 
 
-async def create_4d_scan(db: Session, scan: Scan4DCreate):
-    scan = crud.create_scan(db=db, scan=scan)
+async def create_4d_scan(db: AsyncSession, scan: Scan4DCreate):
+    scan = await aio_crud.create_scan(db=db, scan=scan)
     format = settings.IMAGE_FORMAT
     # See if we have HAADF image for this scan
     upload_path = Path(settings.IMAGE_UPLOAD_DIR) / f"scan{scan.scan_id}.{format}"
@@ -49,7 +54,7 @@ async def create_4d_scan(db: Session, scan: Scan4DCreate):
         )
 
         # Finally update the haadf path
-        (_, scan) = crud.update_scan(
+        (_, scan) = await aio_crud.update_scan(
             db,
             cast(int, scan.id),
             image_path=f"{settings.IMAGE_URL_PREFIX}/{scan.id}.{format}",
@@ -75,22 +80,16 @@ def generate_sha256(form_data: schemas.ScanFromFileMetadata):
 
 
 async def create_scan_from_file(
-    db,
+    db: AsyncSession,
     meta: schemas.ScanFromFileMetadata,
     file_upload: UploadFile,
     ser_file_upload: Optional[UploadFile],
 ):
-    sha = generate_sha256(meta)
-
-    # Check for existing scan with this sha
-    if crud.get_scans_count(db, sha=sha) != 0:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT, detail="Scan in SHA already exists"
-        )
+    sha = await new_scan_sha(db, meta)
 
     scan_from_file = schemas.ScanFromFile(sha=sha, **meta.dict())
 
-    scan = crud.create_scan(db=db, scan=scan_from_file)
+    scan = await aio_crud.create_scan(db=db, scan=scan_from_file)
     ext = Path(file_upload.filename).suffix
     upload_path = Path(settings.SCAN_FILE_UPLOAD_DIR) / f"{scan.id}{ext}"
     async with aiofiles.open(upload_path, "wb") as fp:
@@ -121,6 +120,65 @@ async def create_scan_from_file(
     return scan
 
 
+async def new_scan_sha(db: AsyncSession, meta: schemas.ScanFromFileMetadata) -> str:
+    sha = generate_sha256(meta)
+
+    # Check for existing scan with this sha
+    if await aio_crud.get_scans_count(db, sha=sha) != 0:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Scan in SHA already exists"
+        )
+
+    return sha
+
+
+def get_completed_uploads(upload_id: str, ser_upload_id: Optional[str]):
+    uploads = [get_completed_upload(upload_id)]
+    if ser_upload_id is not None:
+        uploads.append(get_completed_upload(ser_upload_id))
+
+    return uploads
+
+
+async def move_uploads_to_scan(scan_id: int, uploads, metadata_extracted: bool = False):
+    loop = asyncio.get_event_loop()
+    for (upload, data_path) in uploads:
+        ext = Path(upload.filename).suffix
+        upload_path = Path(settings.SCAN_FILE_UPLOAD_DIR) / f"{scan_id}{ext}"
+        # The upload is on the same filesystem, so this is just a rename
+        await loop.run_in_executor(None, shutil.move, data_path, upload_path)
+        remove_upload(upload.id)
+
+        # Send event so the metadata get extracted etc.
+        await send_scan_file_event_to_kafka(
+            schemas.ScanFileUploaded(
+                path=str(upload_path),
+                id=scan_id,
+                filename=unquote(upload.filename),
+                metadata_extracted=metadata_extracted,
+            )
+        )
+
+
+async def create_scan_from_uploads(
+    db: AsyncSession,
+    meta: schemas.ScanFromFileMetadata,
+    upload_id: str,
+    ser_upload_id: Optional[str],
+):
+    sha = await new_scan_sha(db, meta)
+
+    # Make sure the uploads are complete before we create the scan
+    uploads = get_completed_uploads(upload_id, ser_upload_id)
+
+    scan_from_file = schemas.ScanFromFile(sha=sha, **meta.dict())
+    scan = await aio_crud.create_scan(db=db, scan=scan_from_file)
+
+    await move_uploads_to_scan(scan.id, uploads)
+
+    return scan
+
+
 # For this endpoint we are on our own! As we want to support two request types
 # we have to the parsing ourself, the OpenAPI doc will not be correct!
 @router.post(
@@ -134,7 +192,7 @@ async def create_scan(
     # Because we can only have "simple" form fields with a file upload
     # we encode the metadata in another str field.
     # file_metadata: Optional[schemas.ScanFromFileFormData] = Depends(to_file_meta),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     api_key: APIKey = Depends(get_api_key),
 ):
     try:
@@ -183,6 +241,77 @@ async def create_scan(
     return schemas.Scan.from_orm(scan)
 
 
+@router.post(
+    "/uploads",
+    response_model=schemas.Scan,
+    response_model_by_alias=False,
+)
+async def create_scan_from_upload(
+    payload: schemas.ScanFromUpload,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: APIKey = Depends(get_api_key),
+):
+    scan = await create_scan_from_uploads(
+        db, payload.metadata, payload.upload_id, payload.ser_upload_id
+    )
+
+    await send_scan_event_to_kafka(
+        ScanCreatedEvent(**schemas.Scan.from_orm(scan).dict())
+    )
+
+    return schemas.Scan.from_orm(scan)
+
+
+# The watcher has extracted the metadata ( and image ) on the acquisition host,
+# so the scan can be created before the scan file has been transferred.
+@router.post(
+    "/extracted",
+    response_model=schemas.Scan,
+    response_model_by_alias=False,
+)
+async def create_scan_from_extracted_metadata(
+    payload: schemas.ScanFromExtractedMetadata,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: APIKey = Depends(get_api_key),
+):
+    sha = await new_scan_sha(db, payload.metadata)
+    scan_from_file = schemas.ScanFromFile(
+        sha=sha, metadata=payload.extracted_metadata, **payload.metadata.dict()
+    )
+    scan = await aio_crud.create_scan(db=db, scan=scan_from_file)
+
+    await send_scan_event_to_kafka(
+        ScanCreatedEvent(**schemas.Scan.from_orm(scan).dict())
+    )
+
+    return schemas.Scan.from_orm(scan)
+
+
+# Attach the scan files for a scan created from extracted metadata, once they
+# have been uploaded.
+@router.post(
+    "/{id}/uploads",
+    response_model=schemas.Scan,
+    response_model_by_alias=False,
+)
+async def add_scan_file_uploads(
+    id: int,
+    payload: schemas.ScanFileUploads,
+    db: AsyncSession = Depends(get_async_db),
+    api_key: APIKey = Depends(get_api_key),
+):
+    scan = await aio_crud.get_scan(db, id=id)
+    if scan is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Scan not found"
+        )
+
+    uploads = get_completed_uploads(payload.upload_id, payload.ser_upload_id)
+    await move_uploads_to_scan(scan.id, uploads, metadata_extracted=True)
+
+    return schemas.Scan.from_orm(scan)
+
+
 @router.get(
     "",
     response_model=List[schemas.Scan],
@@ -190,6 +319,7 @@ async def create_scan(
     dependencies=[Depends(oauth2_password_bearer_or_api_key)],
 )
 def read_scans(
+    request: Request,
     response: Response,
     skip: int = 0,
     limit: int = 100,
@@ -203,8 +333,14 @@ def read_scans(
     sha: Optional[str] = None,
     uuid: Optional[str] = None,
     job_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    count: schemas.CountMode = schemas.CountMode.EXACT,
     db: Session = Depends(get_db),
 ):
+    scan_cursor = None
+    if cursor is not None:
+        scan_cursor = decode_cursor(cursor, schemas.ScanCursor)
+
     scans = crud.get_scans(
         db,
         skip=skip,
@@ -219,12 +355,10 @@ def read_scans(
         sha=sha,
         uuid=uuid,
         job_id=job_id,
+        cursor=scan_cursor,
     )
 
-    count = crud.get_scans_count(
-        db,
-        skip=skip,
-        limit=limit,
+    params = dict(
         scan_id=scan_id,
         state=state,
         created=created,
@@ -236,12 +370,37 @@ def read_scans(
         uuid=uuid,
         job_id=job_id,
     )
+    total = count_crud.get_count(
+        db,
+        count,
+        "scans",
+        crud.get_scans_filters(**params),
+        params,
+        lambda: crud.get_scans_count(db, **params),
+    )
+    if total is not None:
+        response.headers["X-Total-Count"] = str(total)
 
-    response.headers["X-Total-Count"] = str(count)
+    next_cursor = None
+    if len(scans) == limit and len(scans) > 0:
+        next_cursor = schemas.ScanCursor(created=scans[-1].created, id=scans[-1].id)
+    set_next_page_headers(request, response, next_cursor)
 
     return [schemas.Scan.from_orm(scan) for scan in scans]
 
 
+@router.post(
+    "/sha-lookup",
+    response_model=schemas.ScanShaLookup,
+    dependencies=[Depends(oauth2_password_bearer_or_api_key)],
+)
+def sha_lookup(payload: schemas.ScanShaLookup, db: Session = Depends(get_db)):
+    # Return the subset of the SHAs that already have a scan
+    shas = crud.get_existing_shas(db, payload.shas)
+
+    return schemas.ScanShaLookup(shas=shas)
+
+
 @router.get(
     "/{id}",
     response_model=schemas.Scan,
@@ -273,15 +432,15 @@ def read_scan(response: Response, id: int, db: Session = Depends(get_db)):
     dependencies=[Depends(oauth2_password_bearer_or_api_key)],
 )
 async def update_scan(
-    id: int, payload: schemas.ScanUpdate, db: Session = Depends(get_db)
+    id: int, payload: schemas.ScanUpdate, db: AsyncSession = Depends(get_async_db)
 ):
-    db_scan = crud.get_scan(db, id=id)
+    db_scan = await aio_crud.get_scan(db, id=id)
     if db_scan is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND, detail="Scan not found"
         )
 
-    (updated, scan) = crud.update_scan(
+    (updated, db_scan) = await aio_crud.update_scan(
         db,
         id,
         progress=payload.progress,
@@ -290,19 +449,20 @@ async def update_scan(
         metadata=payload.metadata,
         job_id=payload.job_id,
     )
+    # Serialize before anything else is loaded, loading the job reloads the
+    # scan without its relationships.
+    scan = schemas.Scan.from_orm(db_scan)
 
     if updated:
         scan_updated_event = schemas.ScanUpdateEvent(id=id)
         if scan.progress == payload.progress:
             scan_updated_event.progress = cast(int, scan.progress)
 
-        scan_updated_event.locations = [
-            schemas.scan.Location.from_orm(l) for l in scan.locations
-        ]
+        scan_updated_event.locations = scan.locations
 
         if payload.job_id:
-            scan_updated_event.job_ids = schemas.Scan.from_orm(scan).job_ids
-            job = job_crud.get_job(db, payload.job_id)
+            scan_updated_event.job_ids = scan.job_ids
+            job = await aio_job_crud.get_job(db, payload.job_id)
             scan_ids = schemas.Job.from_orm(job).scan_ids
             job_updated_event = schemas.UpdateJobEvent(
                 id=payload.job_id, scan_ids=scan_ids
@@ -314,7 +474,7 @@ async def update_scan(
 
         await send_scan_event_to_kafka(scan_updated_event)
 
-    return schemas.Scan.from_orm(scan)
+    return scan
 
 
 async def _remove_scan_files(db_scan: Scan, host: Optional[str] = None):
@@ -425,7 +585,7 @@ async def upload_image(
     id: int,
     file: UploadFile = File(...),
     api_key: APIKey = Depends(get_api_key),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ) -> None:
     format = settings.IMAGE_FORMAT
 
@@ -434,7 +594,7 @@ async def upload_image(
         await upload_to_file(file, fp)
 
     image_path = f"{settings.IMAGE_URL_PREFIX}/{id}.{format}"
-    (updated, _) = crud.update_scan(db, id, image_path=str(image_path))
+    (updated, _) = await aio_crud.update_scan(db, id, image_path=str(image_path))
     if updated:
         await send_scan_event_to_kafka(
             schemas.ScanUpdateEvent(image_path=image_path, id=id)
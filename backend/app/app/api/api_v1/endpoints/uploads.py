@@ -0,0 +1,140 @@
+import asyncio
+import uuid
+from typing import AsyncGenerator
+
+import aiofiles
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.security.api_key import APIKey
+from starlette.requests import Request
+
+from app import schemas
+from app.api.deps import get_api_key
+from app.api.utils import (ContentDecoder, expire_uploads, file_sha256,
+                           read_upload, remove_upload, upload_paths,
+                           write_upload)
+from app.core.config import settings
+
+router = APIRouter()
+
+
+async def decode_stream(
+    request: Request, decoder: ContentDecoder
+) -> AsyncGenerator[bytes, None]:
+    async for bytes in request.stream():
+        yield decoder.decode(bytes)
+
+    yield decoder.flush()
+
+
+@router.post("", response_model=schemas.Upload)
+def create_upload(
+    payload: schemas.UploadCreate, api_key: APIKey = Depends(get_api_key)
+):
+    if payload.size > settings.UPLOAD_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Upload too large, max size is {settings.UPLOAD_MAX_SIZE} bytes",
+        )
+
+    # Clean up after any uploads that were abandoned, before allocating another
+    expire_uploads()
+
+    upload = schemas.Upload(
+        id=uuid.uuid4().hex, filename=payload.filename, size=payload.size
+    )
+
+    # Allocate the target file, chunks are written in place at their offsets
+    (_, data_path) = upload_paths(upload.id)
+    with data_path.open("wb") as fp:
+        fp.truncate(upload.size)
+
+    write_upload(upload)
+
+    return upload
+
+
+@router.get("/{id}", response_model=schemas.Upload)
+def read_upload_state(id: str, api_key: APIKey = Depends(get_api_key)):
+    return read_upload(id)
+
+
+@router.put("/{id}", response_model=schemas.Upload)
+async def upload_chunk(
+    id: str, offset: int, request: Request, api_key: APIKey = Depends(get_api_key)
+):
+    upload = read_upload(id)
+    if upload.complete:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Upload already finalized"
+        )
+
+    # Chunks can be resent, but not leave a gap
+    if offset < 0 or offset > upload.offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Invalid offset, expected <= {upload.offset}",
+        )
+
+    # A compressed chunk is decoded as it arrives, offsets are always in
+    # terms of the decoded file.
+    decoder = ContentDecoder(request.headers.get("content-encoding"))
+
+    (_, data_path) = upload_paths(id)
+    end = offset
+    async with aiofiles.open(data_path, "r+b") as fp:
+        await fp.seek(offset)
+        async for bytes in decode_stream(request, decoder):
+            if end + len(bytes) > upload.size:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="Chunk extends past the end of the upload",
+                )
+            await fp.write(bytes)
+            end += len(bytes)
+
+    # Re-read, the state is only advanced if we extend it
+    upload = read_upload(id)
+    if end > upload.offset:
+        upload.offset = end
+        write_upload(upload)
+
+    return upload
+
+
+@router.post("/{id}/finalize", response_model=schemas.Upload)
+async def finalize_upload(
+    id: str,
+    payload: schemas.UploadFinalize,
+    api_key: APIKey = Depends(get_api_key),
+):
+    upload = read_upload(id)
+    if upload.complete:
+        return upload
+
+    if upload.offset != upload.size:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Upload incomplete, {upload.offset} of {upload.size} bytes received",
+        )
+
+    (_, data_path) = upload_paths(id)
+    loop = asyncio.get_event_loop()
+    sha = await loop.run_in_executor(None, file_sha256, data_path)
+    if sha != payload.sha256:
+        # Start again
+        upload.offset = 0
+        write_upload(upload)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Checksum mismatch"
+        )
+
+    upload.complete = True
+    write_upload(upload)
+
+    return upload
+
+
+@router.delete("/{id}")
+def delete_upload(id: str, api_key: APIKey = Depends(get_api_key)):
+    read_upload(id)
+    remove_upload(id)
@@ -1,16 +1,17 @@
-from typing import Generator
+from typing import AsyncGenerator, Generator
 
 from fastapi import Depends, HTTPException, Security, status
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.security.api_key import APIKeyCookie, APIKeyHeader, APIKeyQuery
 import jwt
 from jwt.exceptions import InvalidTokenError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from starlette.status import HTTP_403_FORBIDDEN
 
 from app.core.config import settings
 from app.crud import user as crud
-from app.db.session import SessionLocal
+from app.db.session import AsyncSessionLocal, SessionLocal
 from app.schemas import TokenData
 
 # DB
@@ -24,6 +25,11 @@ def get_db() -> Generator:
         db.close()
 
 
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
 # API key
 api_key_query = APIKeyQuery(name=settings.API_KEY_NAME, auto_error=False)
 api_key_header = APIKeyHeader(name=settings.API_KEY_NAME, auto_error=False)
@@ -1,11 +1,29 @@
+import base64
+import hashlib
+import os
+import re
+import time
+import zlib
+from pathlib import Path
+from typing import Optional, Tuple, Type, TypeVar
+
 from aiofiles.threadpool.binary import AsyncBufferedIOBase
-from fastapi import UploadFile
+from fastapi import HTTPException, Request, Response, UploadFile, status
 from passlib.context import CryptContext
+from pydantic import BaseModel, ValidationError
 
+from app import schemas
+from app.core.config import settings
 from app.core.constants import BLOCKSIZE
+from app.core.logging import logger
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+UPLOAD_ID_REGEX = re.compile(r"^[0-9a-f]{32}$")
+
+
+Cursor = TypeVar("Cursor", bound=BaseModel)
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -15,9 +33,175 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+class ContentDecoder(object):
+    """
+    Incrementally decodes a gzip or zstd content encoded body, so it can be
+    written out as it arrives.
+    """
+
+    def __init__(self, encoding: Optional[str]):
+        self._decompressor = None
+        if encoding is None or encoding == "identity":
+            return
+
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        elif encoding == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise HTTPException(
+                    status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                    detail="zstd content encoding not supported",
+                )
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail=f"Unsupported content encoding: {encoding}",
+            )
+
+    def decode(self, bytes: bytes) -> bytes:
+        # The request stream ends with an empty chunk
+        if self._decompressor is None or len(bytes) == 0:
+            return bytes
+
+        try:
+            return self._decompressor.decompress(bytes)
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid encoded content"
+            )
+
+    def flush(self) -> bytes:
+        if self._decompressor is None:
+            return b""
+
+        return self._decompressor.flush()
+
+
 async def upload_to_file(upload: UploadFile, fp: AsyncBufferedIOBase):
+    encoding = None
+    if upload.headers is not None:
+        encoding = upload.headers.get("content-encoding")
+    decoder = ContentDecoder(encoding)
+
     bytes = upload.file.read(BLOCKSIZE)
 
     while len(bytes) > 0:
-        await fp.write(bytes)
+        await fp.write(decoder.decode(bytes))
         bytes = upload.file.read(BLOCKSIZE)
+
+    await fp.write(decoder.flush())
+
+
+def file_sha256(path: Path) -> str:
+    sha = hashlib.sha256()
+    with path.open("rb") as fp:
+        bytes = fp.read(BLOCKSIZE)
+        while len(bytes) > 0:
+            sha.update(bytes)
+            bytes = fp.read(BLOCKSIZE)
+
+    return sha.hexdigest()
+
+
+def upload_dir() -> Path:
+    upload_dir = Path(settings.SCAN_FILE_UPLOAD_DIR) / ".uploads"
+    upload_dir.mkdir(exist_ok=True)
+
+    return upload_dir
+
+
+def upload_paths(id: str) -> Tuple[Path, Path]:
+    """
+    Returns the paths of the state and data files of a resumable upload. They
+    live under the scan file upload directory so a completed upload can be
+    moved into place.
+    """
+    if not UPLOAD_ID_REGEX.match(id):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found"
+        )
+
+    dir = upload_dir()
+
+    return (dir / f"{id}.json", dir / f"{id}.part")
+
+
+def read_upload(id: str) -> schemas.Upload:
+    (state_path, _) = upload_paths(id)
+    try:
+        return schemas.Upload.parse_file(state_path)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found"
+        )
+
+
+def write_upload(upload: schemas.Upload) -> None:
+    (state_path, _) = upload_paths(upload.id)
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(upload.json())
+    os.replace(tmp_path, state_path)
+
+
+def remove_upload(id: str) -> None:
+    for path in upload_paths(id):
+        path.unlink(missing_ok=True)
+
+
+def expire_uploads() -> None:
+    """
+    Remove the uploads that haven't been written to for UPLOAD_TTL hours,
+    those abandoned by the client. The data files are allocated in full, so
+    they would otherwise fill the disk.
+    """
+    expires = time.time() - settings.UPLOAD_TTL * 60 * 60
+    for path in upload_dir().iterdir():
+        try:
+            if path.stat().st_mtime < expires:
+                logger.info(f"Removing expired upload file: {path}")
+                path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            continue
+
+
+def get_completed_upload(id: str) -> Tuple[schemas.Upload, Path]:
+    upload = read_upload(id)
+    if not upload.complete:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Upload not finalized"
+        )
+
+    (_, data_path) = upload_paths(id)
+
+    return (upload, data_path)
+
+
+def encode_cursor(cursor: BaseModel) -> str:
+    return base64.urlsafe_b64encode(cursor.json().encode()).decode()
+
+
+def decode_cursor(cursor: str, cursor_type: Type[Cursor]) -> Cursor:
+    try:
+        return cursor_type.parse_raw(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, ValidationError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+def set_next_page_headers(
+    request: Request, response: Response, cursor: Optional[BaseModel]
+) -> None:
+    # Only set if there may be another page
+    if cursor is None:
+        return
+
+    next_cursor = encode_cursor(cursor)
+    url = request.url.remove_query_params("skip").include_query_params(
+        cursor=next_cursor
+    )
+    response.headers["X-Next-Cursor"] = next_cursor
+    response.headers["Link"] = f'<{url}>; rel="next"'
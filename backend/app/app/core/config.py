@@ -46,6 +46,23 @@ class Settings(BaseSettings):
             path=f"/{values.get('POSTGRES_DB') or ''}",
         )
 
+    # Used by the async sessions, defaults to the asyncpg driver
+    ASYNC_SQLALCHEMY_DATABASE_URI: Optional[str] = None
+
+    @validator("ASYNC_SQLALCHEMY_DATABASE_URI", pre=True)
+    def assemble_async_db_connection(
+        cls, v: Optional[str], values: Dict[str, Any]
+    ) -> Any:
+        if isinstance(v, str):
+            return v
+        return PostgresDsn.build(
+            scheme="postgresql+asyncpg",
+            user=values.get("POSTGRES_USER"),
+            password=values.get("POSTGRES_PASSWORD"),
+            host=values.get("POSTGRES_SERVER"),
+            path=f"/{values.get('POSTGRES_DB') or ''}",
+        )
+
     API_KEY_NAME: str
     API_KEY: str
 
@@ -67,6 +84,12 @@ class Settings(BaseSettings):
     # This is need to avoid associate a HAADF with a old scan if the scan ids
     # have been reset in in the detector software.
     HAADF_SCAN_AGE_LIMIT: int = 1
+    # Resumable uploads with no activity for this long are removed (hours)
+    UPLOAD_TTL: int = 24
+    # Max size (bytes) of a resumable upload, the file is allocated up front
+    UPLOAD_MAX_SIZE: int = 100 * 1024**3
+    # How long (seconds) an estimated count for a filtered listing is cached
+    COUNT_CACHE_TTL: int = 30
 
     SENTRY_DSN_URL: AnyHttpUrl = None
 
@@ -0,0 +1,34 @@
+from typing import Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models, schemas
+from app.crud.aio import scan as scan_crud
+from app.crud.job import select_job, update_job_statement
+
+
+async def get_job(db: AsyncSession, id: int) -> models.Job:
+    result = await db.execute(
+        select_job(id).execution_options(populate_existing=True)
+    )
+
+    return result.scalars().first()
+
+
+async def update_job(
+    db: AsyncSession, id: int, updates: schemas.JobUpdate
+) -> Tuple[bool, models.Job]:
+    updated = False
+
+    if updates.scan_id is not None:
+        scans_updated = await scan_crud.add_job_to_scan(db, updates.scan_id, id)
+        updated = updated or scans_updated
+
+    statement = update_job_statement(id, updates)
+    if statement is not None:
+        resultproxy = await db.execute(statement)
+        updated = resultproxy.rowcount == 1 or updated
+
+    await db.commit()
+
+    return (updated, await get_job(db, id))
@@ -0,0 +1,28 @@
+from typing import Any, Dict, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.crud.microscope import (select_microscope, select_microscopes,
+                                 update_microscope_statement)
+
+
+async def get_microscopes(db: AsyncSession, name: Optional[str] = None):
+    result = await db.execute(select_microscopes(name))
+
+    return result.scalars().all()
+
+
+async def get_microscope(db: AsyncSession, id: int):
+    result = await db.execute(
+        select_microscope(id).execution_options(populate_existing=True)
+    )
+
+    return result.scalars().first()
+
+
+async def update_microscope(db: AsyncSession, id: int, state: Dict[str, Any]):
+    resultproxy = await db.execute(update_microscope_statement(id, state))
+    updated = resultproxy.rowcount == 1
+    await db.commit()
+
+    return (updated, await get_microscope(db, id))
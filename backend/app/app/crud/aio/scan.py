@@ -0,0 +1,157 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import models, schemas
+from app.crud.aio import microscope
+from app.crud.scan import (insert_locations, insert_scan_job, select_id,
+                           select_scan, select_scan_job, select_scans,
+                           select_scans_count, update_scan_statements)
+
+
+async def get_scan(db: AsyncSession, id: int) -> models.Scan:
+    # The relationships can't be lazy loaded in an async session, the shared
+    # statement loads them up front.
+    result = await db.execute(
+        select_scan(id).execution_options(populate_existing=True)
+    )
+
+    return result.scalars().first()
+
+
+async def get_scans(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    scan_id: int = -1,
+    state: Optional[schemas.ScanState] = None,
+    created: Optional[datetime] = None,
+    has_image: Optional[bool] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    microscope_id: Optional[int] = None,
+    sha: Optional[str] = None,
+    uuid: Optional[str] = None,
+    job_id: Optional[int] = None,
+    cursor: Optional[schemas.ScanCursor] = None,
+):
+    statement = select_scans(
+        skip,
+        limit,
+        scan_id,
+        state,
+        created,
+        has_image,
+        start,
+        end,
+        microscope_id,
+        sha,
+        uuid,
+        job_id,
+        cursor,
+    )
+    result = await db.execute(statement)
+
+    return result.scalars().all()
+
+
+async def get_scans_count(
+    db: AsyncSession,
+    scan_id: int = -1,
+    state: Optional[schemas.ScanState] = None,
+    created: Optional[datetime] = None,
+    has_image: Optional[bool] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    microscope_id: Optional[int] = None,
+    sha: Optional[str] = None,
+    uuid: Optional[str] = None,
+    job_id: Optional[int] = None,
+) -> int:
+    statement = select_scans_count(
+        scan_id,
+        state,
+        created,
+        has_image,
+        start,
+        end,
+        microscope_id,
+        sha,
+        uuid,
+        job_id,
+    )
+    result = await db.execute(statement)
+
+    return result.scalar_one()
+
+
+async def create_scan(
+    db: AsyncSession,
+    scan: Union[schemas.Scan4DCreate, schemas.ScanFromFile],
+    image_path: Union[str, None] = None,
+) -> models.Scan:
+    locations = scan.locations
+    scan.locations = []
+
+    if scan.microscope_id is None:
+        microscope_ids = [m.id for m in await microscope.get_microscopes(db)]
+        # We default to the first ( 4D Camera )
+        scan.microscope_id = microscope_ids[0]
+
+    # Note: We have to pass metadata as metadata_ as metadata is reserved!
+    db_scan = models.Scan(**scan.dict(), image_path=image_path, metadata_=scan.metadata)
+    db.add(db_scan)
+    for l in locations:
+        l = models.Location(**l.dict())
+        db_scan.locations.append(l)
+        db.add(l)
+    await db.commit()
+
+    return await get_scan(db, db_scan.id)
+
+
+async def update_scan(
+    db: AsyncSession,
+    id: int,
+    progress: Optional[int] = None,
+    locations: Optional[List[schemas.LocationCreate]] = None,
+    image_path: Optional[str] = None,
+    notes: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    job_id: Optional[int] = None,
+):
+    updated = False
+
+    for statement in update_scan_statements(id, progress, image_path, notes, metadata):
+        resultsproxy = await db.execute(statement)
+        updated = resultsproxy.rowcount == 1 or updated
+
+    if locations:
+        resultsproxy = await db.execute(insert_locations(id, locations))
+        locations_updated = len(resultsproxy.all()) > 0
+        updated = updated or locations_updated
+
+    if job_id is not None:
+        jobs_updated = await add_job_to_scan(db, id, job_id)
+        updated = updated or jobs_updated
+
+    await db.commit()
+
+    return (updated, await get_scan(db, id))
+
+
+async def add_job_to_scan(db: AsyncSession, id: int, job_id: int) -> bool:
+    # Use the association table directly, so the scan's jobs aren't loaded
+    for (model, model_id) in [(models.Scan, id), (models.Job, job_id)]:
+        result = await db.execute(select_id(model, model_id))
+        if result.first() is None:
+            raise Exception(f"{model.__name__} with id {model_id} does not exist.")
+
+    result = await db.execute(select_scan_job(id, job_id))
+    if result.first() is not None:
+        return False
+
+    await db.execute(insert_scan_job(id, job_id))
+
+    return True
@@ -0,0 +1,65 @@
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from cachetools import TTLCache
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import schemas
+from app.core.config import settings
+
+# (table, filters) => count
+_counts: TTLCache = TTLCache(maxsize=1024, ttl=settings.COUNT_CACHE_TTL)
+_counts_lock = threading.Lock()
+
+
+def estimate_table_count(db: Session, table: str) -> Optional[int]:
+    # The planner's estimate, None if the table hasn't been analyzed yet
+    if db.get_bind().dialect.name != "postgresql":
+        return None
+
+    count = db.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE relname = :table"),
+        {"table": table},
+    ).scalar()
+
+    if count is None or count < 0:
+        return None
+
+    return count
+
+
+def get_count(
+    db: Session,
+    mode: schemas.CountMode,
+    table: str,
+    filters: List[Any],
+    params: Dict[str, Any],
+    count: Callable[[], int],
+) -> Optional[int]:
+    """
+    The number of rows matching a listing's filters, counted as requested by
+    the mode. The params identify the filters in the cache.
+    """
+    if mode == schemas.CountMode.NONE:
+        return None
+
+    if mode == schemas.CountMode.EXACT:
+        return count()
+
+    if len(filters) == 0:
+        estimate = estimate_table_count(db, table)
+        if estimate is not None:
+            return estimate
+
+    key = (table, tuple(sorted((k, str(v)) for (k, v) in params.items())))
+    with _counts_lock:
+        cached = _counts.get(key)
+    if cached is not None:
+        return cached
+
+    value = count()
+    with _counts_lock:
+        _counts[key] = value
+
+    return value
@@ -1,49 +1,93 @@
 from datetime import datetime
-from typing import Optional, Tuple, Union, cast
+from typing import Any, List, Optional, Tuple, Union, cast
 
-from sqlalchemy import desc, or_, update
-from sqlalchemy.orm import Session
+from sqlalchemy import desc, func, or_, select, update
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.sql import Select, Update
 
 from app import models, schemas
 from app.crud import scan as scan_crud
 
 
+def select_job(id: int) -> Select:
+    # Only the scan ids are needed to serialize a job
+    return (
+        select(models.Job)
+        .options(selectinload(models.Job.scans).load_only(models.Scan.id))
+        .where(models.Job.id == id)
+    )
+
+
 def get_job(db: Session, id: int):
-    return db.query(models.Job).filter(models.Job.id == id).first()
+    return db.execute(select_job(id)).scalars().first()
 
 
 def get_job_by_slurm_id(db: Session, slurm_id: int):
     return db.query(models.Job).filter(models.Job.slurm_id == slurm_id).first()
 
 
-def _get_jobs_query(
-    db: Session,
-    skip: int = 0,
-    limit: int = 100,
+def get_jobs_filters(
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
     slurm_id: Optional[int] = None,
     job_type: Optional[schemas.JobType] = None,
     scan_id: Optional[int] = None,
-):
-    query = db.query(models.Job)
+) -> List[Any]:
+    filters: List[Any] = []
 
     if slurm_id is not None:
-        query = query.filter(models.Job.slurm_id == slurm_id)
+        filters.append(models.Job.slurm_id == slurm_id)
 
     if job_type is not None:
-        query = query.filter(models.Job.job_type == job_type)
+        filters.append(models.Job.job_type == job_type)
 
     if start is not None:
-        query = query.filter(models.Job.submit > start)
+        filters.append(models.Job.submit > start)
 
     if end is not None:
-        query = query.filter(models.Job.submit < end)
+        filters.append(models.Job.submit < end)
 
     if scan_id is not None:
-        query = query.filter(models.Job.scans.any(id=scan_id))
+        filters.append(models.Job.scans.any(id=scan_id))
+
+    return filters
+
+
+def select_jobs(
+    skip: int = 0,
+    limit: int = 100,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    slurm_id: Optional[int] = None,
+    job_type: Optional[schemas.JobType] = None,
+    scan_id: Optional[int] = None,
+    cursor: Optional[schemas.JobCursor] = None,
+) -> Select:
+    filters = get_jobs_filters(start, end, slurm_id, job_type, scan_id)
+
+    # Keyset pagination, start after the last job of the previous page
+    if cursor is not None:
+        filters.append(models.Job.id < cursor.id)
+
+    return (
+        select(models.Job)
+        .where(*filters)
+        .order_by(desc(models.Job.id))
+        .offset(skip)
+        .limit(limit)
+    )
 
-    return query
+
+def select_jobs_count(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    slurm_id: Optional[int] = None,
+    job_type: Optional[schemas.JobType] = None,
+    scan_id: Optional[int] = None,
+) -> Select:
+    filters = get_jobs_filters(start, end, slurm_id, job_type, scan_id)
+
+    return select(func.count()).select_from(models.Job).where(*filters)
 
 
 def get_jobs(
@@ -55,10 +99,13 @@ def get_jobs(
     slurm_id: Optional[int] = None,
     job_type: Optional[schemas.JobType] = None,
     scan_id: Optional[int] = None,
+    cursor: Optional[schemas.JobCursor] = None,
 ):
-    query = _get_jobs_query(db, skip, limit, start, end, slurm_id, job_type, scan_id)
+    statement = select_jobs(
+        skip, limit, start, end, slurm_id, job_type, scan_id, cursor
+    )
 
-    return query.order_by(desc(models.Job.id)).offset(skip).limit(limit).all()
+    return db.execute(statement).scalars().all()
 
 
 def get_jobs_count(
@@ -71,9 +118,9 @@ def get_jobs_count(
     job_type: Optional[schemas.JobType] = None,
     scan_id: Optional[int] = None,
 ):
-    query = _get_jobs_query(db, skip, limit, start, end, slurm_id, job_type, scan_id)
+    statement = select_jobs_count(start, end, slurm_id, job_type, scan_id)
 
-    return query.count()
+    return db.execute(statement).scalar_one()
 
 
 def create_job(db: Session, job: schemas.JobCreate):
@@ -93,28 +140,15 @@ def create_job(db: Session, job: schemas.JobCreate):
 
 
 def add_scan_to_job(db: Session, id: int, scan_id: int) -> bool:
-    scans_updated = False
-    scan = scan_crud.get_scan(db, scan_id)
-
-    if scan is None:
-        raise Exception(f"Scan with id {scan_id} does not exist.")
-
-    job = get_job(db, id)
-
-    if job is not None and not any([s.id == scan_id for s in job.scans]):
-        job.scans.append(scan)
-        scans_updated = True
-
-    return scans_updated
+    return scan_crud.add_job_to_scan(db, scan_id, id)
 
 
-def update_job(
-    db: Session, id: int, updates: schemas.JobUpdate
-) -> Tuple[bool, models.Job]:
+def update_job_statement(id: int, updates: schemas.JobUpdate) -> Optional[Update]:
+    # A single update, that only matches the job if it changes a value. None if
+    # there is nothing to update.
     statement = update(models.Job).where(models.Job.id == id)
 
     or_comparisons = []
-    updated = False
 
     if updates.state is not None:
         statement = statement.values(state=updates.state)
@@ -145,13 +179,23 @@ def update_job(
         or_comparisons.append(models.Job.notes != updates.notes)
         or_comparisons.append(models.Job.notes == None)
 
+    if not or_comparisons:
+        return None
+
+    return statement.where(or_(*or_comparisons))
+
+
+def update_job(
+    db: Session, id: int, updates: schemas.JobUpdate
+) -> Tuple[bool, models.Job]:
+    updated = False
+
     if updates.scan_id is not None:
         scans_updated = add_scan_to_job(db, id, updates.scan_id)
         updated = updated or scans_updated
 
-    if or_comparisons:
-        statement = statement.where(or_(*or_comparisons))
-
+    statement = update_job_statement(id, updates)
+    if statement is not None:
         resultproxy = db.execute(statement)
         updated = resultproxy.rowcount == 1 or updated
 
@@ -163,26 +207,29 @@ def update_job(
 def get_prev_next_job(
     db: Session, id: int
 ) -> Tuple[Union[int, None], Union[int, None]]:
-    job = get_job(db, id)
-
-    if job is None:
-        raise Exception("Invalid job id: {id}")
-
+    # One query, the neighbours are looked up in the (job_type, id) index
+    # constrained by the type of the job.
+    other = aliased(models.Job)
     prev_job = (
-        db.query(models.Job.id)
-        .order_by(models.Job.id.desc())
-        .filter(models.Job.job_type == job.job_type)
-        .filter(models.Job.id < id)
-        .limit(1)
-        .scalar()
+        select(func.max(other.id))
+        .where(other.job_type == models.Job.job_type)
+        .where(other.id < models.Job.id)
+        .scalar_subquery()
     )
     next_job = (
-        db.query(models.Job.id)
-        .order_by(models.Job.id.asc())
-        .filter(models.Job.job_type == job.job_type)
-        .filter(models.Job.id > id)
-        .limit(1)
-        .scalar()
+        select(func.min(other.id))
+        .where(other.job_type == models.Job.job_type)
+        .where(other.id > models.Job.id)
+        .scalar_subquery()
     )
+    row = (
+        db.query(prev_job.label("prev_job"), next_job.label("next_job"))
+        .select_from(models.Job)
+        .filter(models.Job.id == id)
+        .first()
+    )
+
+    if row is None:
+        raise Exception(f"Invalid job id: {id}")
 
-    return (prev_job, next_job)
+    return (row.prev_job, row.next_job)
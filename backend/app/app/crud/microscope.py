@@ -1,30 +1,41 @@
 from typing import Any, Dict, Optional
 
-from sqlalchemy import asc, update
+from sqlalchemy import asc, select, update
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select, Update
 
 from app import models
 
 
-def get_microscopes(db: Session, name: Optional[str] = None):
-    query = db.query(models.Microscope)
+def select_microscopes(name: Optional[str] = None) -> Select:
+    statement = select(models.Microscope)
 
     if name is not None:
-        query = query.filter(models.Microscope.name == name)
+        statement = statement.where(models.Microscope.name == name)
 
-    return query.order_by(asc(models.Microscope.id)).all()
+    return statement.order_by(asc(models.Microscope.id))
 
 
-def get_microscope(db: Session, id: int):
-    return db.query(models.Microscope).filter(models.Microscope.id == id).first()
+def select_microscope(id: int) -> Select:
+    return select(models.Microscope).where(models.Microscope.id == id)
 
 
-def update_microscope(db: Session, id: int, state: Dict[str, Any]):
-    statement = (
+def update_microscope_statement(id: int, state: Dict[str, Any]) -> Update:
+    return (
         update(models.Microscope).where(models.Microscope.id == id).values(state=state)
     )
 
-    resultproxy = db.execute(statement)
+
+def get_microscopes(db: Session, name: Optional[str] = None):
+    return db.execute(select_microscopes(name)).scalars().all()
+
+
+def get_microscope(db: Session, id: int):
+    return db.execute(select_microscope(id)).scalars().first()
+
+
+def update_microscope(db: Session, id: int, state: Dict[str, Any]):
+    resultproxy = db.execute(update_microscope_statement(id, state))
     updated = resultproxy.rowcount == 1
     db.commit()
 
@@ -1,26 +1,50 @@
 from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple, Union
 
-from sqlalchemy import desc, or_, update
-from sqlalchemy.orm import Session
+from sqlalchemy import desc, func, insert, or_, select, tuple_, update
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.sql import Insert, Select, Update
 
 from app import models, schemas
-from app.crud import job as job_crud
 from app.crud import microscope
+from app.models.association import scan_job_table
+
+
+def scan_load_options() -> List[Any]:
+    # Load what is needed to serialize a scan, batched rather than a query per
+    # scan. The job ids come from the association table, the jobs themselves
+    # aren't needed ( and have large outputs ).
+    return [
+        selectinload(models.Scan.locations),
+        selectinload(models.Scan.scan_jobs),
+    ]
+
+
+def insert_locations(id: int, locations: List[schemas.LocationCreate]):
+    # A single statement, locations the scan already has are skipped. Returns
+    # the ids of the locations added.
+    return (
+        postgresql.insert(models.Location)
+        .values([dict(**l.dict(), scan_id=id) for l in locations])
+        .on_conflict_do_nothing(constraint="scan_id_host_path")
+        .returning(models.Location.id)
+    )
+
+
+def select_scan(id: int) -> Select:
+    return select(models.Scan).options(*scan_load_options()).where(models.Scan.id == id)
 
 
 def get_scan(db: Session, id: int) -> models.Scan:
-    return db.query(models.Scan).filter(models.Scan.id == id).first()
+    return db.execute(select_scan(id)).scalars().first()
 
 
 def get_scan_by_scan_id(db: Session, scan_id: int):
     return db.query(models.Scan).filter(models.Scan.scan_id == scan_id).first()
 
 
-def _get_scans_query(
-    db: Session,
-    skip: int = 0,
-    limit: int = 100,
+def get_scans_filters(
     scan_id: int = -1,
     state: Optional[schemas.ScanState] = None,
     created: Optional[datetime] = None,
@@ -31,45 +55,119 @@ def _get_scans_query(
     sha: Optional[str] = None,
     uuid: Optional[str] = None,
     job_id: Optional[int] = None,
-):
-    query = db.query(models.Scan)
+) -> List[Any]:
+    # The where clauses, shared with the async queries
+    filters: List[Any] = []
     if scan_id > -1:
-        query = query.filter(models.Scan.scan_id == scan_id)
+        filters.append(models.Scan.scan_id == scan_id)
 
     if state is not None:
         if state == schemas.ScanState.TRANSFER:
-            query = query.filter(models.Scan.progress < 100)
+            filters.append(models.Scan.progress < 100)
         elif state == schemas.ScanState.COMPLETE:
-            query = query.filter(models.Scan.progress == 100)
+            filters.append(models.Scan.progress == 100)
 
     if created is not None:
-        query = query.filter(models.Scan.created == created)
+        filters.append(models.Scan.created == created)
 
     if has_image is not None:
         if has_image:
-            query = query.filter(models.Scan.image_path != None)
+            filters.append(models.Scan.image_path != None)
         else:
-            query = query.filter(models.Scan.image_path == None)
+            filters.append(models.Scan.image_path == None)
 
     if start is not None:
-        query = query.filter(models.Scan.created > start)
+        filters.append(models.Scan.created > start)
 
     if end is not None:
-        query = query.filter(models.Scan.created < end)
+        filters.append(models.Scan.created < end)
 
     if microscope_id is not None:
-        query = query.filter(models.Scan.microscope_id == microscope_id)
+        filters.append(models.Scan.microscope_id == microscope_id)
 
     if sha is not None:
-        query = query.filter(models.Scan.sha == sha)
+        filters.append(models.Scan.sha == sha)
 
     if uuid is not None:
-        query = query.filter(models.Scan.uuid == uuid)
+        filters.append(models.Scan.uuid == uuid)
 
     if job_id is not None:
-        query = query.filter(models.Scan.jobs.any(id=job_id))
+        filters.append(models.Scan.jobs.any(id=job_id))
+
+    return filters
+
+
+def select_scans(
+    skip: int = 0,
+    limit: int = 100,
+    scan_id: int = -1,
+    state: Optional[schemas.ScanState] = None,
+    created: Optional[datetime] = None,
+    has_image: Optional[bool] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    microscope_id: Optional[int] = None,
+    sha: Optional[str] = None,
+    uuid: Optional[str] = None,
+    job_id: Optional[int] = None,
+    cursor: Optional[schemas.ScanCursor] = None,
+) -> Select:
+    # The statements are shared with the async queries, so the two don't drift
+    filters = get_scans_filters(
+        scan_id,
+        state,
+        created,
+        has_image,
+        start,
+        end,
+        microscope_id,
+        sha,
+        uuid,
+        job_id,
+    )
+
+    # Keyset pagination, start after the last scan of the previous page
+    if cursor is not None:
+        filters.append(
+            tuple_(models.Scan.created, models.Scan.id) < tuple_(cursor.created, cursor.id)
+        )
+
+    return (
+        select(models.Scan)
+        .options(*scan_load_options())
+        .where(*filters)
+        .order_by(desc(models.Scan.created), desc(models.Scan.id))
+        .offset(skip)
+        .limit(limit)
+    )
+
+
+def select_scans_count(
+    scan_id: int = -1,
+    state: Optional[schemas.ScanState] = None,
+    created: Optional[datetime] = None,
+    has_image: Optional[bool] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    microscope_id: Optional[int] = None,
+    sha: Optional[str] = None,
+    uuid: Optional[str] = None,
+    job_id: Optional[int] = None,
+) -> Select:
+    filters = get_scans_filters(
+        scan_id,
+        state,
+        created,
+        has_image,
+        start,
+        end,
+        microscope_id,
+        sha,
+        uuid,
+        job_id,
+    )
 
-    return query
+    return select(func.count()).select_from(models.Scan).where(*filters)
 
 
 def get_scans(
@@ -86,9 +184,9 @@ def get_scans(
     sha: Optional[str] = None,
     uuid: Optional[str] = None,
     job_id: Optional[int] = None,
+    cursor: Optional[schemas.ScanCursor] = None,
 ):
-    query = _get_scans_query(
-        db,
+    statement = select_scans(
         skip,
         limit,
         scan_id,
@@ -101,9 +199,10 @@ def get_scans(
         sha,
         uuid,
         job_id,
+        cursor,
     )
 
-    return query.order_by(desc(models.Scan.created)).offset(skip).limit(limit).all()
+    return db.execute(statement).scalars().all()
 
 
 def get_scans_count(
@@ -121,10 +220,7 @@ def get_scans_count(
     uuid: Optional[str] = None,
     job_id: Optional[int] = None,
 ):
-    query = _get_scans_query(
-        db,
-        skip,
-        limit,
+    statement = select_scans_count(
         scan_id,
         state,
         created,
@@ -137,7 +233,13 @@ def get_scans_count(
         job_id,
     )
 
-    return query.count()
+    return db.execute(statement).scalar_one()
+
+
+def get_existing_shas(db: Session, shas: List[str]) -> List[str]:
+    rows = db.query(models.Scan.sha).filter(models.Scan.sha.in_(shas)).all()
+
+    return [row.sha for row in rows]
 
 
 def create_scan(
@@ -166,48 +268,26 @@ def create_scan(
     return db_scan
 
 
-def update_scan(
-    db: Session,
+def update_scan_statements(
     id: int,
     progress: Optional[int] = None,
-    locations: Optional[List[schemas.LocationCreate]] = None,
     image_path: Optional[str] = None,
     notes: Optional[str] = None,
     metadata: Optional[Dict[str, Any]] = None,
-    job_id: Optional[int] = None,
-):
-    updated = False
+) -> List[Update]:
+    # An update per field, each only matches the scan if it changes the value
+    statements = []
 
     if progress is not None:
-        statement = (
+        statements.append(
             update(models.Scan)
             .where(models.Scan.id == id)
             .where(models.Scan.progress < progress)
             .values(progress=progress)
         )
 
-        resultsproxy = db.execute(statement)
-        progress_updated = resultsproxy.rowcount == 1
-        updated = updated or progress_updated
-
-    if locations is not None:
-        locations_updated = False
-        for l in locations:
-            exists = (
-                db.query(models.Location.id)
-                .filter_by(scan_id=id, host=l.host, path=l.path)
-                .first()
-                is not None
-            )
-            if not exists:
-                l = models.Location(**l.dict(), scan_id=id)
-                db.add(l)
-                locations_updated = True
-
-        updated = updated or locations_updated
-
     if image_path is not None:
-        statement = (
+        statements.append(
             update(models.Scan)
             .where(models.Scan.id == id)
             .where(
@@ -217,23 +297,17 @@ def update_scan(
             )
             .values(image_path=image_path)
         )
-        resultsproxy = db.execute(statement)
-        image_path_updated = resultsproxy.rowcount == 1
-        updated = updated or image_path_updated
 
     if notes is not None:
-        statement = (
+        statements.append(
             update(models.Scan)
             .where(models.Scan.id == id)
             .where(or_(models.Scan.notes != notes, models.Scan.notes == None))
             .values(notes=notes)
         )
-        resultsproxy = db.execute(statement)
-        notes_updated = resultsproxy.rowcount == 1
-        updated = updated or notes_updated
 
     if metadata is not None:
-        statement = (
+        statements.append(
             update(models.Scan)
             .where(models.Scan.id == id)
             .where(
@@ -241,22 +315,47 @@ def update_scan(
             )
             .values(metadata_=metadata)
         )
+
+    return statements
+
+
+def select_id(model: Any, id: int) -> Select:
+    return select(model.id).where(model.id == id)
+
+
+def select_scan_job(id: int, job_id: int) -> Select:
+    return select(scan_job_table.c.scan_id).where(
+        scan_job_table.c.scan_id == id, scan_job_table.c.job_id == job_id
+    )
+
+
+def insert_scan_job(id: int, job_id: int) -> Insert:
+    return insert(scan_job_table).values(scan_id=id, job_id=job_id)
+
+
+def update_scan(
+    db: Session,
+    id: int,
+    progress: Optional[int] = None,
+    locations: Optional[List[schemas.LocationCreate]] = None,
+    image_path: Optional[str] = None,
+    notes: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    job_id: Optional[int] = None,
+):
+    updated = False
+
+    for statement in update_scan_statements(id, progress, image_path, notes, metadata):
         resultsproxy = db.execute(statement)
-        metadata_updated = resultsproxy.rowcount == 1
-        updated = updated or metadata_updated
+        updated = resultsproxy.rowcount == 1 or updated
 
-    if job_id is not None:
-        jobs_updated = False
-        scan = get_scan(db, id)
-        if scan is None:
-            raise Exception(f"Scan with id {id} does not exist.")
-        # If jobs get too large, this operation should be moved
-        # to a db query and made optional
-        if not any([job.id == job_id for job in scan.jobs]):
-            job = job_crud.get_job(db, job_id)
-            scan.jobs.append(job)
-            jobs_updated = True
+    if locations:
+        resultsproxy = db.execute(insert_locations(id, locations))
+        locations_updated = len(resultsproxy.all()) > 0
+        updated = updated or locations_updated
 
+    if job_id is not None:
+        jobs_updated = add_job_to_scan(db, id, job_id)
         updated = updated or jobs_updated
 
     db.commit()
@@ -264,6 +363,20 @@ def update_scan(
     return (updated, get_scan(db, id))
 
 
+def add_job_to_scan(db: Session, id: int, job_id: int) -> bool:
+    # Use the association table directly, so the scan's jobs aren't loaded
+    for (model, model_id) in [(models.Scan, id), (models.Job, job_id)]:
+        if db.execute(select_id(model, model_id)).first() is None:
+            raise Exception(f"{model.__name__} with id {model_id} does not exist.")
+
+    if db.execute(select_scan_job(id, job_id)).first() is not None:
+        return False
+
+    db.execute(insert_scan_job(id, job_id))
+
+    return True
+
+
 def count(db: Session) -> int:
     return db.query(models.Scan).count()
 
@@ -306,27 +419,29 @@ def delete_locations(db: Session, scan_id: int, host: str) -> None:
 def get_prev_next_scan(
     db: Session, id: int
 ) -> Tuple[Union[int, None], Union[int, None]]:
-    # Fetch the scan so we can constrain by microscope id
-    scan = get_scan(db, id)
-
-    if scan is None:
-        raise Exception("Invalid scan id: {id}")
-
+    # One query, the neighbours are looked up in the (microscope_id, id) index
+    # constrained by the microscope of the scan.
+    other = aliased(models.Scan)
     prev_scan = (
-        db.query(models.Scan.id)
-        .order_by(models.Scan.id.desc())
-        .filter(models.Scan.microscope_id == scan.microscope_id)
-        .filter(models.Scan.id < id)
-        .limit(1)
-        .scalar()
+        select(func.max(other.id))
+        .where(other.microscope_id == models.Scan.microscope_id)
+        .where(other.id < models.Scan.id)
+        .scalar_subquery()
     )
     next_scan = (
-        db.query(models.Scan.id)
-        .order_by(models.Scan.id.asc())
-        .filter(models.Scan.microscope_id == scan.microscope_id)
-        .filter(models.Scan.id > id)
-        .limit(1)
-        .scalar()
+        select(func.min(other.id))
+        .where(other.microscope_id == models.Scan.microscope_id)
+        .where(other.id > models.Scan.id)
+        .scalar_subquery()
+    )
+    row = (
+        db.query(prev_scan.label("prev_scan"), next_scan.label("next_scan"))
+        .select_from(models.Scan)
+        .filter(models.Scan.id == id)
+        .first()
     )
 
-    return (prev_scan, next_scan)
+    if row is None:
+        raise Exception(f"Invalid scan id: {id}")
+
+    return (row.prev_scan, row.next_scan)
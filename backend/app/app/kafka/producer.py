@@ -1,4 +1,5 @@
-from typing import Union
+import random
+from typing import List, Union
 
 from aiokafka import AIOKafkaProducer
 
@@ -54,6 +55,42 @@ async def send_filesystem_event_to_kafka(event: FileSystemEvent) -> None:
         logger.exception(f"Exception send on topic: {TOPIC_STATUS_FILE_EVENTS}")
 
 
+async def send_filesystem_events_to_kafka(events: List[FileSystemEvent]) -> None:
+    if producer is None:
+        raise Exception("Producer has not been initialized")
+
+    try:
+        # Publish the events as a single batch, on a single partition so the
+        # order of the events is preserved.
+        partitions = await producer.partitions_for(TOPIC_STATUS_FILE_EVENTS)
+        partition = random.choice(sorted(partitions))
+
+        batch = producer.create_batch()
+        for event in events:
+            if batch.append(key=None, value=event, timestamp=None) is not None:
+                continue
+
+            # The batch is full, send it and start a new one
+            if batch.record_count() > 0:
+                await producer.send_batch(
+                    batch, TOPIC_STATUS_FILE_EVENTS, partition=partition
+                )
+                batch = producer.create_batch()
+
+                if batch.append(key=None, value=event, timestamp=None) is not None:
+                    continue
+
+            # Too large to fit into a batch on its own
+            await producer.send(TOPIC_STATUS_FILE_EVENTS, event, partition=partition)
+
+        if batch.record_count() > 0:
+            await producer.send_batch(
+                batch, TOPIC_STATUS_FILE_EVENTS, partition=partition
+            )
+    except:
+        logger.exception(f"Exception send on topic: {TOPIC_STATUS_FILE_EVENTS}")
+
+
 async def send_log_file_sync_event_to_kafka(event: SyncEvent) -> None:
     if producer is None:
         raise Exception("Producer has not been initialized")
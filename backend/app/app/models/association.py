@@ -8,3 +8,9 @@ scan_job_table = Table(
     Column("scan_id", ForeignKey("scans.id", ondelete="CASCADE"), primary_key=True),
     Column("job_id", ForeignKey("jobs.id", ondelete="CASCADE"), primary_key=True),
 )
+
+
+class ScanJob(Base):
+    # The association as a class, so a scan's job ids can be loaded without
+    # loading the jobs
+    __table__ = scan_job_table
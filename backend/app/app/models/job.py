@@ -1,4 +1,5 @@
-from sqlalchemy import JSON, Column, DateTime, Enum, Integer, Interval, String
+from sqlalchemy import (JSON, Column, DateTime, Enum, Index, Integer, Interval,
+                        String)
 from sqlalchemy.orm import relationship
 
 from app.db.base_class import Base
@@ -8,6 +9,9 @@ from .association import scan_job_table
 
 
 class Job(Base):
+    # For the previous/next job of a type
+    __table_args__ = (Index("ix_jobs_job_type_id", "job_type", "id"),)
+
     id = Column(Integer, primary_key=True, index=True)
     job_type = Column(String)
     slurm_id = Column(Integer, index=True, nullable=True)
@@ -1,13 +1,20 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 
 from app.db.base_class import Base
 
-from .association import scan_job_table
+from .association import ScanJob, scan_job_table
 
 
 class Scan(Base):
+    __table_args__ = (
+        # For the keyset pagination of the scan listing
+        Index("ix_scans_created_id", "created", "id"),
+        # For the previous/next scan of a microscope
+        Index("ix_scans_microscope_id_id", "microscope_id", "id"),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     scan_id = Column(Integer, index=True)
     sha = Column(String(length=64), nullable=True, index=True, unique=True)
@@ -23,3 +30,4 @@ class Scan(Base):
 
     locations = relationship("Location", cascade="delete")
     jobs = relationship("Job", secondary=scan_job_table, back_populates="scans")
+    scan_jobs = relationship(ScanJob, viewonly=True)
@@ -1,12 +1,15 @@
 from .events import CancelJobEvent, SubmitJobEvent, UpdateJobEvent
 from .file import (FileSystemEvent, FileSystemEventType, HaadfUploaded,
-                   ScanFileUploaded, SyncEvent)
+                   ScanFileUploaded, SyncEvent, Upload, UploadCreate,
+                   UploadFinalize)
 from .job import Job, JobCreate, JobType, JobUpdate
 from .jwt import Token, TokenData
 from .machine import Machine
 from .microscope import Microscope, MicroscopeUpdate, MicroscopeUpdateEvent
 from .notebook import Notebook, NotebookCreate, NotebookCreateEvent
+from .pagination import CountMode, JobCursor, ScanCursor
 from .scan import (Location, LocationCreate, Scan, Scan4DCreate,
-                   ScanCreatedEvent, ScanFromFile, ScanFromFileMetadata,
-                   ScanState, ScanUpdate, ScanUpdateEvent)
+                   ScanCreatedEvent, ScanFileUploads, ScanFromExtractedMetadata,
+                   ScanFromFile, ScanFromFileMetadata, ScanFromUpload,
+                   ScanShaLookup, ScanState, ScanUpdate, ScanUpdateEvent)
 from .user import User, UserCreate, UserResponse
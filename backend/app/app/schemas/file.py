@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
 
 
 class FileSystemEventType(str, Enum):
@@ -50,3 +50,24 @@ class ScanFileUploaded(BaseModel):
     path: str
     # This is the original filename
     filename: str
+    # The metadata and image have already been extracted on the acquisition
+    # host, so only the file itself needs processing
+    metadata_extracted: bool = False
+
+
+class UploadCreate(BaseModel):
+    filename: str
+    size: conint(ge=0)
+
+
+class Upload(BaseModel):
+    id: str
+    filename: str
+    size: int
+    # The number of contiguous bytes received so far
+    offset: int = 0
+    complete: bool = False
+
+
+class UploadFinalize(BaseModel):
+    sha256: str
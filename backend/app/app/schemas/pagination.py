@@ -0,0 +1,22 @@
+from datetime import datetime
+from enum import Enum
+
+from pydantic import BaseModel
+
+
+class CountMode(str, Enum):
+    EXACT = "exact"
+    # From the table statistics when there are no filters, otherwise a cached
+    # count that may be a little out of date.
+    ESTIMATED = "estimated"
+    NONE = "none"
+
+
+# The position of the last row of a page, the next page starts after it
+class ScanCursor(BaseModel):
+    created: datetime
+    id: int
+
+
+class JobCursor(BaseModel):
+    id: int
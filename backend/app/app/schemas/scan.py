@@ -3,7 +3,7 @@ from datetime import datetime
 from enum import Enum
 from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field, validator
+from pydantic import BaseModel, Field, conlist, validator
 
 
 class Location(BaseModel):
@@ -61,7 +61,7 @@ class Scan(BaseModel):
 
     @classmethod
     def from_orm(cls, obj) -> "Scan":
-        job_ids = [job.id for job in obj.jobs]
+        job_ids = [scan_job.job_id for scan_job in obj.scan_jobs]
         locations = [Location.from_orm(location) for location in obj.locations]
         obj_dict = obj.__dict__.copy()
         obj_dict.pop("locations", None)
@@ -85,6 +85,29 @@ class ScanFromFileMetadata(BaseModel):
     microscope_id: int
 
 
+class ScanFromUpload(BaseModel):
+    metadata: ScanFromFileMetadata
+    upload_id: str
+    # Upload id of any associated ser file
+    ser_upload_id: Optional[str]
+
+
+class ScanFromExtractedMetadata(BaseModel):
+    metadata: ScanFromFileMetadata
+    # The metadata extracted from the scan file on the acquisition host
+    extracted_metadata: Dict[str, Any]
+
+    _metadata_infinity = validator("extracted_metadata", allow_reuse=True)(
+        metadata_infinity
+    )
+
+
+class ScanFileUploads(BaseModel):
+    upload_id: str
+    # Upload id of any associated ser file
+    ser_upload_id: Optional[str]
+
+
 class ScanFromFile(BaseModel):
     sha: str
     created: datetime
@@ -95,6 +118,10 @@ class ScanFromFile(BaseModel):
     _metadata_infinity = validator("metadata", allow_reuse=True)(metadata_infinity)
 
 
+class ScanShaLookup(BaseModel):
+    shas: conlist(str, max_items=10000)  # type: ignore
+
+
 class ScanUpdate(BaseModel):
     progress: Optional[int] = None
     locations: Optional[List[LocationCreate]] = None
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+#
+# Latency of the scan and job detail pages, GET /scans/{id} and GET /jobs/{id},
+# which also look up the previous and next scan/job for the navigation headers.
+# Requests the most recent scans and jobs, as the UI does.
+#
+# Run it against a running API, before and after a change:
+#
+# python benchmarks/detail_latency.py --url http://localhost:8000/api/v1 \
+#     --api-key-name access_key --api-key letmeout --requests 1000 \
+#     --concurrency 8
+#
+# Needs aiohttp.
+#
+
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+import aiohttp
+from scan_update_latency import percentiles
+
+
+async def get_ids(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Dict[str, str],
+    resource: str,
+    count: int,
+) -> List[int]:
+    async with session.get(
+        f"{url}/{resource}", headers=headers, params={"limit": count, "count": "none"}
+    ) as r:
+        r.raise_for_status()
+
+        return [item["id"] for item in await r.json()]
+
+
+async def get_details(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Dict[str, str],
+    resource: str,
+    ids: List[int],
+    worker: int,
+    requests: int,
+    latencies: List[float],
+) -> None:
+    for i in range(requests):
+        id = ids[(worker + i) % len(ids)]
+        start = time.monotonic()
+        async with session.get(f"{url}/{resource}/{id}", headers=headers) as r:
+            await r.read()
+            r.raise_for_status()
+        latencies.append(time.monotonic() - start)
+
+
+async def run(args) -> Dict:
+    headers = {args.api_key_name: args.api_key}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    results = {}
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for resource in ["scans", "jobs"]:
+            ids = await get_ids(session, args.url, headers, resource, args.ids)
+            if not ids:
+                continue
+
+            latencies: List[float] = []
+            start = time.monotonic()
+            await asyncio.gather(
+                *[
+                    get_details(
+                        session,
+                        args.url,
+                        headers,
+                        resource,
+                        ids,
+                        worker,
+                        args.requests // args.concurrency,
+                        latencies,
+                    )
+                    for worker in range(args.concurrency)
+                ]
+            )
+            elapsed = time.monotonic() - start
+
+            results[resource] = {
+                "requests": len(latencies),
+                "requests_per_second": len(latencies) / elapsed,
+                "latency": percentiles(latencies),
+            }
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000/api/v1")
+    parser.add_argument("--api-key-name", default="access_key")
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--ids", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+#
+# Load test for PATCH /scans/{id}, sent the way the faust scan worker sends
+# them: progress updates with the scan's locations, from many workers at once.
+# Reports the latency percentiles of the PATCHes and of a probe request that
+# doesn't touch the database, which shows how long the event loop is blocked.
+#
+# Run it against a running API ( with Postgres ), before and after a change:
+#
+# python benchmarks/scan_update_latency.py --url http://localhost:8000/api/v1 \
+#     --api-key-name access_key --api-key letmeout --scans 50 --concurrency 32 \
+#     --duration 30
+#
+# Needs aiohttp.
+#
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import aiohttp
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    samples = sorted(samples)
+
+    def at(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {
+        "p50": statistics.median(samples),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": samples[-1],
+    }
+
+
+async def create_scans(
+    session: aiohttp.ClientSession, url: str, headers: Dict[str, str], count: int
+) -> List[int]:
+    ids = []
+    for i in range(count):
+        scan = {
+            "scan_id": i,
+            "uuid": str(uuid.uuid4()),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "locations": [],
+            "metadata": {},
+        }
+        async with session.post(f"{url}/scans", headers=headers, json=scan) as r:
+            r.raise_for_status()
+            ids.append((await r.json())["id"])
+
+    return ids
+
+
+async def update_scans(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Dict[str, str],
+    ids: List[int],
+    worker: int,
+    deadline: float,
+    latencies: List[float],
+    errors: List[int],
+) -> None:
+    # Each worker walks the scans, so the updates for a scan are concurrent
+    update = 0
+    while time.monotonic() < deadline:
+        id = ids[(worker + update) % len(ids)]
+        update += 1
+        payload = {
+            # Always increasing, so each update changes the row
+            "progress": min(99, update),
+            "locations": [
+                {"host": f"receiver{r}", "path": f"/mnt/nvmedata{r}"} for r in range(4)
+            ],
+        }
+        start = time.monotonic()
+        try:
+            async with session.patch(
+                f"{url}/scans/{id}", headers=headers, json=payload
+            ) as r:
+                await r.read()
+                if r.status != 200:
+                    errors.append(r.status)
+                    continue
+        except aiohttp.ClientError:
+            errors.append(0)
+            continue
+        latencies.append(time.monotonic() - start)
+
+
+async def probe(
+    session: aiohttp.ClientSession,
+    url: str,
+    headers: Dict[str, str],
+    deadline: float,
+    interval: float,
+    latencies: List[float],
+) -> None:
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        async with session.get(f"{url}/machines", headers=headers) as r:
+            await r.read()
+        latencies.append(time.monotonic() - start)
+        await asyncio.sleep(interval)
+
+
+async def run(args) -> Dict:
+    headers = {args.api_key_name: args.api_key}
+    connector = aiohttp.TCPConnector(limit=args.concurrency + 1)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        ids = await create_scans(session, args.url, headers, args.scans)
+
+        deadline = time.monotonic() + args.duration
+        update_latencies: List[float] = []
+        probe_latencies: List[float] = []
+        errors: List[int] = []
+        await asyncio.gather(
+            probe(session, args.url, headers, deadline, 0.05, probe_latencies),
+            *[
+                update_scans(
+                    session,
+                    args.url,
+                    headers,
+                    ids,
+                    worker,
+                    deadline,
+                    update_latencies,
+                    errors,
+                )
+                for worker in range(args.concurrency)
+            ],
+        )
+
+    return {
+        "concurrency": args.concurrency,
+        "updates": len(update_latencies),
+        "updates_per_second": len(update_latencies) / args.duration,
+        "errors": len(errors),
+        "update_latency": percentiles(update_latencies),
+        "probe_latency": percentiles(probe_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000/api/v1")
+    parser.add_argument("--api-key-name", default="access_key")
+    parser.add_argument("--api-key", required=True)
+    parser.add_argument("--scans", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+# Settings the .env doesn't provide
+os.environ.setdefault("NCEMHUB_PATH", "/tmp")
+os.environ.setdefault("MACHINES", "[]")
+
+from app import models  # noqa: E402
+from app.db.base_class import Base  # noqa: E402
+from app.models.association import scan_job_table  # noqa: E402
+
+
+# The tests run against SQLite, which stores JSONB as JSON
+@compiles(JSONB, "sqlite")
+def compile_jsonb_sqlite(element, compiler, **kw):
+    return "JSON"
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    Base.metadata.create_all(engine)
+
+    return engine
+
+
+@pytest.fixture
+def statements(engine) -> List[str]:
+    """
+    The SQL statements executed, to check the number of queries made.
+    """
+    statements: List[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+
+    return statements
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+    yield session
+    session.close()
+
+
+@pytest.fixture
+def scans(db):
+    microscope = models.Microscope(name="4D Camera", config={}, state={})
+    db.add(microscope)
+    db.commit()
+
+    created = datetime(2023, 1, 1, tzinfo=timezone.utc)
+    scans = []
+    for i in range(50):
+        scan = models.Scan(
+            scan_id=i,
+            created=created + timedelta(minutes=i),
+            microscope_id=microscope.id,
+            metadata_={},
+        )
+        db.add(scan)
+        scans.append(scan)
+    db.flush()
+
+    # The locations aren't cascaded, so add them as create_scan does
+    db.add_all(
+        [
+            models.Location(
+                scan_id=scan.id, host=f"receiver{r}", path=f"/mnt/nvmedata{r}"
+            )
+            for scan in scans
+            for r in range(2)
+        ]
+    )
+
+    jobs = [
+        models.Job(job_type="count", machine="perlmutter", params={}, output="x" * 1024)
+        for _ in range(2)
+    ]
+    db.add_all(jobs)
+    db.flush()
+
+    db.execute(
+        scan_job_table.insert(),
+        [{"scan_id": scan.id, "job_id": job.id} for scan in scans for job in jobs],
+    )
+    db.commit()
+
+    ids = [scan.id for scan in scans]
+    # Start each test with nothing loaded
+    db.expunge_all()
+
+    return ids
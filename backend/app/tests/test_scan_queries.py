@@ -0,0 +1,27 @@
+import pytest
+
+from app import schemas
+from app.crud import scan as crud
+
+
+def test_get_scan_query_count(db, scans, statements):
+    scan = schemas.Scan.from_orm(crud.get_scan(db, scans[0]))
+
+    # The scan, its job ids and its locations
+    assert len(statements) == 3
+    assert len(scan.job_ids) == 2
+    assert len(scan.locations) == 2
+    # The job ids come from the association, not the jobs
+    assert not any("FROM jobs" in s for s in statements)
+
+
+@pytest.mark.parametrize("limit", [1, 10, 50])
+def test_get_scans_query_count(db, scans, statements, limit):
+    page = [schemas.Scan.from_orm(scan) for scan in crud.get_scans(db, limit=limit)]
+
+    # The same whatever the size of the page
+    assert len(statements) == 3
+    assert len(page) == limit
+    assert all(len(scan.job_ids) == 2 for scan in page)
+    assert all(len(scan.locations) == 2 for scan in page)
+    assert not any("FROM jobs" in s for s in statements)
@@ -43,7 +43,12 @@ class Settings(BaseSettings):
 
     CUSTODIAN_USER: str
     CUSTODIAN_PRIVATE_KEY: str
+    # Hosts custodian is run on, to remove or list ( for transfer jobs ) scan files
     CUSTODIAN_VALID_HOSTS: List[str] = []
+    # Max number of remove events batched into a single custodian invocation
+    CUSTODIAN_BATCH_SIZE: int = 100
+    # Max time (seconds) to wait for a batch of remove events to build up
+    CUSTODIAN_BATCH_WINDOW: float = 5
 
     class Config:
         case_sensitive = True
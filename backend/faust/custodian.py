@@ -0,0 +1,67 @@
+import json
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, List
+
+from fabric import Connection
+
+from config import settings
+
+# Setup logger
+logger = logging.getLogger("custodian")
+logger.setLevel(logging.INFO)
+
+# host => connection, reused across calls
+connections: Dict[str, Connection] = {}
+
+# The connections are not thread safe, so calls to a host are serialized
+locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+
+
+def get_connection(host: str) -> Connection:
+    if host not in connections:
+        connections[host] = Connection(
+            f"{host}",
+            user=f"{settings.CUSTODIAN_USER}",
+            connect_kwargs={"key_filename": settings.CUSTODIAN_PRIVATE_KEY},
+        )
+
+    return connections[host]
+
+
+def parse_results(stdout: str) -> List[dict]:
+    results = []
+    for line in stdout.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            results.append(json.loads(line))
+        except json.JSONDecodeError:
+            logger.warning(f"Unexpected output from custodian: {line}")
+
+    return results
+
+
+def run(host: str, command: str) -> List[dict]:
+    """
+    Run a command on the custodian command server on a host, returning the
+    JSON lines it outputs.
+    """
+    with locks[host]:
+        try:
+            result = get_connection(host).run(command, hide=True, warn=True)
+        except Exception:
+            # Don't reuse a connection that may be broken
+            connection = connections.pop(host, None)
+            if connection is not None:
+                connection.close()
+            raise
+
+    if result.exited != 0:
+        raise Exception(
+            f"Custodian command '{command}' failed on {host}, exit code: {result.exited}."
+        )
+
+    return parse_results(result.stdout)
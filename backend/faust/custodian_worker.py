@@ -1,9 +1,9 @@
 import asyncio
 import logging
-from typing import List
-
-from fabric import Connection
+from collections import defaultdict
+from typing import Dict, List, Tuple
 
+import custodian
 import faust
 from config import settings
 from constants import TOPIC_CUSTODIAN_EVENTS
@@ -31,21 +31,18 @@ custodian_events_topic = app.topic(
 )
 
 
-def remove(scan: Scan, host: str, paths: List[str]):
-    result = Connection(
-        f"{host}",
-        user=f"{settings.CUSTODIAN_USER}",
-        connect_kwargs={"key_filename": settings.CUSTODIAN_PRIVATE_KEY},
-    ).run(f"rm {scan.scan_id} {' '.join(paths)}", hide=True)
-    if result.exited != 0:
-        logger.error(
-            "Error removing scan {scan.scan_id}({scan.id}), exit code: {result.exit_code}."
-        )
+def remove(scans: List[Scan], host: str, paths: List[str]) -> List[dict]:
+    scan_ids = " ".join(str(s.scan_id) for s in scans)
 
+    return custodian.run(host, f"rm {scan_ids} {' '.join(paths)}")
 
-@app.agent(custodian_events_topic)
-async def watch_for_custodian_events(custodian_events):
-    async for event in custodian_events:
+
+def group_events(
+    events: List[RemoveScanFilesEvent],
+) -> Dict[Tuple[str, Tuple[str, ...]], List[Scan]]:
+    # (host, paths) => scans, so each group is removed with a single invocation
+    groups = defaultdict(list)
+    for event in events:
         scan = event.scan
         host = event.host
 
@@ -54,24 +51,58 @@ async def watch_for_custodian_events(custodian_events):
             continue
 
         # List of paths to remove from
-        paths = [l.path for l in scan.locations if l.host == host]
+        paths = tuple(sorted({l.path for l in scan.locations if l.host == host}))
 
         if len(paths) == 0:
-            logger.warn("No paths to remove.")
+            logger.warn(f"No paths to remove for {scan.scan_id}({scan.id}).")
             continue
 
+        groups[(host, paths)].append(scan)
+
+    return groups
+
+
+async def process_group(host: str, paths: List[str], scans: List[Scan]) -> None:
+    loop = asyncio.get_event_loop()
+    summaries = await loop.run_in_executor(None, remove, scans, host, paths)
+
+    # The watcher resamples the disk usage when it sees the status files
+    # removed, so the microscope state is left to it.
+    freed = 0
+    for summary in summaries:
         logger.info(
-            f"Remove scan files for {scan.scan_id}({scan.id}) from {host}:{paths}."
+            f"Removed {summary['removed']} files ({summary['bytes']} bytes), "
+            f"{summary.get('already_removed', 0)} already removed, from "
+            f"{host}:{summary['mount']} in {summary['elapsed']}s."
         )
+        if "error" in summary:
+            logger.error(
+                f"Error removing files from {host}:{summary['mount']}: "
+                f"{summary['error']}"
+            )
+        freed += summary["bytes"]
+
+    logger.info(f"Freed {freed} bytes on {host}.")
+
+
+def _log_exception(task: asyncio.Task) -> None:
+    try:
+        task.result()
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        logger.exception("Exception removing files.")
 
-        def _log_exception(future: asyncio.Future) -> None:
-            try:
-                future.result()
-            except asyncio.CancelledError:
-                pass
-            except Exception:
-                logger.exception("Exception removing files.")
-
-        loop = asyncio.get_event_loop()
-        future = loop.run_in_executor(None, remove, scan, host, paths)
-        future.add_done_callback(_log_exception)
+
+@app.agent(custodian_events_topic)
+async def watch_for_custodian_events(custodian_events):
+    async for events in custodian_events.take(
+        settings.CUSTODIAN_BATCH_SIZE, within=settings.CUSTODIAN_BATCH_WINDOW
+    ):
+        for ((host, paths), scans) in group_events(events).items():
+            logger.info(
+                f"Remove scan files for {[f'{s.scan_id}({s.id})' for s in scans]} from {host}:{list(paths)}."
+            )
+
+            task = asyncio.create_task(process_group(host, list(paths), scans))
+            task.add_done_callback(_log_exception)
@@ -14,6 +14,7 @@ class Scan(faust.Record):
     locations: List[Location]
     created: datetime
     scan_id: Optional[int]
+    microscope_id: Optional[int] = None
 
 
 class json_numpy(codecs.Codec):
@@ -1,10 +1,12 @@
 import asyncio
 import copy
+import heapq
 import json
 import logging
+from collections import defaultdict
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import aiohttp
 import httpx
@@ -25,7 +27,7 @@ from constants import (DATE_DIR_FORMAT, SFAPI_BASE_URL, SFAPI_TOKEN_URL,
 from faust_records import CancelJobEvent, Job, JobType, SubmitJobEvent
 from schemas import JobUpdate
 from schemas import Location as LocationRest
-from schemas import Machine, Scan, ScanUpdate, SfapiJob
+from schemas import Machine, Scan, ScanFile, ScanUpdate, SfapiJob
 from utils import get_job
 from utils import get_machine
 from utils import get_machine as fetch_machine
@@ -105,8 +107,100 @@ async def get_machine(session: aiohttp.ClientSession, name: str) -> Machine:
     return machine
 
 
+def filter_locations(scan: Scan, machine_names: List[str]) -> Scan:
+    # Make a copy and filter out machines from locations
+    scan = copy.deepcopy(scan)
+    scan.locations = [x for x in scan.locations if x.host not in machine_names]
+
+    return scan
+
+
+def list_scan_files(host: str, scan_id: int, paths: List[str]) -> List[ScanFile]:
+    # Only transfer jobs list files, so only they need fabric
+    import custodian
+
+    results = custodian.run(host, f"ls {scan_id} {' '.join(paths)}")
+
+    return [ScanFile(host=host, path=r["path"], size=r["size"]) for r in results]
+
+
+async def get_scan_files(scan: Scan) -> List[ScanFile]:
+    """
+    List the data files of a scan, with their sizes, using a single custodian
+    call per host.
+    """
+    paths_by_host = defaultdict(list)
+    invalid_hosts = set()
+    for l in scan.locations:
+        # As with the custodian worker, only run custodian on hosts we trust
+        if l.host not in settings.CUSTODIAN_VALID_HOSTS:
+            invalid_hosts.add(l.host)
+            continue
+        paths_by_host[l.host].append(l.path)
+
+    for host in invalid_hosts:
+        logger.error(f"Invalid host: {host}, skipping its files for {scan.scan_id}({scan.id}).")
+
+    loop = asyncio.get_event_loop()
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(None, list_scan_files, host, scan.scan_id, paths)
+            for (host, paths) in paths_by_host.items()
+        ]
+    )
+
+    return [f for files in results for f in files]
+
+
+def pack_files(files: List[ScanFile], ntasks: int) -> List[List[ScanFile]]:
+    """
+    Distribute the files across (at most) ntasks, balancing the bytes each
+    task transfers. Largest first, each file goes to the task with the least
+    bytes so far (LPT).
+    """
+    ntasks = min(ntasks, len(files))
+    tasks = [[] for _ in range(ntasks)]
+    # (bytes, task index)
+    loads: List[Tuple[int, int]] = [(0, i) for i in range(ntasks)]
+
+    for f in sorted(files, key=lambda f: (-f.size, f.host, f.path)):
+        (load, index) = heapq.heappop(loads)
+        tasks[index].append(f)
+        heapq.heappush(loads, (load + f.size, index))
+
+    return tasks
+
+
+async def plan_transfer(
+    scan: Scan, machine: Machine, machine_names: List[str]
+) -> List[List[ScanFile]]:
+    scan = filter_locations(scan, machine_names)
+    files = await get_scan_files(scan)
+    if len(files) == 0:
+        raise Exception(f"No data files found for scan {scan.scan_id}({scan.id}).")
+
+    return pack_files(files, machine.ntasks)
+
+
+async def write_transfer_plan(job: Job, transfer_plan: List[List[ScanFile]]) -> None:
+    # The file lists read by bbcp.sh, one per srun task
+    job_dir = AsyncPath(settings.JOB_SCRIPT_DIRECTORY) / str(job.id)
+    for (index, files) in enumerate(transfer_plan):
+        async with (job_dir / f"_ncem_files_{job.id}_{index}.txt").open("w") as fp:
+            await fp.write(
+                "".join(
+                    f"{settings.ACQUISITION_USER}@{f.host}:{f.path}\n" for f in files
+                )
+            )
+
+
 async def render_job_script(
-    scan: Scan, job: Job, machine: Machine, dest_dir: str, machine_names: List[str]
+    scan: Scan,
+    job: Job,
+    machine: Machine,
+    dest_dir: str,
+    machine_names: List[str],
+    transfer_plan: Optional[List[List[ScanFile]]] = None,
 ) -> str:
     template_name = f"{job.job_type}.sh.j2"
     template_loader = jinja2.FileSystemLoader(
@@ -115,10 +209,8 @@ async def render_job_script(
     template_env = jinja2.Environment(loader=template_loader, enable_async=True)
     template = template_env.get_template(template_name)
 
-    # Make a copy and filter out machines from locations
     if scan is not None:
-        scan = copy.deepcopy(scan)
-        scan.locations = [x for x in scan.locations if x.host not in machine_names]
+        scan = filter_locations(scan, machine_names)
 
     try:
         output = await template.render_async(
@@ -127,6 +219,7 @@ async def render_job_script(
             dest_dir=dest_dir,
             job=job,
             machine=machine,
+            transfer_plan=transfer_plan,
             **job.params,
         )
     except:
@@ -340,14 +433,22 @@ async def process_submit_job_event(
     await dest_path.mkdir(parents=True, exist_ok=True)
     dest_dir = str(dest_path)
 
-    # Render the subsmission script
     machines = await get_machines(session)
+    machine_names = list(machines.keys())
+
+    # Balance the files to transfer across the bbcp tasks
+    transfer_plan = None
+    if job_cfg["bbcp"]:
+        transfer_plan = await plan_transfer(event.scan, machine, machine_names)
+
+    # Render the subsmission script
     job_script_output = await render_job_script(
         scan=event.scan,
         job=event.job,
         machine=machine,
         dest_dir=dest_dir,
-        machine_names=list(machines.keys()),
+        machine_names=machine_names,
+        transfer_plan=transfer_plan,
     )
 
     submission_script_path = (
@@ -384,6 +485,8 @@ async def process_submit_job_event(
             await fp.write(bbcp_script_output)
         await bbcp_script_path.chmod(0o740)
 
+        await write_transfer_plan(event.job, transfer_plan)
+
     # Submit the job
     slurm_id = await submit_job(machine.name, str(submission_script_path))
 
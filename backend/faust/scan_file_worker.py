@@ -48,6 +48,8 @@ class ScanFileUploadedEvent(faust.Record):
     path: str
     # The original filename provided by the user
     filename: str
+    # The metadata and image were extracted on the acquisition host
+    metadata_extracted: bool = False
 
 
 haadf_events_topic = app.topic(TOPIC_HAADF_FILE_EVENTS, value_type=HaadfEvent)
@@ -461,7 +463,8 @@ async def watch_for_scan_file_events(scan_file_events):
                         logger.exception("Exception copying to ncemhub.")
                         raise
 
-                    if Path(path).suffix in DATA_FILE_FORMATS:
+                    extract = not event.metadata_extracted
+                    if extract and Path(path).suffix in DATA_FILE_FORMATS:
                         try:
                             image_path = await generate_image(
                                 tmp, path, f"{id}.{format}"
@@ -483,7 +486,8 @@ async def watch_for_scan_file_events(scan_file_events):
                         metadata = scan.metadata
                         if metadata is None:
                             metadata = {}
-                        metadata.update(extract_metadata(path))
+                        if extract:
+                            metadata.update(extract_metadata(path))
 
                         # Patch the locations to include the location at NERSC
                         locations = scan.locations
@@ -12,6 +12,12 @@ class Location(BaseModel):
     path: str
 
 
+class ScanFile(BaseModel):
+    host: str
+    path: str
+    size: int
+
+
 class ScanStatusFile(BaseModel):
     time: datetime
     last_scan_number: int
@@ -103,3 +109,8 @@ class Microscope(BaseModel):
     id: int
     name: str
     config: Optional[Dict[str, Any]]
+    state: Optional[Dict[str, Any]]
+
+
+class MicroscopeUpdate(BaseModel):
+    state: Dict[str, Any]
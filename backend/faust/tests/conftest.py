@@ -3,7 +3,7 @@ from pathlib import Path
 import pytest
 
 from faust_records import Location, Scan
-from schemas import Machine
+from schemas import Machine, ScanFile
 
 
 # Change to match how faust record comes in... as str
@@ -26,6 +26,28 @@ def scan(locations, created):
     return Scan(id=0, scan_id=1, created=created, locations=locations)
 
 
+@pytest.fixture
+def scan_files(locations):
+    # Uneven module sizes, as we see on the receivers
+    return [
+        ScanFile(
+            host=l.host,
+            path=f"{l.path}/data_scan0000000001_module{m}_dst0_file{f}.data",
+            size=(m + 1) * 1024**3 + f,
+        )
+        for l in locations
+        for m in range(4)
+        for f in range(4)
+    ]
+
+
+@pytest.fixture
+def transfer_plan(scan_files):
+    from job_worker import pack_files
+
+    return pack_files(scan_files, 16)
+
+
 @pytest.fixture
 def job_params():
     return {"threshold": 4.0, "darkfield": "none"}
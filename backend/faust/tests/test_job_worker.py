@@ -11,13 +11,14 @@ async def test_perlmutter_submission_script(
     perlmutter_machine,
     expected_perlmutter_submission_script,
     machine_names,
+    transfer_plan,
 ):
     mocker.patch("authlib.integrations.httpx_client.AsyncOAuth2Client", autospec=True)
 
     dest_dir = "/tmp"
 
     perlmutter_submission_script = await job_worker.render_job_script(
-        scan, job, perlmutter_machine, dest_dir, machine_names
+        scan, job, perlmutter_machine, dest_dir, machine_names, transfer_plan
     )
 
     assert perlmutter_submission_script == expected_perlmutter_submission_script
@@ -31,13 +32,19 @@ async def test_perlmutter_reservation_submission_script(
     perlmutter_reservation_machine,
     expected_perlmutter_reservation_submission_script,
     machine_names,
+    transfer_plan,
 ):
     mocker.patch("authlib.integrations.httpx_client.AsyncOAuth2Client", autospec=True)
 
     dest_dir = "/tmp"
 
     perlmutter_submission_script = await job_worker.render_job_script(
-        scan, job, perlmutter_reservation_machine, dest_dir, machine_names
+        scan,
+        job,
+        perlmutter_reservation_machine,
+        dest_dir,
+        machine_names,
+        transfer_plan,
     )
 
     assert (
@@ -67,3 +74,57 @@ async def test_machine_overrides(
     perlmutter = await job_worker.get_machine(None, "perlmutter")
 
     assert perlmutter == expected_perlmutter_overridden
+
+
+def test_pack_files(scan_files):
+    tasks = job_worker.pack_files(scan_files, 16)
+
+    assert len(tasks) == 16
+    assert sorted(f.path for t in tasks for f in t) == sorted(
+        f.path for f in scan_files
+    )
+
+    # The largest task is within a file of the smallest
+    loads = [sum(f.size for f in t) for t in tasks]
+    assert max(loads) - min(loads) <= max(f.size for f in scan_files)
+
+
+def test_pack_files_fewer_files_than_tasks(scan_files):
+    tasks = job_worker.pack_files(scan_files[:3], 16)
+
+    assert len(tasks) == 3
+    assert all(len(t) == 1 for t in tasks)
+
+
+@pytest.mark.asyncio
+async def test_get_scan_files(mocker, scan, scan_files):
+    def ls(host, command):
+        (_, scan_id, *paths) = command.split()
+        return [
+            {"scan_id": int(scan_id), "path": f.path, "size": f.size}
+            for f in scan_files
+            if f.host == host and any(f.path.startswith(p) for p in paths)
+        ]
+
+    run = mocker.patch("custodian.run", side_effect=ls)
+    mocker.patch.object(job_worker.settings, "CUSTODIAN_VALID_HOSTS", ["localhost"])
+
+    files = await job_worker.get_scan_files(scan)
+
+    # A single call for the host
+    run.assert_called_once_with(
+        "localhost", "ls 1 /mnt/nvmedata1 /mnt/nvmedata4 /mnt/nvmedata5"
+    )
+    assert files == scan_files
+
+
+@pytest.mark.asyncio
+async def test_get_scan_files_invalid_host(mocker, scan, scan_files):
+    run = mocker.patch("custodian.run", return_value=[])
+    mocker.patch.object(job_worker.settings, "CUSTODIAN_VALID_HOSTS", ["receiver"])
+
+    files = await job_worker.get_scan_files(scan)
+
+    # Custodian is never run on localhost
+    run.assert_not_called()
+    assert files == []
@@ -9,8 +9,8 @@ import tenacity
 from aiopath import AsyncPath
 
 from config import settings
-from schemas import (Job, JobUpdate, Machine, Microscope, Scan, ScanCreate,
-                     ScanUpdate)
+from schemas import (Job, JobUpdate, Machine, Microscope, MicroscopeUpdate, Scan,
+                     ScanCreate, ScanUpdate)
 
 logger = logging.getLogger("utils")
 logger.setLevel(logging.INFO)
@@ -333,6 +333,31 @@ async def get_microscope_by_id(session: aiohttp.ClientSession, id: int) -> Micro
         return Microscope(**json)
 
 
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    )
+    | tenacity.retry_if_exception_type(aiohttp.client_exceptions.ClientConnectionError),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+)
+async def update_microscope(
+    session: aiohttp.ClientSession, id: int, update: MicroscopeUpdate
+) -> Microscope:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    async with session.patch(
+        f"{settings.API_URL}/microscopes/{id}", headers=headers, data=update.json()
+    ) as r:
+        r.raise_for_status()
+        json = await r.json()
+
+        return Microscope(**json)
+
+
 @tenacity.retry(
     retry=tenacity.retry_if_exception_type(
         aiohttp.client_exceptions.ServerConnectionError
@@ -10,13 +10,27 @@
 #
 # command="/path/to/this/script/distiller $SSH_ORIGINAL_COMMAND",no-port-forwarding,no-x11-forwarding,no-agent-forwarding,no-pty ...
 #
+# rm and ls take one or more scan ids followed by the paths to look in:
+#
+# ls <scan_id> [<scan_id> ...] <path> [<path> ...]
+#
+# The results are written to stdout as JSON lines, the log goes to stderr. ls
+# outputs the path and size of each data file, rm the number of files removed,
+# the bytes freed and the time taken for each mount.
+#
 
+import json
 import logging
 import os
+import re
 import subprocess
 import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Pattern, Set, Tuple
 
 import coloredlogs
 from config import settings
@@ -27,10 +41,13 @@ STATUS_FILE_GLOB_PATTERN = "4dstem_rec_status_*_scan_{scan_id}.json"
 
 COMMANDS = ["rm", "ls", "bbcp"]
 
+# Max number of mounts to remove files from in parallel
+RM_MAX_WORKERS = 4
+
 # Setup logger
 logger = logging.getLogger("custodian")
 logger.setLevel(logging.INFO)
-handler = logging.StreamHandler(sys.stdout)
+handler = logging.StreamHandler(sys.stderr)
 handler.setLevel(logging.INFO)
 formatter = coloredlogs.ColoredFormatter(
     "%(asctime)s,%(msecs)03d - %(name)s - %(levelname)s - %(message)s"
@@ -44,17 +61,46 @@ if settings.LOG_FILE_PATH is not None:
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
 
-class PermissiveDict(dict):
-    def __missing__(self, key):
-        return f"{{{key}}}"
-
-def _traverse(args, patterns, func):
-    if len(args) < 2:
+def _pattern_regex(pattern: str) -> str:
+    """
+    Convert one of the glob patterns to a regex, capturing the scan id.
+    """
+    regex = ""
+    for part in re.split(r"(\{padded_scan_id\}|\{scan_id\}|\*)", pattern):
+        if part == "{padded_scan_id}":
+            regex += "([0-9]{10})"
+        elif part == "{scan_id}":
+            regex += "([0-9]+)"
+        elif part == "*":
+            regex += ".*"
+        else:
+            regex += re.escape(part)
+
+    return regex
+
+
+def _compile_patterns(patterns: List[str]) -> Pattern:
+    return re.compile("|".join(f"^{_pattern_regex(p)}$" for p in patterns))
+
+
+def _parse_args(args: List[str]) -> Tuple[Set[int], List[str]]:
+    # The scan ids, followed by the paths
+    scan_ids = set()
+    index = 0
+    while index < len(args) and args[index].isdigit():
+        scan_ids.add(int(args[index]))
+        index += 1
+    paths = args[index:]
+
+    if len(scan_ids) == 0 or len(paths) == 0:
         logger.error(f"Invalid number of arguments.")
         raise ValueError()
 
-    scan_id = int(args[0])
-    paths = args[1:]
+    return (scan_ids, paths)
+
+
+def _validate_args(args: List[str]) -> Tuple[Set[int], List[str]]:
+    (scan_ids, paths) = _parse_args(args)
     logger.info(f"Traverse paths: {paths}")
 
     invalid_paths = [p for p in paths if p not in settings.SCAN_DIRECTORIES]
@@ -63,15 +109,7 @@ def _traverse(args, patterns, func):
     # Validate paths
     paths = [p for p in paths if p in settings.SCAN_DIRECTORIES]
 
-    logger.info(f"Traversing file for scan {scan_id} in {paths}.")
-
-    zero_padded_scan_id = f"{scan_id:010}"
-
-    # Render the scan id into the glob patterns
-    patterns = [pattern.format_map(PermissiveDict(padded_scan_id=zero_padded_scan_id)) for pattern in patterns]
-    patterns = [pattern.format_map(PermissiveDict(scan_id=scan_id)) for pattern in patterns]
-
-    logger.info(f"Glob patterns: {patterns}")
+    logger.info(f"Traversing files for scans {sorted(scan_ids)} in {paths}.")
 
     # Check all paths exist
     for path in paths:
@@ -79,12 +117,88 @@ def _traverse(args, patterns, func):
             logger.error(f"Path doesn't exist: {path}")
             raise ValueError()
 
-    # Loop through patterns and paths
-    for pattern in patterns:
+    return (scan_ids, paths)
+
+
+def _scan_directory(
+    path: str, regex: Pattern, scan_ids: Set[int], func: Callable[[int, os.DirEntry], None]
+):
+    # A single pass over the directory
+    with os.scandir(path) as it:
+        for entry in it:
+            match = regex.match(entry.name)
+            if match is None:
+                continue
+
+            scan_id = int(next(g for g in match.groups() if g is not None))
+            if scan_id in scan_ids:
+                logger.debug(f"Calling {func} for {entry.path}.")
+                func(scan_id, entry)
+
+
+def _traverse(args, patterns, func: Callable[[int, os.DirEntry], None]):
+    (scan_ids, paths) = _validate_args(args)
+
+    regex = _compile_patterns(patterns)
+    logger.info(f"Pattern: {regex.pattern}")
+
+    for path in paths:
+        _scan_directory(path, regex, scan_ids, func)
+
+
+def _print_json(result: dict) -> None:
+    print(json.dumps(result), flush=True)
+
+
+def _mount_point(path: str) -> str:
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+
+    return path
+
+
+def _rm_mount(
+    mount: str, paths: List[str], regex: Pattern, scan_ids: Set[int]
+) -> Dict[str, Any]:
+    start = time.monotonic()
+    removed = 0
+    already_removed = 0
+    freed = 0
+
+    def _unlink(scan_id: int, entry: os.DirEntry) -> None:
+        nonlocal removed, already_removed, freed
+        try:
+            size = entry.stat(follow_symlinks=False).st_size
+            os.unlink(entry.path)
+        except FileNotFoundError:
+            # Removed since we listed the directory
+            already_removed += 1
+            return
+
+        removed += 1
+        freed += size
+
+    error = None
+    try:
         for path in paths:
-            for p in Path(path).glob(pattern):
-                logger.info(f"Calling {func} for {p}.")
-                func(p)
+            _scan_directory(path, regex, scan_ids, _unlink)
+    except OSError as ex:
+        # Still report what we did remove from this mount
+        logger.exception(f"Error removing files from {mount}.")
+        error = str(ex)
+
+    summary = {
+        "mount": mount,
+        "removed": removed,
+        "already_removed": already_removed,
+        "bytes": freed,
+        "elapsed": round(time.monotonic() - start, 3),
+    }
+    if error is not None:
+        summary["error"] = error
+
+    return summary
 
 
 def _rm(args):
@@ -96,7 +210,27 @@ def _rm(args):
 
     logger.info("Removing scan files.")
 
-    _traverse(args, patterns, os.unlink)
+    (scan_ids, paths) = _validate_args(args)
+    regex = _compile_patterns(patterns)
+
+    # Each mount is a separate device, so remove from them in parallel
+    mounts = defaultdict(list)
+    for path in paths:
+        mounts[_mount_point(path)].append(path)
+
+    with ThreadPoolExecutor(max_workers=RM_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(_rm_mount, mount, mount_paths, regex, scan_ids)
+            for (mount, mount_paths) in mounts.items()
+        ]
+        for future in futures:
+            summary = future.result()
+            logger.info(
+                f"Removed {summary['removed']} files ({summary['bytes']} bytes), "
+                f"{summary['already_removed']} already removed, "
+                f"from {summary['mount']} in {summary['elapsed']}s."
+            )
+            _print_json(summary)
 
 
 def _ls(args):
@@ -106,7 +240,12 @@ def _ls(args):
 
     logger.info("Listing scan files.")
 
-    _traverse(args, patterns, print)
+    def _print(scan_id: int, entry: os.DirEntry) -> None:
+        _print_json(
+            {"scan_id": scan_id, "path": entry.path, "size": entry.stat().st_size}
+        )
+
+    _traverse(args, patterns, _print)
 
 
 def _bbcp(args):
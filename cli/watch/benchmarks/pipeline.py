@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+#
+# End to end benchmark of the pipeline. Starts the API, the faust workers and
+# the watchers, drives them with the acquisition simulator and measures the
+# time from a status file ( HAADF or scan file ) being written to the update
+# being delivered on the notifications websocket.
+#
+# The simulator is run in stages, one per update interval, so the point at
+# which the pipeline stops keeping up can be seen.
+#
+# It needs Postgres and Kafka, local stand-ins will do, for example:
+#
+# docker run -d -p 5432:5432 -e POSTGRES_PASSWORD=distiller postgres:13
+# docker run -d -p 9092:9092 docker.redpanda.com/redpandadata/redpanda \
+#     redpanda start --overprovisioned --smp 1 --kafka-addr 0.0.0.0:9092 \
+#     --advertise-kafka-addr localhost:9092
+#
+# and an env file with the settings shared by the API and the workers (
+# POSTGRES_*, KAFKA_URL, API_KEY_NAME, API_KEY, JWT_* etc. ), the directories
+# are set by the runner.
+#
+# Usage:
+#
+# python benchmarks/pipeline.py --env pipeline.env --workdir /tmp/pipeline \
+#     --update-intervals 1 0.5 0.25 0.1 --scans 5 --scan-duration 20
+#
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+from simulator import Simulator, add_arguments, config_from_args
+
+REPO = Path(__file__).resolve().parent.parent.parent.parent
+API_DIR = REPO / "backend" / "app"
+FAUST_DIR = REPO / "backend" / "faust"
+WATCH_DIR = REPO / "cli" / "watch" / "distiller"
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark"
+# Seeded by the migrations
+MICROSCOPE = "4D Camera"
+MICROSCOPE_ID = 1
+
+WATCHER_METRICS_PORT = 9464
+
+
+def read_env(path: Path) -> Dict[str, str]:
+    env = {}
+    for line in path.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#") and "=" in line:
+            (key, value) = line.split("=", 1)
+            env[key] = value
+
+    return env
+
+
+class Pipeline(object):
+    def __init__(self, env: Dict[str, str], workdir: Path, api_port: int):
+        self.workdir = workdir
+        self.api_url = f"http://localhost:{api_port}/api/v1"
+        self._api_port = api_port
+        self._processes: List[subprocess.Popen] = []
+
+        self.status_dir = workdir / "status"
+        self.haadf_dir = workdir / "haadf"
+        self.scan_file_dir = workdir / "scan_files"
+        dirs = {
+            "IMAGE_STATIC_DIR": workdir / "static",
+            "IMAGE_UPLOAD_DIR": workdir / "image_upload",
+            "SCAN_FILE_UPLOAD_DIR": workdir / "scan_file_upload",
+            "HAADF_IMAGE_UPLOAD_DIR": workdir / "image_upload",
+            "HAADF_NCEMHUB_DM4_DATA_PATH": workdir / "ncemhub" / "haadf",
+            "NCEMHUB_PATH": workdir / "ncemhub",
+            "NCEMHUB_DATA_PATH": workdir / "ncemhub" / "data",
+        }
+        for d in list(dirs.values()) + [self.status_dir, self.haadf_dir, self.scan_file_dir]:
+            d.mkdir(parents=True, exist_ok=True)
+
+        self.env = {
+            **os.environ,
+            **env,
+            **{k: str(v) for (k, v) in dirs.items()},
+            "API_URL": self.api_url,
+        }
+
+    def _start(self, name: str, args: List[str], cwd: Path, **env: str) -> None:
+        log = open(self.workdir / f"{name}.log", "w")
+        process = subprocess.Popen(
+            args, cwd=cwd, env={**self.env, **env}, stdout=log, stderr=subprocess.STDOUT
+        )
+        self._processes.append(process)
+
+    def setup(self) -> None:
+        subprocess.run(["alembic", "upgrade", "head"], cwd=API_DIR, env=self.env, check=True)
+        # Fails if the user exists, which is fine
+        subprocess.run(
+            [sys.executable, "-m", "app.cli.create_user", "--username", USERNAME,
+             "--fullname", USERNAME, "--password", PASSWORD],
+            cwd=API_DIR, env=self.env,
+        )
+
+    def start(self, haadf: bool, scan_files: bool) -> None:
+        self._start(
+            "api",
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(self._api_port)],
+            API_DIR,
+        )
+
+        faust_data = self.workdir / "faust"
+        for worker in ["scan", "scan_file"]:
+            self._start(
+                f"{worker}_worker",
+                ["faust", "-A", f"{worker}_worker", "--datadir", str(faust_data / worker),
+                 "worker", "-l", "info", "--without-web"],
+                FAUST_DIR,
+            )
+
+        watchers = [("scan_4d_files", self.status_dir)]
+        if haadf:
+            watchers.append(("scan_4d_haadf_files", self.haadf_dir))
+        if scan_files:
+            watchers.append(("scan_files", self.scan_file_dir))
+
+        for (index, (mode, directory)) in enumerate(watchers):
+            self._start(
+                f"watch_{mode}",
+                [sys.executable, "watch.py"],
+                WATCH_DIR,
+                MODE=mode,
+                MICROSCOPE=MICROSCOPE,
+                WATCH_DIRECTORIES=json.dumps([str(directory)]),
+                METRICS_PORT=str(WATCHER_METRICS_PORT + index),
+            )
+
+    def stop(self) -> None:
+        for process in self._processes:
+            process.terminate()
+        for process in self._processes:
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    async def wait_for_api(self, session: aiohttp.ClientSession, timeout: float = 120) -> None:
+        headers = {self.env["API_KEY_NAME"]: self.env["API_KEY"]}
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with session.get(
+                    f"{self.api_url}/microscopes", headers=headers, params={"name": MICROSCOPE}
+                ) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientConnectionError:
+                pass
+
+            if time.monotonic() > deadline:
+                raise Exception("Timed out waiting for the API to start")
+            await asyncio.sleep(1)
+
+    async def token(self, session: aiohttp.ClientSession) -> str:
+        async with session.post(
+            f"{self.api_url}/token", data={"username": USERNAME, "password": PASSWORD}
+        ) as r:
+            r.raise_for_status()
+            json = await r.json()
+
+            return json["access_token"]
+
+
+async def record_notifications(
+    session: aiohttp.ClientSession, url: str, messages: List[Dict[str, Any]]
+) -> None:
+    async with session.ws_connect(url) as ws:
+        async for msg in ws:
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                message = json.loads(msg.data)
+            except ValueError:
+                continue
+            messages.append({"received": time.time(), **message})
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    samples = sorted(samples)
+
+    def at(q: float) -> float:
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {"p50": statistics.median(samples), "p95": at(0.95), "p99": at(0.99), "max": samples[-1]}
+
+
+def analyze(records: List[Dict[str, Any]], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Match the simulator's writes to the notifications they caused. The
+    latency of a status file write is the time until an update with at least
+    its progress was delivered, updates the watcher coalesced are covered by
+    the later update that superseded them.
+    """
+    # distiller id => scan number
+    scan_ids = {
+        m["id"]: m["scan_id"]
+        for m in messages
+        if m.get("event_type") == "scan.created" and m.get("scan_id") is not None
+    }
+    # scan number => [(time, progress, image_path)]
+    updates: Dict[int, List[tuple]] = {}
+    # location path => time created
+    created_by_path: Dict[str, float] = {}
+    for m in messages:
+        if m.get("event_type") not in ["scan.created", "scan.updated"]:
+            continue
+        scan_id = scan_ids.get(m["id"])
+        if scan_id is not None:
+            updates.setdefault(scan_id, []).append(
+                (m["received"], m.get("progress"), m.get("image_path"))
+            )
+        if m.get("event_type") == "scan.created":
+            for location in m.get("locations") or []:
+                created_by_path.setdefault(location["path"], m["received"])
+
+    status_latencies = []
+    haadf_latencies = []
+    scan_file_latencies = []
+    missing = {"status": 0, "haadf": 0, "scan_file": 0}
+    for record in records:
+        kind = record["kind"]
+        latency = None
+        if kind == "status":
+            for (received, progress, _) in updates.get(record["scan_id"], []):
+                if progress is not None and progress >= record["progress"]:
+                    latency = received - record["time"]
+                    break
+            if latency is not None:
+                status_latencies.append(latency)
+        elif kind == "haadf":
+            for (received, _, image_path) in updates.get(record["scan_id"], []):
+                if image_path and received >= record["time"]:
+                    latency = received - record["time"]
+                    break
+            if latency is not None:
+                haadf_latencies.append(latency)
+        elif kind == "scan_file":
+            if record["path"] in created_by_path:
+                latency = created_by_path[record["path"]] - record["time"]
+                scan_file_latencies.append(latency)
+
+        if latency is None:
+            missing[kind] += 1
+
+    status_records = [r for r in records if r["kind"] == "status"]
+    duration = (
+        max(r["time"] for r in status_records) - min(r["time"] for r in status_records)
+        if len(status_records) > 1 else 0
+    )
+    delivered = [m for m in messages if m.get("event_type") == "scan.updated"]
+
+    return {
+        "status_writes": len(status_records),
+        "status_writes_per_second": len(status_records) / duration if duration else None,
+        "updates_delivered": len(delivered),
+        "status_latency": percentiles(status_latencies),
+        "haadf_latency": percentiles(haadf_latencies),
+        "scan_file_latency": percentiles(scan_file_latencies),
+        "missing": missing,
+    }
+
+
+def format_latency(latency: Dict[str, Optional[float]]) -> str:
+    if latency["p50"] is None:
+        return "n/a"
+
+    return " ".join(f"{k} {v * 1000:.0f}ms" for (k, v) in latency.items())
+
+
+async def run_stages(args, pipeline: Pipeline) -> List[Dict[str, Any]]:
+    results = []
+    async with aiohttp.ClientSession() as session:
+        await pipeline.wait_for_api(session)
+        token = await pipeline.token(session)
+        ws_url = (
+            pipeline.api_url.replace("http", "ws", 1)
+            + f"/notifications?microscope_id={MICROSCOPE_ID}&token={token}"
+        )
+
+        first_scan_id = args.first_scan_id
+        for interval in args.update_intervals:
+            messages: List[Dict[str, Any]] = []
+            notifications = asyncio.create_task(record_notifications(session, ws_url, messages))
+            # Let the websocket connect before we start writing
+            await asyncio.sleep(1)
+
+            log_path = pipeline.workdir / f"simulator_{interval}.jsonl"
+            args.update_interval = interval
+            args.first_scan_id = first_scan_id
+            config = config_from_args(
+                args,
+                pipeline.status_dir,
+                pipeline.haadf_dir if args.haadf else None,
+                pipeline.scan_file_dir if args.scan_files else None,
+            )
+            with open(log_path, "w") as log:
+                await Simulator(config, log).run()
+
+            # Let the pipeline drain
+            await asyncio.sleep(args.drain)
+            notifications.cancel()
+            await asyncio.gather(notifications, return_exceptions=True)
+
+            with open(log_path) as log:
+                records = [json.loads(line) for line in log]
+            result = {"update_interval": interval, **analyze(records, messages)}
+            results.append(result)
+            print(
+                f"Update interval {interval}s: {result['status_writes']} status writes "
+                f"({result['status_writes_per_second'] or 0:.1f}/s), "
+                f"{result['updates_delivered']} updates delivered, "
+                f"latency {format_latency(result['status_latency'])}, "
+                f"missing {result['missing']}"
+            )
+            if args.haadf:
+                print(f"  HAADF latency {format_latency(result['haadf_latency'])}")
+            if args.scan_files:
+                print(f"  Scan file latency {format_latency(result['scan_file_latency'])}")
+
+            first_scan_id += args.scans
+
+        # Keep the watcher's own view of the run
+        for port in range(WATCHER_METRICS_PORT, WATCHER_METRICS_PORT + 3):
+            try:
+                async with session.get(f"http://localhost:{port}/metrics") as r:
+                    (pipeline.workdir / f"metrics_{port}.txt").write_text(await r.text())
+            except aiohttp.ClientConnectionError:
+                pass
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env", type=Path, required=True)
+    parser.add_argument("--workdir", type=Path, required=True)
+    parser.add_argument("--api-port", type=int, default=8000)
+    parser.add_argument("--update-intervals", type=float, nargs="+", default=[1, 0.5, 0.25, 0.1])
+    parser.add_argument("--haadf", action="store_true", help="Drop HAADF files after each scan.")
+    parser.add_argument("--drain", type=float, default=10,
+                        help="Time (seconds) to wait for the pipeline after each stage.")
+    parser.add_argument("--latency-slo", type=float, default=2,
+                        help="p99 status latency (seconds) the pipeline is keeping up within.")
+    parser.add_argument("--skip-setup", action="store_true")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    args.workdir.mkdir(parents=True, exist_ok=True)
+    pipeline = Pipeline(read_env(args.env), args.workdir, args.api_port)
+    if not args.skip_setup:
+        pipeline.setup()
+
+    pipeline.start(haadf=args.haadf, scan_files=args.scan_files > 0)
+    try:
+        results = asyncio.run(run_stages(args, pipeline))
+    finally:
+        pipeline.stop()
+
+    (args.workdir / "results.json").write_text(json.dumps(results, indent=2))
+
+    # The highest status update rate that stayed within the SLO
+    keeping_up = [
+        r for r in results
+        if r["status_latency"]["p99"] is not None
+        and r["status_latency"]["p99"] <= args.latency_slo
+        and r["missing"]["status"] == 0
+    ]
+    if keeping_up:
+        best = max(keeping_up, key=lambda r: r["status_writes_per_second"] or 0)
+        print(
+            f"Keeping up to {best['status_writes_per_second']:.1f} status writes/s "
+            f"(update interval {best['update_interval']}s) within a p99 of {args.latency_slo}s"
+        )
+    else:
+        print(f"No stage kept within a p99 of {args.latency_slo}s")
+
+
+if __name__ == "__main__":
+    main()
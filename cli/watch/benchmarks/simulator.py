@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+#
+# Synthetic acquisition, writes what the microscope PCs write:
+#
+# - 4dstem_rec_status_{0..3}_scan_N.json status files for the four receivers,
+#   updated at a configurable interval until the scan is complete, optionally
+#   with data files of a given size.
+# - A scanN.dm4 HAADF file at the end of each 4D scan.
+# - EMD ( or DM, copied from a template ) scan files.
+#
+# Each write is recorded as a line of JSON in the event log, so the latency
+# of the pipeline can be measured against it, see pipeline.py.
+#
+# Usage:
+#
+# python benchmarks/simulator.py --status-dir /tmp/sim/status --scans 10 \
+#     --scan-duration 30 --update-interval 0.5 --haadf-dir /tmp/sim/haadf
+#
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Optional
+
+STATUS_FILE_NAME = "4dstem_rec_status_{receiver}_scan_{scan_id}.json"
+DATA_FILE_NAME = "data_scan{scan_id:010}_module{module}_dst{dst}_file{file}.data"
+HAADF_FILE_NAME = "scan{scan_id}.dm4"
+RECEIVERS = 4
+
+
+@dataclass
+class SimulatorConfig:
+    status_dir: Path
+    # Number of 4D scans to acquire, 0 for no 4D scans
+    scans: int = 10
+    # First scan number
+    first_scan_id: int = 1
+    # Time (seconds) each scan takes to acquire
+    scan_duration: float = 30
+    # Interval (seconds) between status file updates
+    update_interval: float = 0.5
+    # Time (seconds) between scans
+    scan_gap: float = 2
+    # Bytes of data written by each receiver per scan, in files of data_file_size
+    data_bytes: int = 0
+    data_file_size: int = 64 * 1024 * 1024
+    # Drop a HAADF file at the end of each scan
+    haadf_dir: Optional[Path] = None
+    # DM4 to copy for the HAADF files, otherwise random bytes
+    dm4_template: Optional[Path] = None
+    # Write a scan file every scan_file_interval seconds
+    scan_file_dir: Optional[Path] = None
+    scan_file_interval: float = 10
+    scan_files: int = 0
+    # Shape of the EMD scan files
+    emd_shape: tuple = (1024, 1024)
+    # DM file to copy for the scan files, otherwise EMDs are generated
+    dm_template: Optional[Path] = None
+
+
+class Simulator(object):
+    def __init__(self, config: SimulatorConfig, log: IO[str]):
+        self.config = config
+        self._log = log
+
+    def _record(self, kind: str, **fields) -> None:
+        self._log.write(json.dumps({"kind": kind, "time": time.time(), **fields}) + "\n")
+        self._log.flush()
+
+    def _write_status(self, receiver: int, scan_id: int, scan_uuid: str, progress: float) -> None:
+        path = self.config.status_dir / STATUS_FILE_NAME.format(
+            receiver=receiver, scan_id=scan_id
+        )
+        status = {
+            "time": datetime.now().astimezone().isoformat(),
+            "last_scan_number": scan_id,
+            "progress": progress,
+            "UUID": scan_uuid,
+        }
+        # The receivers write in place, so do we
+        with open(path, "w") as fp:
+            json.dump(status, fp)
+
+    def _write_data(self, receiver: int, scan_id: int, index: int, size: int) -> None:
+        path = self.config.status_dir / DATA_FILE_NAME.format(
+            scan_id=scan_id, module=receiver, dst=index % 2, file=index
+        )
+        with open(path, "wb") as fp:
+            fp.truncate(size)
+
+    async def _acquire(self, scan_id: int) -> None:
+        config = self.config
+        loop = asyncio.get_running_loop()
+        scan_uuid = str(uuid.uuid4())
+        updates = max(1, round(config.scan_duration / config.update_interval))
+        data_files = -(-config.data_bytes // config.data_file_size) if config.data_bytes else 0
+
+        for update in range(updates + 1):
+            progress = round(100 * update / updates)
+            for receiver in range(RECEIVERS):
+                await loop.run_in_executor(
+                    None, self._write_status, receiver, scan_id, scan_uuid, progress
+                )
+                # Spread the data files over the scan
+                for index in range(data_files * update // updates, data_files * (update + 1) // updates):
+                    size = min(config.data_file_size, config.data_bytes - index * config.data_file_size)
+                    await loop.run_in_executor(None, self._write_data, receiver, scan_id, index, size)
+            # The progress the pipeline reports is the mean over the receivers
+            self._record("status", scan_id=scan_id, uuid=scan_uuid, progress=progress)
+            if update < updates:
+                await asyncio.sleep(config.update_interval)
+
+        if config.haadf_dir is not None:
+            await loop.run_in_executor(None, self._write_haadf, scan_id)
+
+    def _write_haadf(self, scan_id: int) -> None:
+        path = self.config.haadf_dir / HAADF_FILE_NAME.format(scan_id=scan_id)
+        # Write and rename, as the acquisition software does
+        tmp_path = path.with_suffix(".tmp")
+        if self.config.dm4_template is not None:
+            shutil.copyfile(self.config.dm4_template, tmp_path)
+        else:
+            tmp_path.write_bytes(os.urandom(1024 * 1024))
+        os.rename(tmp_path, path)
+        self._record("haadf", scan_id=scan_id, path=str(path))
+
+    def _write_scan_file(self, index: int) -> None:
+        config = self.config
+        if config.dm_template is not None:
+            path = config.scan_file_dir / f"sim_{index:06}{config.dm_template.suffix}"
+            tmp_path = path.with_suffix(".tmp")
+            shutil.copyfile(config.dm_template, tmp_path)
+            os.rename(tmp_path, path)
+        else:
+            import numpy as np
+            from ncempy.io import emd
+
+            path = config.scan_file_dir / f"sim_{index:06}.emd"
+            data = np.random.rand(*config.emd_shape).astype(np.float32)
+            dims = [
+                (np.arange(n) * 0.1, name, "n_m") for (n, name) in zip(config.emd_shape, "yx")
+            ]
+            with emd.fileEMD(str(path), readonly=False) as emd_file:
+                emd_file.put_emdgroup("simulated", data, dims)
+
+        self._record("scan_file", path=str(path))
+
+    async def run_4d_scans(self) -> None:
+        config = self.config
+        for scan_id in range(config.first_scan_id, config.first_scan_id + config.scans):
+            await self._acquire(scan_id)
+            await asyncio.sleep(config.scan_gap)
+
+    async def run_scan_files(self) -> None:
+        loop = asyncio.get_running_loop()
+        for index in range(self.config.scan_files):
+            await loop.run_in_executor(None, self._write_scan_file, index)
+            await asyncio.sleep(self.config.scan_file_interval)
+
+    async def run(self) -> None:
+        tasks = [self.run_4d_scans()]
+        if self.config.scan_file_dir is not None:
+            tasks.append(self.run_scan_files())
+
+        await asyncio.gather(*tasks)
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--scans", type=int, default=10)
+    parser.add_argument("--first-scan-id", type=int, default=1)
+    parser.add_argument("--scan-duration", type=float, default=30)
+    parser.add_argument("--update-interval", type=float, default=0.5)
+    parser.add_argument("--scan-gap", type=float, default=2)
+    parser.add_argument("--data-bytes", type=int, default=0)
+    parser.add_argument("--dm4-template", type=Path)
+    parser.add_argument("--scan-files", type=int, default=0)
+    parser.add_argument("--scan-file-interval", type=float, default=10)
+    parser.add_argument("--emd-shape", type=int, nargs=2, default=[1024, 1024])
+    parser.add_argument("--dm-template", type=Path)
+
+
+def config_from_args(args, status_dir: Path, haadf_dir: Optional[Path],
+                     scan_file_dir: Optional[Path]) -> SimulatorConfig:
+    for d in [status_dir, haadf_dir, scan_file_dir]:
+        if d is not None:
+            d.mkdir(parents=True, exist_ok=True)
+
+    return SimulatorConfig(
+        status_dir=status_dir,
+        scans=args.scans,
+        first_scan_id=args.first_scan_id,
+        scan_duration=args.scan_duration,
+        update_interval=args.update_interval,
+        scan_gap=args.scan_gap,
+        data_bytes=args.data_bytes,
+        haadf_dir=haadf_dir,
+        dm4_template=args.dm4_template,
+        scan_file_dir=scan_file_dir,
+        scan_file_interval=args.scan_file_interval,
+        scan_files=args.scan_files,
+        emd_shape=tuple(args.emd_shape),
+        dm_template=args.dm_template,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--status-dir", type=Path, required=True)
+    parser.add_argument("--haadf-dir", type=Path)
+    parser.add_argument("--scan-file-dir", type=Path)
+    parser.add_argument("--log", type=Path, default=Path("simulator.jsonl"))
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    config = config_from_args(args, args.status_dir, args.haadf_dir, args.scan_file_dir)
+    with open(args.log, "a") as log:
+        asyncio.run(Simulator(config, log).run())
+
+
+if __name__ == "__main__":
+    main()
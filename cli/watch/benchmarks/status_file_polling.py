@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+#
+# Compare the per poll CPU time of watchdog's DirectorySnapshot ( what
+# PollingObserver does each interval ) with the status file only snapshot used
+# by StatusFilePollingObserver, on a directory laid out like a receiver NVMe
+# mount.
+#
+# Usage:
+#
+# python benchmarks/status_file_polling.py --files 100000 --polls 20
+#
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "distiller"))
+
+# The distiller modules load their settings on import
+os.environ.setdefault("API_KEY_NAME", "benchmark")
+os.environ.setdefault("API_KEY", "benchmark")
+os.environ.setdefault("MICROSCOPE", "benchmark")
+os.environ.setdefault("WATCH_DIRECTORIES", "[]")
+
+from watchdog.utils.dirsnapshot import (DirectorySnapshot,  # noqa: E402
+                                        DirectorySnapshotDiff)
+
+from observers import (diff_status_file_snapshots,  # noqa: E402
+                       status_file_snapshot)
+
+DATA_FILE_NAME = "data_scan{scan_id:010}_module{module}_dst{dst}_file{file}.data"
+STATUS_FILE_NAME = "4dstem_rec_status_{receiver}_scan_{scan_id}.json"
+
+
+def populate(path: Path, number_of_files: int) -> None:
+    for i in range(number_of_files):
+        name = DATA_FILE_NAME.format(
+            scan_id=i // 1000, module=i % 4, dst=i % 2, file=i % 1000
+        )
+        (path / name).touch()
+
+    for receiver in range(4):
+        (path / STATUS_FILE_NAME.format(receiver=receiver, scan_id=1)).write_text(
+            '{"progress": 0}'
+        )
+
+
+def cpu_time_per_poll(poll, polls: int):
+    samples = []
+    for _ in range(polls):
+        start = time.process_time()
+        poll()
+        samples.append(time.process_time() - start)
+
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--polls", type=int, default=20)
+    parser.add_argument("--dir", help="Existing directory to poll instead.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.dir
+        if path is None:
+            path = tmp
+            print(f"Creating {args.files} files in {path}...")
+            populate(Path(path), args.files)
+
+        watchdog_snapshot = DirectorySnapshot(path, recursive=False)
+
+        def watchdog_poll():
+            nonlocal watchdog_snapshot
+            snapshot = DirectorySnapshot(path, recursive=False)
+            DirectorySnapshotDiff(watchdog_snapshot, snapshot)
+            watchdog_snapshot = snapshot
+
+        status_snapshot = status_file_snapshot(path)
+
+        def status_file_poll():
+            nonlocal status_snapshot
+            snapshot = status_file_snapshot(path)
+            diff_status_file_snapshots(status_snapshot, snapshot)
+            status_snapshot = snapshot
+
+        results = {
+            "PollingObserver (DirectorySnapshot)": cpu_time_per_poll(
+                watchdog_poll, args.polls
+            ),
+            "StatusFilePollingObserver": cpu_time_per_poll(
+                status_file_poll, args.polls
+            ),
+        }
+
+    for name, samples in results.items():
+        print(
+            f"{name}: median {statistics.median(samples) * 1000:.2f} ms, "
+            f"max {max(samples) * 1000:.2f} ms CPU per poll"
+        )
+
+
+if __name__ == "__main__":
+    main()
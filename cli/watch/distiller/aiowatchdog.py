@@ -1,40 +1,155 @@
 import asyncio
-from typing import Optional, Union
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional, Union
 
-from watchdog.events import (DirCreatedEvent, DirDeletedEvent,
+from schemas import OverflowPolicy
+from watchdog.events import (EVENT_TYPE_CLOSED, EVENT_TYPE_CREATED,
+                             EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED,
+                             DirCreatedEvent, DirDeletedEvent,
                              DirModifiedEvent, DirMovedEvent, FileClosedEvent,
                              FileCreatedEvent, FileDeletedEvent,
                              FileModifiedEvent, FileMovedEvent,
-                             FileSystemEventHandler)
+                             FileSystemEvent, FileSystemEventHandler)
 
+# Event types that will pick up the latest state of the file when processed
+CONTENT_EVENT_TYPES = [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED]
+
+
+class BoundedEventQueue(object):
+    """
+    Bounded queue handing events from the watchdog observer threads to the
+    asyncio loop. When the queue is full the overflow policy is applied:
+
+    - block: the observer thread waits for space.
+    - drop: a modified/closed event for a path that already has a
+      created/modified/closed event queued is dropped, the queued event will
+      read the latest content when it is processed.
+    - merge: as drop, in addition a delete replaces a queued
+      created/modified/closed event for the same path.
+
+    Events that can't be dropped or merged block the observer thread.
+    """
 
-class AIOEventHandler(FileSystemEventHandler):
     def __init__(
-        self, queue: asyncio.Queue, loop: asyncio.BaseEventLoop, *args, **kwargs
+        self,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int = 10000,
+        policy: OverflowPolicy = OverflowPolicy.MERGE,
     ):
         self._loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._not_empty = asyncio.Event()
+        self._getter_waiting = False
+        # Each entry is a single element list, so a queued event can be
+        # replaced in place.
+        self._entries: Deque[List[FileSystemEvent]] = deque()
+        # path => latest queued entry for that path
+        self._latest: Dict[str, List[FileSystemEvent]] = {}
+
+        self.merged = 0
+        self.dropped = 0
+        self.blocked = 0
+
+    def qsize(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self.qsize(),
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "blocked": self.blocked,
+        }
+
+    def _apply_overflow_policy(self, event: FileSystemEvent) -> bool:
+        if self.policy == OverflowPolicy.BLOCK or event.is_directory:
+            return False
+
+        entry = self._latest.get(event.src_path)
+        if entry is None or entry[0].event_type not in CONTENT_EVENT_TYPES:
+            return False
+
+        if event.event_type in [EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED]:
+            self.dropped += 1
+            return True
+
+        if (
+            self.policy == OverflowPolicy.MERGE
+            and event.event_type == EVENT_TYPE_DELETED
+        ):
+            entry[0] = event
+            self.merged += 1
+            return True
+
+        return False
+
+    def put_threadsafe(self, event: FileSystemEvent) -> None:
+        """
+        Called from the observer threads, may block if the queue is full.
+        """
+        with self._lock:
+            if len(self._entries) >= self.maxsize:
+                if self._apply_overflow_policy(event):
+                    return
+
+                self.blocked += 1
+                while len(self._entries) >= self.maxsize:
+                    self._not_full.wait()
+
+            entry = [event]
+            self._entries.append(entry)
+            self._latest[event.src_path] = entry
+
+            if self._getter_waiting:
+                self._getter_waiting = False
+                self._loop.call_soon_threadsafe(self._not_empty.set)
+
+    async def get(self) -> FileSystemEvent:
+        while True:
+            with self._lock:
+                if self._entries:
+                    entry = self._entries.popleft()
+                    event = entry[0]
+                    if self._latest.get(event.src_path) is entry:
+                        del self._latest[event.src_path]
+                    self._not_full.notify()
+
+                    return event
+
+                self._not_empty.clear()
+                self._getter_waiting = True
+
+            await self._not_empty.wait()
+
+
+class AIOEventHandler(FileSystemEventHandler):
+    def __init__(self, queue: BoundedEventQueue, *args, **kwargs):
         self._queue = queue
         super(*args, **kwargs)
 
     def on_created(self, event: Union[DirCreatedEvent, FileCreatedEvent]) -> None:
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        self._queue.put_threadsafe(event)
 
     def on_deleted(self, event: Union[DirDeletedEvent, FileDeletedEvent]) -> None:
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        self._queue.put_threadsafe(event)
 
     def on_modified(self, event: Union[DirModifiedEvent, FileModifiedEvent]) -> None:
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        self._queue.put_threadsafe(event)
 
     def on_moved(self, event: Union[DirMovedEvent, FileMovedEvent]) -> None:
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        self._queue.put_threadsafe(event)
 
     def on_closed(self, event: FileClosedEvent) -> None:
-        self._loop.call_soon_threadsafe(self._queue.put_nowait, event)
+        self._queue.put_threadsafe(event)
 
 
 class AIOEventIterator(object):
     def __init__(
-        self, queue: asyncio.Queue, loop: Optional[asyncio.BaseEventLoop] = None
+        self, queue: BoundedEventQueue, loop: Optional[asyncio.BaseEventLoop] = None
     ):
         self.queue = queue
 
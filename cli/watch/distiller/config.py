@@ -1,7 +1,8 @@
 from typing import List, Optional
 
 from pydantic import AnyHttpUrl, BaseSettings
-from schemas import WatchMode
+from schemas import (ContentEncoding, ObserverMode, OverflowPolicy, ShardMode,
+                     WatchMode)
 
 
 class Settings(BaseSettings):
@@ -12,10 +13,64 @@ class Settings(BaseSettings):
     HOST: Optional[str] = None
     LOG_FILE_PATH: Optional[str] = None
     SYNC: bool = True
+    # Local manifest of acknowledged files, when set sync only sends what has
+    # changed since the last run
+    MANIFEST_PATH: Optional[str] = None
     MODE: WatchMode = WatchMode.SCAN_4D_FILES
     MICROSCOPE: str
     POLL: bool = False
+    # Observer used for the 4D modes, POLL=True forces polling
+    OBSERVER: ObserverMode = ObserverMode.AUTO
     RECURSIVE: bool = False
+    # Watch directories are split into shards, each with its own observers,
+    # event queue and task handling the events
+    SHARD_BY: ShardMode = ShardMode.MOUNT
+    # Max number of events queued between the observers and the handler, per shard
+    EVENT_QUEUE_SIZE: int = 10000
+    # What to do when the event queue is full
+    EVENT_QUEUE_POLICY: OverflowPolicy = OverflowPolicy.MERGE
+    # Interval (seconds) between logging event queue stats
+    EVENT_QUEUE_STATS_INTERVAL: float = 60
+    # Outbox of messages waiting to be sent to the API, defaults to next to
+    # the manifest, or watch_outbox.db in the working directory if there isn't one
+    OUTBOX_PATH: Optional[str] = None
+    # Outbox messages are posted in batches of up to this many ...
+    FILE_EVENT_BATCH_SIZE: int = 50
+    # ... waiting this many seconds for a batch to build up
+    FILE_EVENT_BATCH_LATENCY: float = 0.1
+    # Window (seconds) over which updates to the same status file are coalesced
+    STATUS_FILE_COALESCE_WINDOW: float = 0.5
+    # Interval (seconds) between disk usage samples of the receiver mounts
+    DISK_USAGE_INTERVAL: float = 30
+    # Change in used space, as a percentage of the total, before we publish
+    DISK_USAGE_THRESHOLD: float = 0.1
+    # Time (seconds) after a status file is removed before we resample the disk
+    # usage, giving custodian time to remove the rest of the scan's files
+    DISK_USAGE_RESAMPLE_DELAY: float = 5
+
+    # Max number of scan files uploaded concurrently
+    UPLOAD_CONCURRENCY: int = 4
+    # Size (bytes) of each chunk of a resumable upload
+    UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024
+    # Time (seconds) an EMD file's size and mtime must be unchanged before we check it
+    EMD_QUIET_PERIOD: float = 5
+    # Time (seconds) after the last of a burst of close writes before we check an EMD file
+    EMD_CLOSE_DELAY: float = 1
+    # Time (seconds) without events before we stop checking an incomplete EMD file
+    EMD_MAX_AGE: float = 10 * 60
+    # Compress the chunks of uploads using this content encoding
+    UPLOAD_CONTENT_ENCODING: Optional[ContentEncoding] = None
+    # Extract the metadata and image of scan files on this host, so scans are
+    # created without waiting for the file to be uploaded
+    EDGE_EXTRACTION: bool = False
+    # Max size (pixels) of the images generated by edge extraction
+    THUMBNAIL_SIZE: int = 512
+    # Should match the API's image format
+    IMAGE_FORMAT: str = "jpeg"
+    IMAGE_QUALITY: Optional[int] = 90
+    # Serve Prometheus metrics on this port, at /metrics
+    METRICS_PORT: Optional[int] = None
+    METRICS_HOST: str = "0.0.0.0"
 
     class Config:
         case_sensitive = True
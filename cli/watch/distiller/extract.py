@@ -0,0 +1,299 @@
+import io
+import math
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+import ncempy.io as nio
+from ncempy.io import dm, emd, ser
+from numpy import ndarray
+from utils import logger
+
+# The metadata extraction and image generation done by the scan file worker,
+# so it can be done on the acquisition host.
+
+DATA_FILE_FORMATS = [".dm3", ".dm4", ".ser", ".emd"]
+
+
+def clean_metadata(md):
+    for k, v in md.items():
+        if isinstance(v, dict):
+            clean_metadata(v)
+        elif isinstance(v, bytes):
+            md[k] = v.decode("utf8")
+        elif isinstance(v, ndarray):
+            md[k] = tuple(v)
+
+    return md
+
+
+def extract_dm_metadata(dm_path: str):
+    metadata = {}
+
+    GOOD_KEYS = [
+        "Calibrations",
+        "Acquisition",
+        "DataBar",
+        "EELS",
+        "Meta Data",
+        "Microscope Info",
+        "Session Info",
+        "4Dcamera",
+        "DigiScan",
+        "Dimensions",
+    ]
+
+    # Use on_memory=False for now as it doesn't seem to work on spin
+    with dm.fileDM(dm_path, on_memory=False) as dm_file:
+        # Save most useful metadata
+        for tag_key, tag_value in dm_file.allTags.items():
+            if any(x in tag_key for x in GOOD_KEYS):
+                tag_key_split = tag_key.split(".")
+                if "DigiScan" in tag_key:
+                    if "Rotation" in tag_key:
+                        new_key = " ".join(tag_key_split[4:])
+                        metadata[new_key] = tag_value
+                elif "Session Info" in tag_key:
+                    if "Label" in tag_key_split[-1]:
+                        label = tag_value
+                        value_key_split = tag_key_split.copy()
+                        value_key_split[-1] = "Value"
+                        value_key = ".".join(value_key_split)
+                        if value_key in dm_file.allTags:
+                            metadata[label] = dm_file.allTags[value_key]
+                else:
+                    new_key = " ".join(tag_key_split[4:])
+                    metadata[new_key] = tag_value
+
+        # Store the X and Y pixel size, offset and unit
+        try:
+            metadata["PhysicalSizeX"] = metadata["Calibrations.Dimension.1.Scale"]
+            metadata["PhysicalSizeXOrigin"] = metadata[
+                "Calibrations.Dimension.1.Origin"
+            ]
+            metadata["PhysicalSizeXUnit"] = metadata["Calibrations.Dimension.1.Units"]
+            metadata["PhysicalSizeY"] = metadata["Calibrations.Dimension.2.Scale"]
+            metadata["PhysicalSizeYOrigin"] = metadata[
+                "Calibrations.Dimension.2.Origin"
+            ]
+            metadata["PhysicalSizeYUnit"] = metadata["Calibrations.Dimension.2.Units"]
+        except:
+            metadata["PhysicalSizeX"] = 1
+            metadata["PhysicalSizeXOrigin"] = 0
+            metadata["PhysicalSizeXUnit"] = ""
+            metadata["PhysicalSizeY"] = 1
+            metadata["PhysicalSizeYOrigin"] = 0
+            metadata["PhysicalSizeYUnit"] = ""
+
+    return metadata
+
+
+def extract_ser_metadata(ser_path: str):
+    with ser.fileSER(ser_path) as ser_file:
+        # We just pull out the first image
+        _, metadata = ser_file.getDataset(0)
+
+        # Add header data for the ser file
+        metadata.update(ser_file.head)
+
+    # Clean up the data
+    metadata = clean_metadata(metadata)
+
+    # Store the X and Y pixel size, offset and unit
+    try:
+        metadata["Dimensions.1"] = metadata["ArrayShape"][0]
+        metadata["Dimensions.2"] = metadata["ArrayShape"][1]
+        metadata["PhysicalSizeX"] = metadata["Calibration"][0]["CalibrationDelta"]
+        metadata["PhysicalSizeXOrigin"] = metadata["Calibration"][0][
+            "CalibrationOffset"
+        ]
+        metadata["PhysicalSizeXUnit"] = "m"  # always meters
+        metadata["PhysicalSizeY"] = metadata["Calibration"][1]["CalibrationDelta"]
+        metadata["PhysicalSizeYOrigin"] = metadata["Calibration"][1][
+            "CalibrationOffset"
+        ]
+        metadata["PhysicalSizeYUnit"] = "m"  # always meters
+    except:
+        logger.warning(f"Unable to extract PhysicalSize from: {ser_path}")
+
+    return metadata
+
+
+def extract_emi_metadata(emi_path: str):
+    metadata = ser.read_emi(emi_path)
+    metadata = clean_metadata(metadata)
+
+    return metadata
+
+
+def extract_ncem_emd_metadata(emd_file):
+    metadata = {}
+
+    try:
+        metadata["user"] = {}
+        metadata["user"].update(emd_file.file_hdl["/user"].attrs)
+    except:
+        pass
+    try:
+        metadata["microscope"] = {}
+        metadata["microscope"].update(emd_file.file_hdl["/microscope"].attrs)
+    except:
+        pass
+    try:
+        metadata["sample"] = {}
+        metadata["sample"].update(emd_file.file_hdl["/sample"].attrs)
+    except:
+        pass
+    try:
+        metadata["comments"] = {}
+        metadata["comments"].update(emd_file.file_hdl["/comments"].attrs)
+    except:
+        pass
+    try:
+        metadata["stage"] = {}
+        # Check for legacy keys in stage group. Skip the rest
+        good_keys = ("position", "type", "Type")
+        for k in good_keys:
+            if k in emd_file.file_hdl["/stage"].attrs:
+                metadata["stage"][k] = emd_file.file_hdl["/stage"].attrs[k]
+    except:
+        pass
+
+    return metadata
+
+
+def extract_emd_metadata(emd_path: str):
+    metadata = {}
+
+    # EMD Berkeley
+    with emd.fileEMD(emd_path, readonly=True) as emd_file:
+        # For now just grab the first dataset
+        data_group = emd_file.list_emds[0]
+        dataset = data_group["data"]
+
+        try:
+            name = data_group.name.split("/")[-1]
+            metadata[name] = {}
+            metadata[name].update(data_group.attrs)
+        except:
+            pass
+
+        # Get the dim vectors
+        dims = emd_file.get_emddims(data_group)
+        if dataset.ndim == 2:
+            dimZ = None
+            dimY = dims[0]
+            dimX = dims[1]
+        elif dataset.ndim == 3:
+            dimZ = dims[0]
+            dimY = dims[1]
+            dimX = dims[2]
+        elif dataset.ndim == 4:
+            dimZ = dims[1]
+            dimY = dims[2]
+            dimX = dims[3]
+        else:
+            dimZ = None
+            dimY = None
+            dimX = None
+
+        if dimX is None or dimY is None:
+            logger.warning("Unable to extract PhysicalSize, dims are not available")
+        else:
+            # Store the X and Y pixel size, offset and unit
+            try:
+                metadata["PhysicalSizeX"] = dimX[0][1] - dimX[0][0]
+                metadata["PhysicalSizeXOrigin"] = dimX[0][0]
+                metadata["PhysicalSizeXUnit"] = dimX[2].replace("_", "")
+                metadata["PhysicalSizeY"] = dimY[0][1] - dimY[0][0]
+                metadata["PhysicalSizeYOrigin"] = dimY[0][0]
+                metadata["PhysicalSizeYUnit"] = dimY[2].replace("_", "")
+                metadata["Dimensions.1"] = dimX[0].shape[0]
+                metadata["Dimensions.2"] = dimY[0].shape[0]
+                if dimZ is not None:
+                    metadata["PhysicalSizeZ"] = dimZ[0][1] - dimZ[0][0]
+                    metadata["PhysicalSizeZOrigin"] = dimZ[0][0]
+                    metadata["PhysicalSizeZUnit"] = dimZ[2]
+
+            except:
+                logger.warning(f"Unable to extract PhysicalSize from: {emd_path}")
+
+        metadata["shape"] = dataset.shape
+        metadata.update(extract_ncem_emd_metadata(emd_file))
+        metadata = clean_metadata(metadata)
+
+    return metadata
+
+
+def extract_metadata(path: str):
+    ext = Path(path).suffix
+
+    if ext in [".dm4", ".dm3"]:
+        return extract_dm_metadata(path)
+    elif ext in [".ser"]:
+        return extract_ser_metadata(path)
+    elif ext in [".emi"]:
+        return extract_emi_metadata(path)
+    elif ext == ".emd":
+        return extract_emd_metadata(path)
+
+    else:
+        raise Exception(f"Unsupported file format: {ext}")
+
+
+def generate_image_from_data(
+    data_path: str, format: str, quality: Optional[int], max_size: int
+) -> bytes:
+    """
+    Render the data as an image no larger than max_size in either dimension,
+    the worker renders the full size image if the file is processed centrally.
+    """
+    from matplotlib import image
+
+    # Hack to get around problem with memory mapping in spin!
+    if Path(data_path).suffix in [".dm3", ".dm4"]:
+        file = dm.dmReader(data_path, on_memory=False)
+    else:
+        file = nio.read(data_path)
+
+    img = file["data"]
+
+    # If we have more than 2 dimensions just pick the first image
+    if img.ndim > 2:
+        slc = [0] * (img.ndim - 2)
+        img = img[tuple(slc)]
+
+    # Only a thumbnail, so just take every nth pixel
+    step = max(1, math.ceil(max(img.shape) / max_size))
+    img = img[::step, ::step]
+
+    pil_kwargs = {}
+    if quality is not None:
+        pil_kwargs["quality"] = quality
+
+    fp = io.BytesIO()
+    image.imsave(fp, img, format=format, pil_kwargs=pil_kwargs)
+
+    return fp.getvalue()
+
+
+def extract_scan_file(
+    path: str,
+    ser_path: Optional[str],
+    format: str,
+    quality: Optional[int],
+    max_size: int,
+) -> Tuple[Dict[str, Any], Optional[bytes]]:
+    """
+    Returns the metadata for a scan file, and its image if it has image data.
+    The data and metadata of an emi file are in its associated ser file.
+    """
+    metadata = extract_metadata(path)
+    if ser_path is not None:
+        metadata.update(extract_metadata(ser_path))
+        path = ser_path
+
+    image = None
+    if Path(path).suffix in DATA_FILE_FORMATS:
+        image = generate_image_from_data(path, format, quality, max_size)
+
+    return (metadata, image)
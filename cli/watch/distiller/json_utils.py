@@ -0,0 +1,25 @@
+import json
+
+import numpy as np
+
+
+def numpy_default(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def numpy_dumps(v, *, default):
+    # Fall back to pydantic's encoder for everything else ( datetimes etc. )
+    def _default(obj):
+        try:
+            return numpy_default(obj)
+        except TypeError:
+            return default(obj)
+
+    return json.dumps(v, default=_default)
@@ -0,0 +1,83 @@
+import sqlite3
+import time
+from typing import Dict, Iterable, NamedTuple, Optional
+
+
+class ManifestEntry(NamedTuple):
+    path: str
+    inode: int
+    mtime_ns: int
+    size: int
+    # Hash identifying the content we last had acknowledged by the API
+    hash: Optional[str]
+    # When the API acknowledged it (epoch seconds)
+    acknowledged: Optional[float] = None
+    # The scan has been created but its file has still to be uploaded to it
+    pending_scan_id: Optional[int] = None
+
+    def matches(self, inode: int, mtime_ns: int, size: int) -> bool:
+        return (self.inode, self.mtime_ns, self.size) == (inode, mtime_ns, size)
+
+
+class Manifest(object):
+    """
+    Local record of the files, and the state of them, that the API has
+    acknowledged. Used to only sync what has changed since the last run.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS manifest (
+                path TEXT PRIMARY KEY,
+                inode INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                hash TEXT,
+                acknowledged REAL,
+                pending_scan_id INTEGER
+            )
+            """
+        )
+        # Manifests written before files could be pending
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(manifest)")]
+        if "pending_scan_id" not in columns:
+            self._db.execute("ALTER TABLE manifest ADD COLUMN pending_scan_id INTEGER")
+        self._db.commit()
+
+    def entries(self) -> Dict[str, ManifestEntry]:
+        rows = self._db.execute(
+            "SELECT path, inode, mtime_ns, size, hash, acknowledged, pending_scan_id "
+            "FROM manifest"
+        )
+
+        return {row[0]: ManifestEntry(*row) for row in rows}
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        row = self._db.execute(
+            "SELECT path, inode, mtime_ns, size, hash, acknowledged, pending_scan_id "
+            "FROM manifest WHERE path = ?",
+            (path,),
+        ).fetchone()
+
+        return ManifestEntry(*row) if row is not None else None
+
+    def acknowledge(self, entries: Iterable[ManifestEntry]) -> None:
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO manifest "
+                "(path, inode, mtime_ns, size, hash, acknowledged, pending_scan_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(*e[:5], now, e.pending_scan_id) for e in entries],
+            )
+
+    def remove(self, paths: Iterable[str]) -> None:
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM manifest WHERE path = ?", [(p,) for p in paths]
+            )
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,269 @@
+import bisect
+import re
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import aiohttp
+import tenacity
+from aiohttp import web
+from config import settings
+from yarl import URL
+
+# Latency buckets (seconds) for the API request histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Path segments that are ids, so the endpoint label stays bounded
+ID_SEGMENT = re.compile(r"^([0-9]+|[0-9a-f]{32})$")
+
+# (name suffix, label values, value)
+Sample = Tuple[str, Tuple[str, ...], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    # Counts ( of bytes etc. ) must not lose precision
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric(object):
+    """
+    A metric in the Prometheus text format. Instead of being updated, the
+    value can be read from a function when the metrics are scraped, for
+    values we already keep track of elsewhere.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # labels => function returning the value
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+        registry.append(self)
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self._functions[self._key(labels)] = function
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self._functions:
+            samples = [("", key, float(f())) for (key, f) in self._functions.items()]
+        else:
+            samples = self.samples()
+
+        for (suffix, values, value) in samples:
+            names = self.labels if len(values) == len(self.labels) else self.labels + ("le",)
+            labels = ",".join(
+                f'{name}="{_escape(value)}"' for (name, value) in zip(names, values)
+            )
+            if labels:
+                labels = f"{{{labels}}}"
+            lines.append(f"{self.name}{suffix}{labels} {_format(value)}")
+
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        if not self.labels and not self._values:
+            return [("", (), 0)]
+
+        return [("", key, value) for (key, value) in self._values.items()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self._buckets = tuple(buckets)
+        # labels => (count per bucket, sum, count)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        (counts, total, count) = self._values.get(
+            key, ([0] * len(self._buckets), 0.0, 0)
+        )
+        index = bisect.bisect_left(self._buckets, value)
+        if index < len(self._buckets):
+            counts[index] += 1
+        self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> Iterable[Sample]:
+        for (key, (counts, total, count)) in self._values.items():
+            cumulative = 0
+            for (bound, bucket_count) in zip(self._buckets, counts):
+                cumulative += bucket_count
+                yield ("_bucket", key + (f"{bound:g}",), cumulative)
+            yield ("_bucket", key + ("+Inf",), count)
+            yield ("_sum", key, total)
+            yield ("_count", key, count)
+
+
+registry: List[Metric] = []
+
+events = Counter(
+    "watch_events_total", "Filesystem events handled, by shard and type.", ["shard", "type"]
+)
+event_duration = Histogram(
+    "watch_event_duration_seconds", "Time taken to handle an event, by shard.", ["shard"]
+)
+event_queue_depth = Gauge(
+    "watch_event_queue_depth", "Events waiting to be handled, by shard.", ["shard"]
+)
+event_queue_merged = Counter(
+    "watch_event_queue_merged_total",
+    "Events merged with a queued event for the same path, by shard.",
+    ["shard"],
+)
+event_queue_dropped = Counter(
+    "watch_event_queue_dropped_total",
+    "Events dropped because an event for the path was already queued, by shard.",
+    ["shard"],
+)
+event_queue_blocked = Counter(
+    "watch_event_queue_blocked_total",
+    "Times an observer blocked on a full event queue, by shard.",
+    ["shard"],
+)
+status_file_events_coalesced = Counter(
+    "watch_status_file_events_coalesced_total",
+    "Status file updates replaced by a later update within the coalescing window.",
+)
+outbox_depth = Gauge(
+    "watch_outbox_depth", "Messages in the outbox waiting to be sent to the API."
+)
+outbox_dropped = Counter(
+    "watch_outbox_dropped_total", "Outbox messages dropped because the API rejected them."
+)
+api_requests = Counter(
+    "watch_api_requests_total",
+    "Requests made to the API, by endpoint and response status.",
+    ["method", "endpoint", "status"],
+)
+api_request_duration = Histogram(
+    "watch_api_request_duration_seconds",
+    "Time until the API responded, by endpoint.",
+    ["method", "endpoint"],
+)
+api_retries = Counter(
+    "watch_api_retries_total", "API calls retried, by the function making the call.", ["call"]
+)
+upload_bytes = Counter(
+    "watch_upload_bytes_total", "Bytes of file content uploaded."
+)
+upload_sent_bytes = Counter(
+    "watch_upload_sent_bytes_total", "Bytes sent uploading files, after compression."
+)
+emd_open_attempts = Counter(
+    "watch_emd_open_attempts_total", "Times an EMD file was opened to check it was complete."
+)
+
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+def endpoint(url: URL) -> str:
+    """
+    The API endpoint for a request, relative to the API_URL and with any ids
+    replaced, /scans/12 => /scans/{id}
+    """
+    path = url.path
+    prefix = URL(settings.API_URL).path.rstrip("/")
+    if prefix and path.startswith(prefix):
+        path = path[len(prefix):]
+
+    return "/".join("{id}" if ID_SEGMENT.match(s) else s for s in path.split("/"))
+
+
+def _observe_request(context, method: str, url: URL, status: str) -> None:
+    labels = {"method": method, "endpoint": endpoint(url)}
+    api_request_duration.observe(time.monotonic() - context.start, **labels)
+    api_requests.inc(status=status, **labels)
+
+
+async def _on_request_start(session, context, params) -> None:
+    context.start = time.monotonic()
+
+
+async def _on_request_end(session, context, params) -> None:
+    _observe_request(context, params.method, params.url, str(params.response.status))
+
+
+async def _on_request_exception(session, context, params) -> None:
+    _observe_request(context, params.method, params.url, "error")
+
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    Trace config recording the latency of the requests made with a session.
+    """
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(_on_request_start)
+    config.on_request_end.append(_on_request_end)
+    config.on_request_exception.append(_on_request_exception)
+
+    return config
+
+
+def count_retry(retry_state: tenacity.RetryCallState) -> None:
+    api_retries.inc(call=retry_state.fn.__name__)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def serve(host: str, port: int) -> web.AppRunner:
+    """
+    Serve the metrics on the running loop, call cleanup() on the runner
+    returned to stop.
+    """
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
+from typing import Optional
 
 import aiohttp
+from config import settings
+from manifest import Manifest
 from watchdog.events import FileSystemEvent
 
 class ModeHandler(ABC):
@@ -8,10 +11,20 @@ class ModeHandler(ABC):
         self.microscope_id = microscope_id
         self.host = host
         self.session = session
+        self.manifest: Optional[Manifest] = None
+        if settings.MANIFEST_PATH is not None:
+            self.manifest = Manifest(settings.MANIFEST_PATH)
 
     @abstractmethod
     async def on_event(self, event: FileSystemEvent):
         pass
 
+    async def start(self):
+        pass
+
     async def sync(self):
-        pass
\ No newline at end of file
+        pass
+
+    async def close(self):
+        if self.manifest is not None:
+            self.manifest.close()
@@ -1,27 +1,61 @@
 import asyncio
+import hashlib
+import json
 import re
 from datetime import datetime, timedelta
-from typing import List, cast
-import os
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Set, Tuple, cast
 import shutil
 
 import aiohttp
+import metrics
 import tenacity
 from aiopath import AsyncPath
+from cachetools import TTLCache
 from config import settings
 from constants import STATUS_FILE_GLOB
+from pydantic import ValidationError
 from schemas import (File, FileSystemEvent as FileSystemEventModel, SyncEvent,
     ScanStatusFile, MicroscopeUpdate )
 
-from watchdog.events import (EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED, EVENT_TYPE_CREATED,
-                             EVENT_TYPE_MOVED, FileSystemEvent, FileCreatedEvent)
-from utils import logger, get_microscope_by_id
+from watchdog.events import (EVENT_TYPE_CLOSED, EVENT_TYPE_DELETED, EVENT_TYPE_MODIFIED,
+                             EVENT_TYPE_CREATED, EVENT_TYPE_MOVED, FileSystemEvent,
+                             FileCreatedEvent, FileModifiedEvent)
+from utils import logger, get_microscope_by_id, find_mount_point
+from manifest import Manifest, ManifestEntry
+from observers import status_file_snapshot
+from outbox import outbox
 from . import ModeHandler
 
 STATUS_PATTERN = re.compile(r"^4dstem_rec_status_([0-3]{1}).*\.json")
 
 STATUS_FILE_EVENTS = [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED]
 
+def outbox_message(payload: str, entries: Iterable[ManifestEntry] = ()) -> str:
+    """
+    An outbox message, with the manifest entries for the state of the status
+    files sent.
+    """
+    return json.dumps({"payload": payload, "entries": list(entries)})
+
+
+def parse_outbox_message(message: str) -> Tuple[str, List[ManifestEntry]]:
+    data = json.loads(message)
+    # Queued before the entries were recorded
+    if "payload" not in data:
+        return (message, [])
+
+    return (data["payload"], [ManifestEntry(*e) for e in data["entries"]])
+
+
+def status_file_entry(stat_info, content: str) -> Tuple[int, int, int, str]:
+    return (
+        stat_info.st_ino,
+        stat_info.st_mtime_ns,
+        stat_info.st_size,
+        hashlib.sha256(content.encode()).hexdigest(),
+    )
+
 async def create_sync_snapshot(host, watch_dirs: List[str]) -> List[File]:
     files = []
     for watch_dir in watch_dirs:
@@ -44,6 +78,7 @@ async def create_sync_snapshot(host, watch_dirs: List[str]) -> List[File]:
     ),
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def post_sync_event(session: aiohttp.ClientSession, event: SyncEvent) -> None:
     headers = {
@@ -67,6 +102,7 @@ async def post_sync_event(session: aiohttp.ClientSession, event: SyncEvent) -> N
 
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def post_file_event(
     session: aiohttp.ClientSession, event: FileSystemEventModel
@@ -90,6 +126,32 @@ async def post_file_event(
 
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+async def post_file_events(
+    session: aiohttp.ClientSession, events: List[FileSystemEventModel]
+) -> None:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    data = f"[{','.join(e.json() for e in events)}]"
+    async with session.post(
+        f"{settings.API_URL}/files/batch", headers=headers, data=data
+    ) as r:
+        r.raise_for_status()
+
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ) | tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ClientConnectionError
+    ),
+
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def patch_microscope(
     session: aiohttp.ClientSession, id: int, update: MicroscopeUpdate
@@ -104,50 +166,225 @@ async def patch_microscope(
     ) as r:
         r.raise_for_status()
 
-def find_mount_point(path):
-    path = os.path.abspath(path)
-    while not os.path.ismount(path):
-        path = os.path.dirname(path)
-    return path
-
-class Scan4DFilesModeHandler(ModeHandler):
-    def __init__(self, microscope_id: int,  host: str, session: aiohttp.ClientSession):
-        super().__init__(microscope_id, host, session)
-        self._receiver_progress = {}
-
-        # File mounts point to use for calculating disk usage
-        self._mount_points = set()
-        for d in settings.WATCH_DIRECTORIES:
-             self._mount_points.add(find_mount_point(d))
-
-
-    async def _send_disk_usage(self, path: str):
-        # First get the current microscope state
-        microscope = await get_microscope_by_id(self.session, self.microscope_id)
-        state = microscope.state if microscope.state is not None else {}
-        disk_usage = state.setdefault("disk_usage", {})
-        state_total = disk_usage.get("total")
-        state_used = disk_usage.get("used")
-        state_free = disk_usage.get("free")
-
-        # Iterate over mount points and calculate the disk usage
+# The manifest is only updated once the API has accepted the messages, so the
+# senders are given the manifest of the handler that registered them.
+async def send_file_events(manifest: Optional[Manifest], session: aiohttp.ClientSession,
+                           messages: List[str]) -> None:
+    parsed = [parse_outbox_message(m) for m in messages]
+    events = [FileSystemEventModel.parse_raw(payload) for (payload, _) in parsed]
+    await post_file_events(session, events)
+
+    if manifest is None:
+        return
+
+    # The latest state of each path, None once it has been deleted
+    latest: Dict[str, Optional[ManifestEntry]] = {}
+    for (event, (_, entries)) in zip(events, parsed):
+        if event.event_type == EVENT_TYPE_DELETED:
+            latest[event.src_path] = None
+        for entry in entries:
+            latest[entry.path] = entry
+
+    manifest.remove(path for (path, entry) in latest.items() if entry is None)
+    manifest.acknowledge(entry for entry in latest.values() if entry is not None)
+
+
+async def send_sync_events(manifest: Optional[Manifest], session: aiohttp.ClientSession,
+                           messages: List[str]) -> None:
+    for message in messages:
+        (payload, entries) = parse_outbox_message(message)
+        await post_sync_event(session, SyncEvent.parse_raw(payload))
+        if manifest is not None:
+            manifest.acknowledge(entries)
+
+
+async def send_microscope_updates(session: aiohttp.ClientSession, payloads: List[str]) -> None:
+    # Only the latest state matters
+    updates = {}
+    for p in payloads:
+        message = json.loads(p)
+        updates[message["id"]] = MicroscopeUpdate(**message["update"])
+
+    for (id, update) in updates.items():
+        await patch_microscope(session, id, update)
+
+
+class DiskUsageSampler:
+    """
+    Periodically samples the disk usage of the receiver mount points, off the
+    event path. The microscope state is only fetched and patched when the
+    usage has moved by more than DISK_USAGE_THRESHOLD percent of the total
+    since the last value we published. A removal, say by custodian, triggers a
+    sample without waiting for the rest of the interval.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, microscope_id: int, mount_points: Set[str]):
+        self.session = session
+        self.microscope_id = microscope_id
+        self.mount_points = mount_points
+        # The last (total, used, free) we published
+        self._published: Optional[Tuple[int, int, int]] = None
+        self._resample = asyncio.Event()
+
+    def resample(self) -> None:
+        self._resample.set()
+
+    def _disk_usage(self) -> Tuple[int, int, int]:
         total = 0
         used = 0
         free = 0
-        for p in self._mount_points:
+        for p in self.mount_points:
             (total_, used_, free_) = shutil.disk_usage(p)
             total += total_
             used += used_
             free += free_
 
-        # Only patch if its changed
-        if state_total != total or state_used != used or state_free != free:
+        return (total, used, free)
+
+    def _changed(self, usage: Tuple[int, int, int]) -> bool:
+        if self._published is None:
+            return True
+
+        (total, used, _) = usage
+        (published_total, published_used, _) = self._published
+        if total != published_total:
+            return True
+
+        threshold = total * settings.DISK_USAGE_THRESHOLD / 100
+
+        return abs(used - published_used) > threshold
+
+    async def sample(self) -> None:
+        loop = asyncio.get_running_loop()
+        # disk_usage is a blocking statvfs per mount, keep it off the loop
+        usage = await loop.run_in_executor(None, self._disk_usage)
+
+        if not self._changed(usage):
+            return
+
+        # Fetch the current state so we only replace the disk usage
+        microscope = await get_microscope_by_id(self.session, self.microscope_id)
+        state = microscope.state if microscope.state is not None else {}
+        disk_usage = state.setdefault("disk_usage", {})
+        (total, used, free) = usage
+
+        if (disk_usage.get("total"), disk_usage.get("used"), disk_usage.get("free")) != usage:
             disk_usage["total"] = total
             disk_usage["used"] = used
             disk_usage["free"] = free
 
-            await patch_microscope(self.session, self.microscope_id, MicroscopeUpdate(state=state))
+            update = MicroscopeUpdate(state=state)
+            outbox.append(
+                "microscope_update",
+                json.dumps({"id": self.microscope_id, "update": update.dict()}),
+            )
+
+        self._published = usage
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.sample()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Exception sampling disk usage.")
+
+            try:
+                await asyncio.wait_for(
+                    self._resample.wait(), settings.DISK_USAGE_INTERVAL
+                )
+                # Let the rest of the removal finish
+                await asyncio.sleep(settings.DISK_USAGE_RESAMPLE_DELAY)
+            except asyncio.TimeoutError:
+                pass
+            self._resample.clear()
+
+
+class Scan4DFilesModeHandler(ModeHandler):
+    def __init__(self, microscope_id: int,  host: str, session: aiohttp.ClientSession):
+        super().__init__(microscope_id, host, session)
+        self._receiver_progress = {}
+
+        # Status file path => uuid of the last event emitted for it within the
+        # coalescing window.
+        self._last_emitted = TTLCache(
+            maxsize=100000, ttl=settings.STATUS_FILE_COALESCE_WINDOW
+        )
+        # Status file path => latest (event, uuid, manifest entry) waiting for
+        # the window to end
+        self._pending: Dict[
+            str, Tuple[FileSystemEventModel, Optional[str], Optional[ManifestEntry]]
+        ] = {}
+        self._pending_timers: Dict[str, asyncio.TimerHandle] = {}
+
+        # Messages for the API go through the outbox
+        self._senders = {
+            "file_events": partial(send_file_events, self.manifest),
+            "sync_event": partial(send_sync_events, self.manifest),
+            "microscope_update": send_microscope_updates,
+        }
+        for (kind, sender) in self._senders.items():
+            outbox.register(kind, sender)
+
+        # File mounts point to use for calculating disk usage
+        mount_points = set()
+        for d in settings.WATCH_DIRECTORIES:
+             mount_points.add(find_mount_point(d))
 
+        self._disk_usage_sampler = DiskUsageSampler(
+            session, microscope_id, mount_points
+        )
+        self._disk_usage_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._disk_usage_task = asyncio.create_task(self._disk_usage_sampler.run())
+
+    def _emit(self, model: FileSystemEventModel, uuid: Optional[str] = None,
+              entry: Optional[ManifestEntry] = None):
+        self._last_emitted[model.src_path] = uuid
+        entries = [entry] if entry is not None else []
+        outbox.append("file_events", outbox_message(model.json(), entries))
+
+    def _cancel_pending(self, path: str):
+        self._pending.pop(path, None)
+        timer = self._pending_timers.pop(path, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _emit_pending(self, path: str):
+        self._pending_timers.pop(path, None)
+        pending = self._pending.pop(path, None)
+        if pending is not None:
+            self._emit(*pending)
+
+    def _coalesce(self, model: FileSystemEventModel, status: ScanStatusFile,
+                  entry: ManifestEntry) -> None:
+        """
+        Emit the event if this is the first event for the status file within
+        the coalescing window, a new scan or the final progress update.
+        Otherwise keep it as the pending event for the path, replacing any
+        previous one, to be emitted at the end of the window.
+        """
+        path = model.src_path
+        if (
+            path not in self._last_emitted
+            or self._last_emitted[path] != status.uuid
+            or status.progress >= 100
+        ):
+            self._cancel_pending(path)
+            self._emit(model, status.uuid, entry)
+
+            return
+
+        if path in self._pending:
+            metrics.status_file_events_coalesced.inc()
+        self._pending[path] = (model, status.uuid, entry)
+        if path not in self._pending_timers:
+            loop = asyncio.get_running_loop()
+            self._pending_timers[path] = loop.call_later(
+                settings.STATUS_FILE_COALESCE_WINDOW, self._emit_pending, path
+            )
 
     async def on_event(self, event: FileSystemEvent):
         event_type = event.event_type
@@ -156,6 +393,10 @@ class Scan4DFilesModeHandler(ModeHandler):
         if event_type == EVENT_TYPE_MOVED:
             event_type = EVENT_TYPE_CREATED
             event = FileCreatedEvent(event.dest_path)
+        # The inotify observer only reports writes once the file is closed
+        elif event_type == EVENT_TYPE_CLOSED:
+            event_type = EVENT_TYPE_MODIFIED
+            event = FileModifiedEvent(event.src_path)
 
         path = AsyncPath(event.src_path)
 
@@ -164,73 +405,178 @@ class Scan4DFilesModeHandler(ModeHandler):
         if not (status_file_match and event_type in STATUS_FILE_EVENTS):
             return
 
+        model = FileSystemEventModel(
+            event_type=event.event_type,
+            src_path=event.src_path,
+            is_directory=event.is_directory,
+            host=self.host,
+        )
+
         if event_type == EVENT_TYPE_DELETED:
             if await path.exists():
                 return
-            else:
-                logger.info(f"Delete event for {path}")
 
-        elif event_type in [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED]:
-            # The receivers are continually writing to their status files, we don't want to send
-            # event if nothing has changes. So we stop sending events if nothing has changed for
-            # 5 minutes. We store progress and last change time for each receiver to be able todo
-            # this.
-            receiver = status_file_match.group(1)
+            logger.info(f"Delete event for {path}")
 
-            try:
-                status = ScanStatusFile.parse_file(path)
-            except FileNotFoundError:
-                return
+            # Deletes are never coalesced, and supersede any pending update
+            self._cancel_pending(event.src_path)
+            self._last_emitted.pop(event.src_path, None)
+            self._emit(model)
 
-            progress = status.progress
-
-            update_receiver_progress = False
-            if receiver in self._receiver_progress:
-                (change_time, previous_progress) = self._receiver_progress[receiver]
-                if f"{status.uuid}/{progress}" == previous_progress:
-                    if change_time + timedelta(minutes=5) < datetime.utcnow():
-                        # we can stop sending events, wait until something changes
-                        return
-                else:
-                    update_receiver_progress = True
-            else:
-                update_receiver_progress = True
+            # The scan's files are being removed, publish the space freed
+            self._disk_usage_sampler.resample()
 
-            if update_receiver_progress:
-                self._receiver_progress[receiver] = (datetime.utcnow(), f"{status.uuid}/{progress}")
+            return
 
-        model = FileSystemEventModel(
-            event_type=event.event_type,
-            src_path=event.src_path,
-            is_directory=event.is_directory,
-            host=self.host,
-        )
+        # The receivers are continually writing to their status files, we don't want to send
+        # event if nothing has changes. So we stop sending events if nothing has changed for
+        # 5 minutes. We store progress and last change time for each receiver to be able todo
+        # this.
+        receiver = status_file_match.group(1)
 
-        if await path.exists():
+        # Read the status file once, the content is both parsed and sent
+        try:
             stat_info = await path.stat()
-            model.created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
+            async with path.open('r') as fp:
+                content = cast(str, await fp.read())
+        except FileNotFoundError:
+            return
 
-            # If its not a delete event attach the contents
-            if event_type != EVENT_TYPE_DELETED:
-                async with path.open('r') as fp:
-                    content = await fp.read()
-                    model.content = cast(str, content)
+        try:
+            status = ScanStatusFile.parse_raw(content)
+        except ValidationError:
+            # Most likely caught mid write, we will get another event
+            logger.warning(f"Unable to parse status file: {path}")
+            return
+
+        progress = status.progress
 
-        def _log_exception(task: asyncio.Task) -> None:
+        update_receiver_progress = False
+        if receiver in self._receiver_progress:
+            (change_time, previous_progress) = self._receiver_progress[receiver]
+            if f"{status.uuid}/{progress}" == previous_progress:
+                if change_time + timedelta(minutes=5) < datetime.utcnow():
+                    # we can stop sending events, wait until something changes
+                    return
+            else:
+                update_receiver_progress = True
+        else:
+            update_receiver_progress = True
+
+        if update_receiver_progress:
+            self._receiver_progress[receiver] = (datetime.utcnow(), f"{status.uuid}/{progress}")
+
+        model.created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
+        model.content = content
+
+        entry = ManifestEntry(event.src_path, *status_file_entry(stat_info, content))
+        self._coalesce(model, status, entry)
+
+    async def close(self):
+        if self._disk_usage_task is not None:
+            self._disk_usage_task.cancel()
+
+        # Flush out any pending coalesced events
+        for path in list(self._pending_timers.keys()):
+            self._pending_timers[path].cancel()
+            self._emit_pending(path)
+
+        # Our senders use our manifest, which is about to be closed
+        for (kind, sender) in self._senders.items():
+            outbox.unregister(kind, sender)
+
+        await super().close()
+
+    async def _sync_with_manifest(self, manifest: Manifest):
+        """
+        Only read the status files that have changed since the state recorded
+        in the manifest, and only send those that have new content along with
+        any deletions. With an empty manifest we fall back to a full sync, so
+        the worker can reconcile its state.
+        """
+        acknowledged = manifest.entries()
+
+        loop = asyncio.get_running_loop()
+        snapshot = {}
+        for watch_dir in settings.WATCH_DIRECTORIES:
+            snapshot.update(
+                await loop.run_in_executor(None, status_file_snapshot, watch_dir)
+            )
+
+        files = []
+        # path => entry for the files to send
+        entries: Dict[str, ManifestEntry] = {}
+        # Rewritten, but with the same content
+        unchanged = []
+        for path, (inode, mtime_ns, size) in snapshot.items():
+            entry = acknowledged.get(path)
+            if entry is not None and entry.matches(inode, mtime_ns, size):
+                continue
+
+            status_file_path = AsyncPath(path)
             try:
-                task.result()
-            except asyncio.CancelledError:
-                pass
-            except Exception:
-                logger.exception("Exception posting file event.")
+                stat_info = await status_file_path.stat()
+                async with status_file_path.open('r') as fp:
+                    content = cast(str, await fp.read())
+            except FileNotFoundError:
+                continue
 
-        # Fire and forget
-        task = asyncio.create_task(post_file_event(self.session, model))
-        task.add_done_callback(_log_exception)
+            new_entry = ManifestEntry(path, *status_file_entry(stat_info, content))
+            if entry is not None and entry.hash == new_entry.hash:
+                unchanged.append(new_entry)
+                continue
 
-        await self._send_disk_usage(str(path))
+            entries[path] = new_entry
+            created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
+            files.append(File(path=path, created=created, host=self.host, content=content))
+
+        deleted = acknowledged.keys() - snapshot.keys()
+
+        if len(acknowledged) == 0:
+            outbox.append(
+                "sync_event", outbox_message(SyncEvent(files=files).json(), entries.values())
+            )
+        else:
+            events = [
+                FileSystemEventModel(
+                    event_type=EVENT_TYPE_DELETED,
+                    src_path=path,
+                    is_directory=False,
+                    host=self.host,
+                )
+                for path in deleted
+            ]
+            messages = [outbox_message(e.json()) for e in events]
+            # The same as the full sync, which treats each file as created
+            messages += [
+                outbox_message(
+                    FileSystemEventModel(
+                        event_type=EVENT_TYPE_CREATED,
+                        src_path=f.path,
+                        is_directory=False,
+                        host=self.host,
+                        created=f.created,
+                        content=f.content,
+                    ).json(),
+                    [entries[f.path]],
+                )
+                for f in files
+            ]
+            outbox.extend("file_events", messages)
+
+        # Nothing to send for these, the rest are updated once the API has them
+        manifest.acknowledge(unchanged)
+
+        logger.info(
+            f"Synced {len(files)} changed and {len(deleted)} deleted status files, "
+            f"{len(snapshot) - len(files)} unchanged."
+        )
 
     async def sync(self):
+        if self.manifest is not None:
+            await self._sync_with_manifest(self.manifest)
+
+            return
+
         files = await create_sync_snapshot(self.host, settings.WATCH_DIRECTORIES)
-        async with aiohttp.ClientSession() as session:
-            await post_sync_event(session, SyncEvent(files=files))
+        outbox.append("sync_event", outbox_message(SyncEvent(files=files).json()))
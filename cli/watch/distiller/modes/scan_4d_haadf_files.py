@@ -4,13 +4,16 @@ import asyncio
 from typing import List
 
 import aiohttp
+import metrics
 import tenacity
 from aiopath import AsyncPath
 from pathlib import Path
 from config import settings
 from schemas import FileSystemEvent as FileSystemEventModel
+from uploads import upload_file
 from utils import logger
-from watchdog.events import (EVENT_TYPE_MOVED, EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, FileSystemEvent)
+from watchdog.events import (EVENT_TYPE_CLOSED, EVENT_TYPE_MOVED, EVENT_TYPE_CREATED,
+                             EVENT_TYPE_MODIFIED, FileSystemEvent)
 from . import ModeHandler
 
 
@@ -27,25 +30,22 @@ from . import ModeHandler
     ,
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def upload_dm4(session: aiohttp.ClientSession, dm4_path: AsyncPath):
     logger.info(f"Uploading {dm4_path}")
-    data = aiohttp.FormData()
     headers = {settings.API_KEY_NAME: settings.API_KEY}
     # We use the standard Path object here rather than the async version here,
     # as the AsyncPath performs very badly in our deployment (SL7). We can
     # probably revert this fix if/when we move away from SL7.
-    with Path(dm4_path).open("rb") as fp:
-        data.add_field(
-            "file", fp, filename=dm4_path.name, content_type="application/octet-stream"
-        )
-        async with session.post(
-            f"{settings.API_URL}/files/haadf", headers=headers, data=data
-        ) as r:
-            r.raise_for_status()
+    upload_id = await upload_file(session, Path(dm4_path))
+    async with session.post(
+        f"{settings.API_URL}/files/haadf/uploads/{upload_id}", headers=headers
+    ) as r:
+        r.raise_for_status()
 
 DM4_PATTERN = re.compile(r"^scan([0-9]*)\.dm4")
-DM4_FILE_EVENTS = [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED]
+DM4_FILE_EVENTS = [EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_MOVED, EVENT_TYPE_CLOSED]
 
 
 class Scan4DHAADFFilesModeHandler(ModeHandler):
@@ -1,19 +1,29 @@
 import asyncio
+import fnmatch
+from functools import partial
+import os
 import re
+import time
 from datetime import datetime
-from typing import List, Optional, cast
+from typing import Any, Dict, List, Optional, Tuple, cast
 import hashlib
 import h5py
 
 
 import aiohttp
+import metrics
 import tenacity
 from aiopath import AsyncPath
 from pathlib import Path
-from cachetools import TTLCache
 from config import settings
-from schemas import Location, ScanFromFileMetadata
+from manifest import ManifestEntry
+from extract import extract_scan_file
+from schemas import (Location, ScanFileUploads, ScanFromExtractedMetadata,
+                     ScanFromFileMetadata, ScanFromUpload, ScanShaLookup)
 from schemas import Scan
+from stability import FileStabilityTracker
+from upload_pool import Progress, UploadPool
+from uploads import upload_file
 from utils import logger
 from watchdog.events import (EVENT_TYPE_CLOSED, EVENT_TYPE_MODIFIED, EVENT_TYPE_CREATED,
                              EVENT_TYPE_MOVED, FileSystemEvent, FileMovedEvent)
@@ -26,13 +36,62 @@ from . import ModeHandler
 
 SCAN_FILE_GLOBS = ["*.dm4", "*.dm3", "*.emi", "*.emd"]
 SCAN_FILE_PATTERNS = [re.compile(f"^.{g}") for g in SCAN_FILE_GLOBS]
+# Number of SHAs sent per lookup request
+SHA_LOOKUP_CHUNK_SIZE = 2000
 SCAN_FILE_EVENTS = [EVENT_TYPE_CREATED, EVENT_TYPE_MOVED, EVENT_TYPE_MODIFIED, EVENT_TYPE_CLOSED]
 
 
+def scan_file_snapshot(path: str) -> Dict[str, os.stat_result]:
+    """
+    Recursive snapshot of the scan files in path, a single pass over each
+    directory rather than a glob per pattern.
+    """
+    snapshot = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                snapshot.update(scan_file_snapshot(entry.path))
+            elif any(fnmatch.fnmatch(entry.name, g) for g in SCAN_FILE_GLOBS):
+                try:
+                    snapshot[entry.path] = entry.stat()
+                except FileNotFoundError:
+                    continue
+
+    return snapshot
+
+
+def is_complete_emd(path: str) -> bool:
+    # The superblock check is cheap, so do that before opening the file
+    if not h5py.is_hdf5(path):
+        return False
+
+    with emd.fileEMD(path, readonly=True) as emd_file:
+        return len(emd_file.list_emds) > 0
+
+
 def ser_file_path(emi_file_path: AsyncPath) -> AsyncPath:
     return emi_file_path.parent / f"{emi_file_path.stem}_1.ser"
 
 
+async def wait_for_ser_file(emi_file_path: AsyncPath) -> Optional[AsyncPath]:
+    tries = 5
+    while tries > 0:
+        if await ser_file_path(emi_file_path).exists():
+            logger.info(f"Associated SER file found for: {emi_file_path}")
+            return ser_file_path(emi_file_path)
+        tries -= 1
+        await asyncio.sleep(1)
+
+    return None
+
+
+async def scan_file_metadata(microscope_id: int, host: str, scan_file_path: AsyncPath) -> ScanFromFileMetadata:
+    location = Location(host=host, path=str(scan_file_path))
+    stat_info = await scan_file_path.stat()
+
+    return ScanFromFileMetadata(microscope_id=microscope_id, created=datetime.fromtimestamp(stat_info.st_ctime).astimezone(), locations=[location])
+
+
 @tenacity.retry(
     retry=tenacity.retry_if_exception_type(
         aiohttp.client_exceptions.ServerConnectionError
@@ -46,59 +105,132 @@ def ser_file_path(emi_file_path: AsyncPath) -> AsyncPath:
     ,
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
-async def create_scan_from_file(microscope_id: int, host: str, session: aiohttp.ClientSession, scan_file_path: AsyncPath):
+async def create_scan_from_file(microscope_id: int, host: str, session: aiohttp.ClientSession, scan_file_path: AsyncPath,
+                                progress: Optional[Progress] = None):
     logger.info(f"Uploading {scan_file_path}")
-    data = aiohttp.FormData()
-    headers = {settings.API_KEY_NAME: settings.API_KEY}
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
     # We use the standard Path object here rather than the async version here,
     # as the AsyncPath performs very badly in our deployment (SL7). We can
     # probably revert this fix if/when we move away from SL7.
-    with Path(scan_file_path).open("rb") as fp:
-        data.add_field("file", fp, filename=scan_file_path.name, content_type="application/octet-stream")
+    upload_id = await upload_file(session, Path(scan_file_path), progress)
+
+    ser_upload_id = None
+    # Special case for emi files, we need to also attach any associated ser file!
+    if scan_file_path.suffix == '.emi':
+        ser_path = await wait_for_ser_file(scan_file_path)
+        if ser_path is not None:
+            ser_upload_id = await upload_file(session, Path(ser_path), progress)
+
+    metadata = await scan_file_metadata(microscope_id, host, scan_file_path)
+    scan = ScanFromUpload(metadata=metadata, upload_id=upload_id, ser_upload_id=ser_upload_id)
+
+    async with session.post(
+        f"{settings.API_URL}/scans/uploads", headers=headers, data=scan.json()
+    ) as r:
+        if r.status == 409:
+            logger.warning(f'"{scan_file_path}" has already been uploaded.')
+        else:
+            r.raise_for_status()
+
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ) | tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ClientResponseError
+    ) | tenacity.retry_if_exception_type(
+         asyncio.TimeoutError
+    ),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+async def create_scan_from_extracted_metadata(
+    session: aiohttp.ClientSession,
+    metadata: ScanFromFileMetadata,
+    extracted_metadata: Dict[str, Any],
+) -> Optional[Scan]:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+    scan = ScanFromExtractedMetadata(metadata=metadata, extracted_metadata=extracted_metadata)
+
+    async with session.post(
+        f"{settings.API_URL}/scans/extracted", headers=headers, data=scan.json()
+    ) as r:
+        if r.status == 409:
+            return None
+
+        r.raise_for_status()
+        json = await r.json()
+
+        return Scan(**json)
 
-        ser_file = None
-        try:
-            # Special case for emi files, we need to also attach any associated ser file!
-            if scan_file_path.suffix == '.emi':
-                # Wait for ser file to appear
-                tries = 5
-                while tries > 0:
-                    if await ser_file_path(scan_file_path).exists():
-                        logger.info(f"Associated SER file found for: {scan_file_path}")
-                        ser_file = Path(ser_file_path(scan_file_path)).open("rb")
-                        name = f"{scan_file_path.stem}.ser"
-                        data.add_field(name, ser_file, filename=name, content_type="application/octet-stream")
-                        break
-                    tries -= 1
-                    await asyncio.sleep(1)
-
-            # Add the metadata needed encoded in another field, we need to it this way as
-            # we can have JSON and a file the same body ...
-            location = Location(host=host, path=str(scan_file_path))
-            stat_info = await scan_file_path.stat()
-            metadata = ScanFromFileMetadata(microscope_id=microscope_id, created=datetime.fromtimestamp(stat_info.st_ctime).astimezone(), locations=[location])
-
-            data.add_field(
-                "scan_metadata", metadata.json(), content_type="application/json")
-
-            async with session.post(
-                f"{settings.API_URL}/scans", headers=headers, data=data
-            ) as r:
-                if r.status == 409:
-                    logger.warning(f'"{scan_file_path}" has already been uploaded.')
-                else:
-                    r.raise_for_status()
-        finally:
-            if ser_file is not None:
-                ser_file.close()
 
 @tenacity.retry(
     retry=tenacity.retry_if_exception_type(
         aiohttp.client_exceptions.ServerConnectionError
+    ) | tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ClientResponseError
+    ) | tenacity.retry_if_exception_type(
+         asyncio.TimeoutError
     ),
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+async def upload_scan_image(session: aiohttp.ClientSession, id: int, image: bytes):
+    headers = {settings.API_KEY_NAME: settings.API_KEY}
+    data = aiohttp.FormData()
+    data.add_field(
+        "file", image, filename=f"{id}.{settings.IMAGE_FORMAT}",
+        content_type=f"image/{settings.IMAGE_FORMAT}"
+    )
+
+    async with session.put(
+        f"{settings.API_URL}/scans/{id}/image", headers=headers, data=data
+    ) as r:
+        r.raise_for_status()
+
+
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ) | tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ClientResponseError
+    ) | tenacity.retry_if_exception_type(
+         asyncio.TimeoutError
+    ),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+async def add_scan_file_uploads(
+    session: aiohttp.ClientSession, id: int, uploads: ScanFileUploads
+):
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    async with session.post(
+        f"{settings.API_URL}/scans/{id}/uploads", headers=headers, data=uploads.json()
+    ) as r:
+        r.raise_for_status()
+
+
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def get_scans(
     session: aiohttp.ClientSession,
@@ -122,31 +254,176 @@ async def get_scans(
         return [Scan(**x) for x in json]
 
 
+@tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+async def get_existing_shas(
+    session: aiohttp.ClientSession,
+    shas: List[str],
+) -> List[str]:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    async with session.post(
+        f"{settings.API_URL}/scans/sha-lookup",
+        headers=headers,
+        data=ScanShaLookup(shas=shas).json(),
+    ) as r:
+        r.raise_for_status()
+        json = await r.json()
+
+        return ScanShaLookup(**json).shas
+
+
 class ScanFilesModeHandler(ModeHandler):
     def __init__(self, microscope_id: int,  host: str, session: aiohttp.ClientSession):
         super().__init__(microscope_id, host, session)
-        self._cache = TTLCache(maxsize=100000, ttl=5*60)
+        # Uploads run in the background, so we keep handling events
+        self._uploads = UploadPool(settings.UPLOAD_CONCURRENCY)
+        # With edge extraction the scan is created by the uploads pool and the
+        # scan files follow separately, so they don't hold up new scans.
+        self._scan_file_uploads = UploadPool(settings.UPLOAD_CONCURRENCY)
+        # EMD files are only checked once they have stopped being written to
+        self._emd_files = FileStabilityTracker(
+            settings.EMD_QUIET_PERIOD, self._emd_stable,
+            close_delay=settings.EMD_CLOSE_DELAY, max_age=settings.EMD_MAX_AGE
+        )
+        # EMD path => number of times we have opened it
+        self._emd_open_attempts: Dict[str, int] = {}
+        self.emd_stats = {"open_attempts": 0, "detected": 0}
+
+    def _emd_stable(self, path: str):
+        self._uploads.submit(path, partial(self._upload_emd, AsyncPath(path)))
+
+    async def _upload_emd(self, path: AsyncPath, progress: Progress) -> bool:
+        key = str(path)
+        self._emd_open_attempts[key] = self._emd_open_attempts.get(key, 0) + 1
+        self.emd_stats["open_attempts"] += 1
+        metrics.emd_open_attempts.inc()
+
+        loop = asyncio.get_running_loop()
+        try:
+            complete = await loop.run_in_executor(None, is_complete_emd, key)
+        except PermissionError:
+            # Still open in the acquisition software
+            complete = False
+        except Exception:
+            logger.exception("Error reading EMD")
+            complete = False
+
+        # There may not be another event, so check it again later
+        if not complete:
+            if not self._emd_files.retry(key):
+                attempts = self._emd_open_attempts.pop(key, 0)
+                logger.warning(
+                    f"Giving up on incomplete EMD '{key}' after {attempts} open attempt(s)"
+                )
+            return False
+
+        attempts = self._emd_open_attempts.pop(key)
+        first_seen = self._emd_files.first_seen(key)
+        self._emd_files.forget(key)
+        self.emd_stats["detected"] += 1
+        if first_seen is not None:
+            logger.info(
+                f"EMD complete '{key}', {time.monotonic() - first_seen:.1f}s after "
+                f"first event, {attempts} open attempt(s)"
+            )
+
+        return await self._upload(path, progress)
+
+    async def _upload(self, path: AsyncPath, progress: Progress,
+                      stat_info: Optional[os.stat_result] = None) -> bool:
+        if settings.EDGE_EXTRACTION:
+            extracted = await self._extract(path)
+            if extracted is not None:
+                return await self._create_from_extracted(path, *extracted, stat_info=stat_info)
+
+        await create_scan_from_file(self.microscope_id, self.host, self.session, path, progress)
+        await self._acknowledge(path, stat_info)
+
+        return True
+
+    async def _extract(
+        self, path: AsyncPath
+    ) -> Optional[Tuple[Optional[AsyncPath], Dict[str, Any], Optional[bytes]]]:
+        """
+        Returns any associated ser file, the metadata and image for a scan
+        file, or None if they couldn't be extracted.
+        """
+        ser_path = None
+        if path.suffix == '.emi':
+            ser_path = await wait_for_ser_file(path)
+
+        loop = asyncio.get_running_loop()
+        try:
+            (metadata, image) = await loop.run_in_executor(
+                None, extract_scan_file, str(path), str(ser_path) if ser_path is not None else None,
+                settings.IMAGE_FORMAT, settings.IMAGE_QUALITY, settings.THUMBNAIL_SIZE
+            )
+        except Exception:
+            # Fall back to having the file processed centrally
+            logger.exception(f"Error extracting metadata from {path}, uploading.")
+            return None
+
+        return (ser_path, metadata, image)
+
+    async def _create_from_extracted(self, path: AsyncPath, ser_path: Optional[AsyncPath],
+                                     extracted_metadata: Dict[str, Any], image: Optional[bytes],
+                                     stat_info: Optional[os.stat_result] = None) -> bool:
+        metadata = await scan_file_metadata(self.microscope_id, self.host, path)
+        scan = await create_scan_from_extracted_metadata(self.session, metadata, extracted_metadata)
+        if scan is None:
+            entry = self.manifest.get(str(path)) if self.manifest is not None else None
+            if entry is not None and entry.pending_scan_id is not None:
+                logger.info(f'Scan for "{path}" already created, uploading the file.')
+                if stat_info is None:
+                    stat_info = await path.stat()
+                await self._resume_scan_files(path, entry.pending_scan_id, stat_info)
 
-    async def _handle_emd(self, event: FileSystemEvent):
-        if event.event_type in [EVENT_TYPE_CREATED, EVENT_TYPE_MOVED, EVENT_TYPE_MODIFIED]:
-            try:
+                return True
+
+            logger.warning(f'"{path}" has already been uploaded.')
+            await self._acknowledge(path, stat_info)
 
-                # Retry logic for PermissionError
-                for attempt in tenacity.Retrying(wait=tenacity.wait_fixed(1),
-                                                 stop=tenacity.stop_after_attempt(10),
-                                                 retry=tenacity.retry_if_exception_type(PermissionError)):
-                    with attempt:
-                        if not h5py.is_hdf5(event.src_path):
-                            return
-
-                with emd.fileEMD(event.src_path, readonly=True) as emd_file:
-                    if len(emd_file.list_emds) > 0:
-                        path = AsyncPath(event.src_path)
-                        await create_scan_from_file(self.microscope_id, self.host, self.session, path)
-                        key = event.src_path
-                        self._cache[key] = True
+            return True
+
+        logger.info(f"Created scan {scan.id} from extracted metadata for {path}")
+        # So the file is still attached to the scan if we stop before it's uploaded
+        await self._acknowledge(path, stat_info, pending_scan_id=scan.id)
+        if image is not None:
+            try:
+                await upload_scan_image(self.session, scan.id, image)
             except Exception:
-                logger.exception("Error reading EMD")
+                # The scan exists now, so carry on with the scan files
+                logger.exception(f"Error uploading image for scan {scan.id}.")
+
+        self._scan_file_uploads.submit(
+            str(path), partial(self._upload_scan_files, path, ser_path, scan.id, stat_info=stat_info)
+        )
+
+        return True
+
+    async def _upload_scan_files(self, path: AsyncPath, ser_path: Optional[AsyncPath], id: int,
+                                 progress: Progress, stat_info: Optional[os.stat_result] = None) -> bool:
+        upload_id = await upload_file(self.session, Path(path), progress)
+        ser_upload_id = None
+        if ser_path is not None:
+            ser_upload_id = await upload_file(self.session, Path(ser_path), progress)
+
+        await add_scan_file_uploads(
+            self.session, id, ScanFileUploads(upload_id=upload_id, ser_upload_id=ser_upload_id)
+        )
+        await self._acknowledge(path, stat_info)
+
+        return True
 
     async def on_event(self, event: FileSystemEvent):
         path = AsyncPath(event.src_path)
@@ -162,8 +439,13 @@ class ScanFilesModeHandler(ModeHandler):
 
         key = event.src_path
         # Handle EMD, we need to make sure it a complete file
-        if path.suffix.lower() == ".emd" and key not in self._cache:
-            await self._handle_emd(event)
+        if path.suffix.lower() == ".emd":
+            if event.event_type == EVENT_TYPE_MOVED:
+                self._emd_files.touch(cast(FileMovedEvent, event).dest_path)
+            elif event.event_type == EVENT_TYPE_CLOSED:
+                self._emd_files.closed(key)
+            else:
+                self._emd_files.touch(key)
             return
 
         # Could be a move event ( the microscopy software creates
@@ -171,12 +453,44 @@ class ScanFilesModeHandler(ModeHandler):
         if event.event_type == EVENT_TYPE_MOVED:
             path = AsyncPath(cast(FileMovedEvent, event).dest_path)
 
-        if key in self._cache:
+        self._uploads.submit(key, partial(self._upload, path))
+
+    async def close(self):
+        self._emd_files.close()
+        await self._uploads.close()
+        await self._scan_file_uploads.close()
+        await super().close()
+
+    def _manifest_entry(self, path: AsyncPath, stat_info: os.stat_result) -> ManifestEntry:
+        created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
+        sha = self.generate_sha256(str(path), created)
+
+        return ManifestEntry(
+            str(path), stat_info.st_ino, stat_info.st_mtime_ns, stat_info.st_size, sha
+        )
+
+    async def _acknowledge(self, path: AsyncPath, stat_info: Optional[os.stat_result] = None,
+                           pending_scan_id: Optional[int] = None):
+        """
+        Record in the manifest that the API has the scan for this file, and
+        whether the file has still to be uploaded to the scan.
+        """
+        if self.manifest is None:
             return
 
-        await create_scan_from_file(self.microscope_id, self.host, self.session, path)
+        if stat_info is None:
+            stat_info = await path.stat()
+        entry = self._manifest_entry(path, stat_info)
+        self.manifest.acknowledge([entry._replace(pending_scan_id=pending_scan_id)])
 
-        self._cache[key] = True
+    async def _resume_scan_files(self, path: AsyncPath, id: int, stat_info: os.stat_result):
+        ser_path = None
+        if path.suffix == '.emi' and await ser_file_path(path).exists():
+            ser_path = ser_file_path(path)
+
+        self._scan_file_uploads.submit(
+            str(path), partial(self._upload_scan_files, path, ser_path, id, stat_info=stat_info)
+        )
 
     def  generate_sha256(self, path: str, created: datetime):
         sha = hashlib.sha256()
@@ -188,18 +502,62 @@ class ScanFilesModeHandler(ModeHandler):
         return sha.hexdigest()
 
     async def sync(self):
-        files = []
+        acknowledged = self.manifest.entries() if self.manifest is not None else {}
+
+        loop = asyncio.get_running_loop()
+        seen = set()
+        # sha => (path, stat) of the files we need to check
+        candidates: Dict[str, Tuple[AsyncPath, os.stat_result]] = {}
+        pending = 0
         for watch_dir in settings.WATCH_DIRECTORIES:
-            for g in SCAN_FILE_GLOBS:
-                async for f in AsyncPath(watch_dir).glob(f"**/{g}"):
-                    path = AsyncPath(f)
-                    stat_info = await path.stat()
-                    created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
-                    sha = self.generate_sha256(str(path), created)
-                    # See if we already have a scan for this sha
-                    scans = await get_scans(self.session, sha)
-                    if len(scans) == 0:
-                        # Create new scan from file
-                        await create_scan_from_file(self.microscope_id, self.host, self.session, path)
-                    else:
-                        logger.info(f"Skipping '{path}' scan already exists")
\ No newline at end of file
+            snapshot = await loop.run_in_executor(None, scan_file_snapshot, watch_dir)
+            seen.update(snapshot.keys())
+            for f, stat_info in snapshot.items():
+                entry = acknowledged.get(f)
+                # The scan exists, but the file didn't get uploaded to it
+                if entry is not None and entry.pending_scan_id is not None:
+                    await self._resume_scan_files(AsyncPath(f), entry.pending_scan_id, stat_info)
+                    pending += 1
+                    continue
+
+                # Nothing has changed since the API acknowledged it
+                if entry is not None and entry.matches(
+                    stat_info.st_ino, stat_info.st_mtime_ns, stat_info.st_size
+                ):
+                    continue
+
+                path = AsyncPath(f)
+                created = datetime.fromtimestamp(stat_info.st_ctime).astimezone()
+                sha = self.generate_sha256(str(path), created)
+                candidates[sha] = (path, stat_info)
+
+        # See which of the shas we already have scans for
+        shas = list(candidates.keys())
+        existing = set()
+        for i in range(0, len(shas), SHA_LOOKUP_CHUNK_SIZE):
+            existing.update(
+                await get_existing_shas(self.session, shas[i:i + SHA_LOOKUP_CHUNK_SIZE])
+            )
+
+        uploads = 0
+        for sha, (path, stat_info) in candidates.items():
+            # Create new scan from file
+            if sha not in existing:
+                self._uploads.submit(str(path), partial(self._upload, path, stat_info=stat_info))
+                uploads += 1
+
+        await self._uploads.join()
+        # The scan files of the scans created from extracted metadata
+        await self._scan_file_uploads.join()
+
+        if self.manifest is not None:
+            self.manifest.acknowledge(
+                self._manifest_entry(*candidates[sha]) for sha in existing
+            )
+            self.manifest.remove(acknowledged.keys() - seen)
+
+        logger.info(
+            f"Synced {uploads} new scan files, {pending} pending scan files, "
+            f"{len(existing)} already uploaded, "
+            f"{len(seen) - len(candidates) - pending} unchanged."
+        )
@@ -0,0 +1,228 @@
+import fnmatch
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from constants import STATUS_FILE_GLOB
+from watchdog.events import (DirCreatedEvent, DirDeletedEvent,
+                             FileClosedEvent, FileCreatedEvent,
+                             FileDeletedEvent, FileModifiedEvent,
+                             FileMovedEvent, FileSystemEvent)
+from watchdog.observers.api import (DEFAULT_OBSERVER_TIMEOUT, BaseObserver,
+                                    EventEmitter)
+from watchdog.observers.inotify import InotifyEmitter
+from watchdog.observers.inotify_buffer import InotifyBuffer
+from watchdog.observers.inotify_c import InotifyConstants
+
+from utils import find_mount_point
+
+# We only care about files once the writer is done with them, so rather than
+# IN_MODIFY ( one event per write(2) ) we only ask for close-after-write,
+# renames and deletes.
+CLOSE_WRITE_EVENT_MASK = (
+    InotifyConstants.IN_CLOSE_WRITE
+    | InotifyConstants.IN_MOVE
+    | InotifyConstants.IN_DELETE
+    | InotifyConstants.IN_DELETE_SELF
+)
+
+# The events passed on to the handler, the DirModifiedEvents that go with
+# each of them are dropped.
+CLOSE_WRITE_EVENT_FILTER = [
+    FileClosedEvent,
+    FileCreatedEvent,
+    FileMovedEvent,
+    FileDeletedEvent,
+    DirCreatedEvent,
+    DirDeletedEvent,
+]
+
+MOUNTS_ESCAPE = re.compile(r"\\([0-7]{3})")
+
+STATUS_FILE_PATTERN = re.compile(fnmatch.translate(STATUS_FILE_GLOB))
+
+# File systems where changes made by other hosts never generate inotify
+# events, so we have to poll.
+NETWORK_FILESYSTEMS = {
+    "nfs",
+    "nfs4",
+    "cifs",
+    "smb3",
+    "smbfs",
+    "9p",
+    "afs",
+    "ceph",
+    "glusterfs",
+    "fuse.glusterfs",
+    "fuse.sshfs",
+    "lustre",
+    "gpfs",
+    "beegfs",
+}
+
+
+def filesystem_type(path: str) -> Optional[str]:
+    mount_point = find_mount_point(path)
+
+    try:
+        with open("/proc/mounts", "r") as fp:
+            mounts = fp.readlines()
+    except OSError:
+        return None
+
+    fs_type = None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+
+        # /proc/mounts escapes whitespace as octal
+        mount_dir = MOUNTS_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), fields[1])
+        # Later entries shadow earlier ones mounted at the same point
+        if mount_dir == mount_point:
+            fs_type = fields[2]
+
+    return fs_type
+
+
+def delivers_events(path: str) -> bool:
+    return filesystem_type(path) not in NETWORK_FILESYSTEMS
+
+
+class CloseWriteInotifyBuffer(InotifyBuffer):
+    """
+    Drops the IN_CREATE events for files, a new file is only of interest once
+    it has been written and closed. Directory creates are kept, so new sub
+    directories are still watched.
+    """
+
+    def read_event(self):
+        while True:
+            event = super().read_event()
+            if (
+                event is None
+                or isinstance(event, tuple)
+                or event.is_directory
+                or not event.is_create
+            ):
+                return event
+
+
+class InotifyCloseWriteEmitter(InotifyEmitter):
+    """
+    watchdog's inotify emitter, only listening for IN_CLOSE_WRITE, renames
+    and deletes. Completed writes are emitted as FileClosedEvents, without
+    the modified events for each write(2) in between.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs["event_filter"] = CLOSE_WRITE_EVENT_FILTER
+        super().__init__(*args, **kwargs)
+
+    def on_thread_start(self):
+        # The inotify fd is only opened here, and closed in on_thread_stop
+        self._inotify = CloseWriteInotifyBuffer(
+            os.fsencode(self.watch.path),
+            recursive=self.watch.is_recursive,
+            event_mask=self.get_event_mask_from_filter(),
+        )
+
+    def get_event_mask_from_filter(self) -> int:
+        mask = CLOSE_WRITE_EVENT_MASK
+        # We only need creates to pick up new sub directories
+        if self.watch.is_recursive:
+            mask |= InotifyConstants.IN_CREATE
+
+        return mask
+
+
+class InotifyCloseWriteObserver(BaseObserver):
+    def __init__(self, timeout: float = DEFAULT_OBSERVER_TIMEOUT):
+        super().__init__(InotifyCloseWriteEmitter, timeout=timeout)
+
+
+# path => (inode, mtime_ns, size)
+StatusFileSnapshot = Dict[str, Tuple[int, int, int]]
+
+
+def status_file_snapshot(path: str, recursive: bool = False) -> StatusFileSnapshot:
+    """
+    Snapshot of just the status files in path. Unlike watchdog's
+    DirectorySnapshot only entries matching STATUS_FILE_GLOB are stat'ed, so
+    the data_scan*_module* files only cost a directory entry read.
+    """
+    snapshot = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if recursive and entry.is_dir(follow_symlinks=False):
+                snapshot.update(status_file_snapshot(entry.path, recursive))
+            elif STATUS_FILE_PATTERN.match(entry.name):
+                try:
+                    stat_info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                snapshot[entry.path] = (
+                    stat_info.st_ino,
+                    stat_info.st_mtime_ns,
+                    stat_info.st_size,
+                )
+
+    return snapshot
+
+
+def diff_status_file_snapshots(
+    previous: StatusFileSnapshot, current: StatusFileSnapshot
+) -> List[FileSystemEvent]:
+    events = []
+    for path in previous.keys() - current.keys():
+        events.append(FileDeletedEvent(path))
+
+    for path, (inode, mtime_ns, size) in current.items():
+        previous_stat = previous.get(path)
+        if previous_stat is None:
+            events.append(FileCreatedEvent(path))
+        elif previous_stat[0] != inode:
+            # The file has been replaced
+            events.append(FileCreatedEvent(path))
+        elif previous_stat[1:] != (mtime_ns, size):
+            events.append(FileModifiedEvent(path))
+
+    return events
+
+
+class StatusFilePollingEmitter(EventEmitter):
+    """
+    Polling emitter that only tracks status files, see status_file_snapshot.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._snapshot: StatusFileSnapshot = {}
+
+    def on_thread_start(self):
+        self._snapshot = status_file_snapshot(
+            self.watch.path, self.watch.is_recursive
+        )
+
+    def queue_events(self, timeout: float):
+        # timeout is our polling interval
+        if self.stopped_event.wait(timeout):
+            return
+
+        try:
+            snapshot = status_file_snapshot(self.watch.path, self.watch.is_recursive)
+        except OSError:
+            self.queue_event(DirDeletedEvent(self.watch.path))
+            self.stop()
+            return
+
+        events = diff_status_file_snapshots(self._snapshot, snapshot)
+        self._snapshot = snapshot
+
+        for event in events:
+            self.queue_event(event)
+
+
+class StatusFilePollingObserver(BaseObserver):
+    def __init__(self, timeout: float = DEFAULT_OBSERVER_TIMEOUT):
+        super().__init__(StatusFilePollingEmitter, timeout=timeout)
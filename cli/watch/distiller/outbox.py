@@ -0,0 +1,201 @@
+import asyncio
+import os
+import sqlite3
+from typing import Awaitable, Callable, Dict, Iterable, List, Set
+
+import aiohttp
+import metrics
+from config import settings
+from utils import logger
+
+# Sends a batch of payloads of one kind to the API
+Sender = Callable[[aiohttp.ClientSession, List[str]], Awaitable[None]]
+
+# Max time (seconds) to wait before retrying a batch that failed to send
+MAX_RETRY_WAIT = 30
+
+# Outbox used when neither OUTBOX_PATH nor MANIFEST_PATH is set, in the
+# working directory
+DEFAULT_OUTBOX_PATH = "watch_outbox.db"
+
+
+class Outbox(object):
+    """
+    SQLite backed queue of messages for the API. Handlers append to it and
+    never wait on the network, the drain task sends the messages in order,
+    in batches of consecutive messages of the same kind, and only removes
+    them once the API has accepted them.
+
+    Messages of a kind nothing has registered a sender for, say from a run
+    in another mode, are left in the outbox and don't hold up the others.
+    When several senders are registered for a kind the latest is used,
+    unregistering it falls back to the one before.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL
+            )
+            """
+        )
+        self._db.commit()
+        # kind => registered senders, the last one is used
+        self._senders: Dict[str, List[Sender]] = {}
+        self._changed = asyncio.Event()
+        # Kinds without a sender we have already logged
+        self._parked: Set[str] = set()
+        self._senders_changed = False
+
+    def register(self, kind: str, sender: Sender) -> None:
+        self._senders.setdefault(kind, []).append(sender)
+        self._senders_changed = True
+        self._changed.set()
+
+    def unregister(self, kind: str, sender: Sender) -> None:
+        senders = self._senders.get(kind, [])
+        if sender in senders:
+            senders.remove(sender)
+        if not senders:
+            self._senders.pop(kind, None)
+        self._senders_changed = True
+        self._changed.set()
+
+    def append(self, kind: str, payload: str) -> None:
+        self.extend(kind, [payload])
+
+    def extend(self, kind: str, payloads: Iterable[str]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO outbox (kind, payload) VALUES (?, ?)",
+                [(kind, p) for p in payloads],
+            )
+        self._changed.set()
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def _log_parked(self) -> None:
+        kinds = list(self._senders.keys())
+        rows = self._db.execute(
+            "SELECT kind, COUNT(*) FROM outbox "
+            f"WHERE kind NOT IN ({','.join('?' * len(kinds))}) GROUP BY kind",
+            kinds,
+        ).fetchall()
+        for (kind, count) in rows:
+            if kind not in self._parked:
+                logger.warning(
+                    f"No sender for {count} '{kind}' message(s) in the outbox, "
+                    "leaving them until one is registered."
+                )
+                self._parked.add(kind)
+
+    def _next_batch(self, max_size: int) -> List[tuple]:
+        kinds = list(self._senders.keys())
+        rows = self._db.execute(
+            "SELECT id, kind, payload FROM outbox "
+            f"WHERE kind IN ({','.join('?' * len(kinds))}) ORDER BY id LIMIT ?",
+            (*kinds, max_size),
+        ).fetchall()
+
+        # Only consecutive messages of the same kind are batched
+        batch = []
+        for row in rows:
+            if row[1] != rows[0][1]:
+                break
+            batch.append(row)
+
+        return batch
+
+    def _remove(self, batch: List[tuple]) -> None:
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(row[0],) for row in batch]
+            )
+
+    async def drain(self, session: aiohttp.ClientSession) -> None:
+        retry_wait = 1
+        # Messages up to this id are sent one at a time, after the API
+        # rejected a batch containing them.
+        individually_until = 0
+        while True:
+            if self._senders_changed:
+                self._senders_changed = False
+                self._log_parked()
+            batch = self._next_batch(settings.FILE_EVENT_BATCH_SIZE)
+            if not batch:
+                # Nothing to send, or the handler for it hasn't registered yet
+                self._changed.clear()
+                await self._changed.wait()
+                # Give a batch a chance to build up
+                await asyncio.sleep(settings.FILE_EVENT_BATCH_LATENCY)
+                continue
+
+            if batch[0][0] <= individually_until:
+                batch = batch[:1]
+
+            kind = batch[0][1]
+            try:
+                await self._senders[kind][-1](session, [row[2] for row in batch])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if isinstance(e, aiohttp.ClientResponseError) and is_client_error(e):
+                    # Find the messages the API won't accept
+                    if len(batch) > 1:
+                        logger.warning(
+                            f"API rejected {len(batch)} '{kind}' messages, "
+                            "sending them individually."
+                        )
+                        individually_until = batch[-1][0]
+                        continue
+
+                    # The API will never accept it, so don't block the rest
+                    logger.exception(f"API rejected '{kind}' message, dropping: {batch[0][2]}")
+                    metrics.outbox_dropped.inc()
+                    self._remove(batch)
+                    continue
+
+                logger.warning(f"Error sending '{kind}' messages, retrying in {retry_wait}s: {e!r}")
+                await asyncio.sleep(retry_wait)
+                retry_wait = min(retry_wait * 2, MAX_RETRY_WAIT)
+                continue
+
+            self._remove(batch)
+            retry_wait = 1
+
+
+def is_client_error(e: aiohttp.ClientResponseError) -> bool:
+    return 400 <= e.status < 500
+
+
+def outbox_path() -> str:
+    if settings.OUTBOX_PATH is not None:
+        return settings.OUTBOX_PATH
+
+    # The manifest records what has been queued, so the outbox needs to be as
+    # durable as the manifest.
+    if settings.MANIFEST_PATH is not None:
+        return f"{settings.MANIFEST_PATH}.outbox"
+
+    return os.path.abspath(DEFAULT_OUTBOX_PATH)
+
+
+def open_outbox() -> Outbox:
+    # Messages only survive a restart on disk, so there is no falling back to
+    # an in memory outbox
+    path = outbox_path()
+    try:
+        return Outbox(path)
+    except sqlite3.Error:
+        logger.exception(f"Unable to open the outbox '{path}'.")
+        raise
+
+
+outbox = open_outbox()
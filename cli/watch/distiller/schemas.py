@@ -2,6 +2,7 @@ from datetime import datetime
 from enum import Enum
 from typing import List, Optional, Any, Dict
 
+from json_utils import numpy_dumps
 from pydantic import BaseModel, Field
 
 
@@ -14,6 +15,39 @@ class WatchMode(str, Enum):
     SCAN_FILES  = "scan_files"
 
 
+class ObserverMode(str, Enum):
+    # Use inotify where the mount delivers events, otherwise poll
+    AUTO = "auto"
+    # Always use inotify
+    INOTIFY = "inotify"
+    # Always poll
+    POLLING = "polling"
+
+
+class OverflowPolicy(str, Enum):
+    # Block the observer until there is space in the event queue
+    BLOCK = "block"
+    # Drop modified events superseded by an event already queued for the path
+    DROP = "drop"
+    # As drop, also merge deletes into events already queued for the path
+    MERGE = "merge"
+
+
+class ShardMode(str, Enum):
+    # One shard per mount point
+    MOUNT = "mount"
+    # One shard per watch directory
+    DIRECTORY = "directory"
+    # A single shard for all the watch directories
+    NONE = "none"
+
+
+class ContentEncoding(str, Enum):
+    GZIP = "gzip"
+    # Requires the zstandard package
+    ZSTD = "zstd"
+
+
 class FileSystemEventType(str, Enum):
     MOVED = "moved"
     DELETED = "deleted"
@@ -52,11 +86,44 @@ class Location(BaseModel):
     host: str
     path: str
 
+class ScanShaLookup(BaseModel):
+    shas: List[str]
+
 class ScanFromFileMetadata(BaseModel):
     created: datetime
     locations: List[Location]
     microscope_id: int
 
+class ScanFromUpload(BaseModel):
+    metadata: ScanFromFileMetadata
+    upload_id: str
+    ser_upload_id: Optional[str]
+
+class ScanFromExtractedMetadata(BaseModel):
+    metadata: ScanFromFileMetadata
+    extracted_metadata: Dict[str, Any]
+
+    class Config:
+        json_dumps = numpy_dumps
+
+class ScanFileUploads(BaseModel):
+    upload_id: str
+    ser_upload_id: Optional[str]
+
+class UploadCreate(BaseModel):
+    filename: str
+    size: int
+
+class Upload(BaseModel):
+    id: str
+    filename: str
+    size: int
+    offset: int
+    complete: bool
+
+class UploadFinalize(BaseModel):
+    sha256: str
+
 class Microscope(BaseModel):
     id: int
     name: str
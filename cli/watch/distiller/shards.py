@@ -0,0 +1,57 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from typing import Dict, List
+
+import metrics
+from aiowatchdog import BoundedEventQueue
+from config import settings
+from schemas import ShardMode
+from utils import find_mount_point
+
+
+@dataclass
+class Shard:
+    """
+    A group of watch directories with their own event queue, so a slow or
+    saturated mount doesn't hold up events from the others. Events are
+    handled in order within a shard, and concurrently across shards.
+    """
+
+    # The mount point or directory the shard is for
+    name: str
+    dirs: List[str]
+    queue: BoundedEventQueue
+
+
+def shard_directories(dirs: List[str], shard_by: ShardMode) -> Dict[str, List[str]]:
+    if shard_by == ShardMode.NONE:
+        return {"all": list(dirs)}
+
+    shards: Dict[str, List[str]] = {}
+    for d in dirs:
+        if shard_by == ShardMode.MOUNT and os.path.exists(d):
+            name = find_mount_point(d)
+        else:
+            name = os.path.abspath(d)
+
+        shards.setdefault(name, []).append(d)
+
+    return shards
+
+
+def create_shards(loop: asyncio.AbstractEventLoop, dirs: List[str]) -> List[Shard]:
+    shards = []
+    for (name, shard_dirs) in shard_directories(dirs, settings.SHARD_BY).items():
+        queue = BoundedEventQueue(
+            loop, maxsize=settings.EVENT_QUEUE_SIZE, policy=settings.EVENT_QUEUE_POLICY
+        )
+        shards.append(Shard(name, shard_dirs, queue))
+
+        # Read from the queue when scraped
+        metrics.event_queue_depth.set_function(queue.qsize, shard=name)
+        metrics.event_queue_merged.set_function(lambda q=queue: q.merged, shard=name)
+        metrics.event_queue_dropped.set_function(lambda q=queue: q.dropped, shard=name)
+        metrics.event_queue_blocked.set_function(lambda q=queue: q.blocked, shard=name)
+
+    return shards
@@ -0,0 +1,127 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+
+@dataclass
+class TrackedFile:
+    # When we first saw an event for the file (monotonic)
+    first_seen: float
+    # When we last saw an event for the file (monotonic)
+    last_seen: float
+    size: Optional[int] = None
+    timer: Optional[asyncio.TimerHandle] = None
+
+
+class FileStabilityTracker(object):
+    """
+    Tracks files that are being written, calling on_stable once a file's
+    size and mtime haven't changed for quiet_period seconds, or close_delay
+    seconds after the last of a burst of close write events for it. Events
+    only re-arm a timer, the file is only stat'ed when the timer fires.
+    """
+
+    def __init__(self, quiet_period: float, on_stable: Callable[[str], None],
+                 close_delay: float = 1, max_age: float = 10 * 60):
+        self._quiet_period = quiet_period
+        self._on_stable = on_stable
+        self._close_delay = close_delay
+        self._max_age = max_age
+        self._files: Dict[str, TrackedFile] = {}
+
+    def _tracked(self, path: str) -> TrackedFile:
+        now = time.monotonic()
+        tracked = self._files.get(path)
+        if tracked is None:
+            tracked = TrackedFile(first_seen=now, last_seen=now)
+            self._files[path] = tracked
+        tracked.last_seen = now
+
+        return tracked
+
+    def _arm(self, path: str, tracked: TrackedFile, delay: float,
+             callback: Optional[Callable[[str], None]] = None) -> None:
+        if tracked.timer is not None:
+            tracked.timer.cancel()
+
+        loop = asyncio.get_running_loop()
+        tracked.timer = loop.call_later(delay, callback or self._check, path)
+
+    def touch(self, path: str) -> None:
+        """
+        The file has been written to, wait for it to go quiet.
+        """
+        tracked = self._tracked(path)
+        self._arm(path, tracked, self._quiet_period)
+
+    def closed(self, path: str) -> None:
+        """
+        The writer has closed the file, no need to wait for it to go quiet.
+        A writer can open and close the file several times, so only the last
+        close of a burst makes it stable.
+        """
+        tracked = self._tracked(path)
+        self._arm(path, tracked, self._close_delay, self._stable)
+
+    def retry(self, path: str) -> bool:
+        """
+        The file was stable but isn't complete, check it again after another
+        quiet period. Gives up, returning False, once there have been no
+        events for the file for max_age seconds.
+        """
+        tracked = self._files.get(path)
+        if tracked is None:
+            return False
+
+        if time.monotonic() - tracked.last_seen > self._max_age:
+            self.forget(path)
+            return False
+
+        self._arm(path, tracked, self._quiet_period)
+
+        return True
+
+    def _stable(self, path: str) -> None:
+        tracked = self._files.get(path)
+        if tracked is None:
+            return
+
+        tracked.timer = None
+        self._on_stable(path)
+
+    def _check(self, path: str) -> None:
+        tracked = self._files.get(path)
+        if tracked is None:
+            return
+
+        tracked.timer = None
+        try:
+            stat_info = os.stat(path)
+        except FileNotFoundError:
+            self._files.pop(path, None)
+            return
+
+        # Still being written to, without us seeing events
+        age = time.time() - stat_info.st_mtime
+        if age < self._quiet_period or stat_info.st_size != tracked.size:
+            tracked.size = stat_info.st_size
+            self._arm(path, tracked, max(self._quiet_period - age, 0.1))
+            return
+
+        self._on_stable(path)
+
+    def first_seen(self, path: str) -> Optional[float]:
+        tracked = self._files.get(path)
+
+        return tracked.first_seen if tracked is not None else None
+
+    def forget(self, path: str) -> None:
+        tracked = self._files.pop(path, None)
+        if tracked is not None and tracked.timer is not None:
+            tracked.timer.cancel()
+
+    def close(self) -> None:
+        for path in list(self._files.keys()):
+            self.forget(path)
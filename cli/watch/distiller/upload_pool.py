@@ -0,0 +1,104 @@
+import asyncio
+import time
+from functools import partial
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from cachetools import TTLCache
+from utils import logger
+
+# Minimum interval (seconds) between progress log messages for a file
+PROGRESS_LOG_INTERVAL = 5
+
+# Called with the bytes sent so far and the total
+Progress = Callable[[int, int], None]
+# Performs the upload, returns True once the file has been uploaded
+UploadJob = Callable[[Progress], Awaitable[bool]]
+
+
+class UploadPool(object):
+    """
+    Runs upload jobs, at most concurrency at a time, in the order their keys
+    were first submitted. Submitting never waits on an upload.
+
+    A key is only queued once, submitting a key that is already queued
+    replaces its job. A key submitted while its job is running is queued
+    again if that job doesn't complete the upload. Keys that have been
+    uploaded are ignored for ttl seconds.
+    """
+
+    def __init__(self, concurrency: int = 4, ttl: float = 5 * 60):
+        self._concurrency = concurrency
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._jobs: Dict[str, UploadJob] = {}
+        self._active: Set[str] = set()
+        self._uploaded = TTLCache(maxsize=100000, ttl=ttl)
+        self._workers: List[asyncio.Task] = []
+        # key => (bytes sent, total bytes, time last logged)
+        self._progress: Dict[str, Tuple[int, int, float]] = {}
+
+    def submit(self, key: str, job: UploadJob) -> None:
+        if key in self._uploaded:
+            return
+
+        queue = key not in self._jobs and key not in self._active
+        self._jobs[key] = job
+        if queue:
+            self._queue.put_nowait(key)
+
+        if len(self._workers) == 0:
+            self._workers = [
+                asyncio.create_task(self._worker()) for _ in range(self._concurrency)
+            ]
+
+    def progress(self) -> Dict[str, Tuple[int, int]]:
+        return {key: (sent, total) for key, (sent, total, _) in self._progress.items()}
+
+    def _report_progress(self, key: str, sent: int, total: int) -> None:
+        now = time.monotonic()
+        (_, _, last_logged) = self._progress.get(key, (0, 0, now))
+        if now - last_logged >= PROGRESS_LOG_INTERVAL:
+            logger.info(f"Uploading {key}: {100 * sent // total}% ({sent}/{total} bytes)")
+            last_logged = now
+
+        self._progress[key] = (sent, total, last_logged)
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._queue.get()
+            job = self._jobs.pop(key)
+            self._active.add(key)
+            try:
+                uploaded = await job(partial(self._report_progress, key))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Error uploading {key}.")
+                uploaded = False
+            finally:
+                self._active.discard(key)
+                self._progress.pop(key, None)
+
+            if uploaded:
+                self._uploaded[key] = True
+                self._jobs.pop(key, None)
+            elif key in self._jobs:
+                # Submitted again while we were running
+                self._queue.put_nowait(key)
+
+            self._queue.task_done()
+
+    async def join(self) -> None:
+        """
+        Wait until everything submitted has been processed.
+        """
+        await self._queue.join()
+
+    async def close(self) -> None:
+        """
+        Finish what has been submitted, then stop the workers.
+        """
+        await self.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
@@ -0,0 +1,250 @@
+import asyncio
+import gzip
+import hashlib
+import time
+from functools import partial
+from pathlib import Path
+from typing import BinaryIO, Callable, Optional, Tuple
+
+import aiohttp
+import metrics
+import tenacity
+from cachetools import TTLCache
+from config import settings
+from schemas import ContentEncoding, Upload, UploadCreate, UploadFinalize
+from utils import logger
+
+# How long (seconds) we try to resume an upload, less than the API keeps them
+UPLOAD_RESUME_TTL = 12 * 60 * 60
+
+# (path, size, mtime) => id of the upload of the file, so a retry resumes the
+# upload rather than starting again.
+_upload_ids = TTLCache(maxsize=10000, ttl=UPLOAD_RESUME_TTL)
+
+
+def is_server_error(e: BaseException) -> bool:
+    return (
+        isinstance(e, aiohttp.client_exceptions.ClientResponseError)
+        and e.status >= 500
+    )
+
+
+# Retry policy for the individual upload requests, so a network error only
+# costs us the request, not the whole file. A 4xx won't change on a retry.
+upload_retry = tenacity.retry(
+    retry=tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ServerConnectionError
+    ) | tenacity.retry_if_exception_type(
+        aiohttp.client_exceptions.ClientConnectionError
+    ) | tenacity.retry_if_exception(
+        is_server_error
+    ) | tenacity.retry_if_exception_type(
+         asyncio.TimeoutError
+    ),
+    wait=tenacity.wait_exponential(max=10),
+    stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
+)
+
+
+@upload_retry
+async def create_upload(
+    session: aiohttp.ClientSession, upload: UploadCreate
+) -> Upload:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    async with session.post(
+        f"{settings.API_URL}/uploads", headers=headers, data=upload.json()
+    ) as r:
+        r.raise_for_status()
+        json = await r.json()
+
+        return Upload(**json)
+
+
+@upload_retry
+async def get_upload(session: aiohttp.ClientSession, id: str) -> Optional[Upload]:
+    """
+    Returns the state of an upload, None if the API no longer has it.
+    """
+    headers = {settings.API_KEY_NAME: settings.API_KEY}
+
+    async with session.get(f"{settings.API_URL}/uploads/{id}", headers=headers) as r:
+        if r.status == 404:
+            return None
+
+        r.raise_for_status()
+        json = await r.json()
+
+        return Upload(**json)
+
+
+def seek_upload(fp: BinaryIO, offset: int) -> "hashlib._Hash":
+    """
+    Position the file at offset to resume an upload, returning the hash of
+    the content before it.
+    """
+    sha = hashlib.sha256()
+    fp.seek(0)
+    while fp.tell() < offset:
+        chunk = fp.read(min(settings.UPLOAD_CHUNK_SIZE, offset - fp.tell()))
+        if len(chunk) == 0:
+            break
+        sha.update(chunk)
+
+    return sha
+
+
+def chunk_encoder(encoding: Optional[ContentEncoding]) -> Callable[[bytes], bytes]:
+    """
+    Returns the function encoding the chunks of an upload. Each chunk is
+    compressed as a complete gzip member/zstd frame rather than as part of one
+    stream, as the API decodes every PUT on its own and a chunk can be resent,
+    or the upload resumed, from whatever offset the API has got to. The
+    compressor itself is created once per upload.
+    """
+    if encoding == ContentEncoding.GZIP:
+        # Favor speed, the links we care about are slow but so are the PCs
+        return partial(gzip.compress, compresslevel=1)
+    elif encoding == ContentEncoding.ZSTD:
+        import zstandard
+
+        return zstandard.ZstdCompressor().compress
+
+    return lambda chunk: chunk
+
+
+def read_chunk(
+    fp: BinaryIO, size: int, encode: Callable[[bytes], bytes]
+) -> Tuple[bytes, bytes]:
+    """
+    Returns the chunk read and the chunk encoded for sending.
+    """
+    chunk = fp.read(size)
+
+    return (chunk, encode(chunk))
+
+
+@upload_retry
+async def put_upload_chunk(
+    session: aiohttp.ClientSession,
+    id: str,
+    offset: int,
+    chunk: bytes,
+    encoding: Optional[ContentEncoding] = None,
+) -> Upload:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/octet-stream",
+    }
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding.value
+
+    async with session.put(
+        f"{settings.API_URL}/uploads/{id}",
+        headers=headers,
+        params={"offset": offset},
+        data=chunk,
+    ) as r:
+        r.raise_for_status()
+        json = await r.json()
+
+        return Upload(**json)
+
+
+@upload_retry
+async def finalize_upload(
+    session: aiohttp.ClientSession, id: str, sha256: str
+) -> Upload:
+    headers = {
+        settings.API_KEY_NAME: settings.API_KEY,
+        "Content-Type": "application/json",
+    }
+
+    async with session.post(
+        f"{settings.API_URL}/uploads/{id}/finalize",
+        headers=headers,
+        data=UploadFinalize(sha256=sha256).json(),
+    ) as r:
+        r.raise_for_status()
+        json = await r.json()
+
+        return Upload(**json)
+
+
+async def upload_file(
+    session: aiohttp.ClientSession,
+    path: Path,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """
+    Upload a file in chunks using the resumable upload API, returning the
+    upload id to pass to the API call consuming the file. progress is called
+    with the bytes sent and the total after each chunk.
+    """
+    loop = asyncio.get_running_loop()
+    stat_info = path.stat()
+    size = stat_info.st_size
+    key = (str(path), size, stat_info.st_mtime_ns)
+
+    # Resume the upload from where the API got to
+    upload = None
+    if key in _upload_ids:
+        upload = await get_upload(session, _upload_ids[key])
+    if upload is None:
+        upload = await create_upload(session, UploadCreate(filename=path.name, size=size))
+        _upload_ids[key] = upload.id
+    elif upload.complete:
+        return upload.id
+    else:
+        logger.info(f"Resuming upload of {path} at {upload.offset} of {size} bytes")
+
+    encoding = settings.UPLOAD_CONTENT_ENCODING
+    encode = chunk_encoder(encoding)
+    start = time.monotonic()
+    offset = upload.offset
+    sent = 0
+    with path.open("rb") as fp:
+        sha = await loop.run_in_executor(None, seek_upload, fp, offset)
+        while offset < size:
+            # Read and compress off the loop
+            (chunk, encoded_chunk) = await loop.run_in_executor(
+                None, read_chunk, fp, min(settings.UPLOAD_CHUNK_SIZE, size - offset), encode
+            )
+            if len(chunk) == 0:
+                raise Exception(f"'{path}' truncated during upload.")
+
+            try:
+                await put_upload_chunk(session, upload.id, offset, encoded_chunk, encoding)
+            except aiohttp.client_exceptions.ClientResponseError as e:
+                if e.status != 409:
+                    raise
+                # Out of step with the API, carry on from where it is
+                state = await get_upload(session, upload.id)
+                if state is None or state.complete:
+                    raise
+                offset = state.offset
+                sha = await loop.run_in_executor(None, seek_upload, fp, offset)
+                continue
+
+            sha.update(chunk)
+            offset += len(chunk)
+            sent += len(encoded_chunk)
+            metrics.upload_bytes.inc(len(chunk))
+            metrics.upload_sent_bytes.inc(len(encoded_chunk))
+            if progress is not None:
+                progress(offset, size)
+
+    await finalize_upload(session, upload.id, sha.hexdigest())
+
+    elapsed = time.monotonic() - start
+    message = f"Uploaded {path} ({size} bytes) in {elapsed:.1f}s, {size / max(elapsed, 1e-6) / 1e6:.2f} MB/s"
+    if encoding is not None:
+        ratio = size / max(sent, 1)
+        message += f", {encoding.value} ratio {ratio:.2f} ({sent} bytes sent)"
+    logger.info(message)
+
+    return upload.id
@@ -1,11 +1,13 @@
 import asyncio
 import logging
+import os
 import platform
 import re
 import signal
 import sys
 import tenacity
 import aiohttp
+import metrics
 from logging.handlers import RotatingFileHandler
 from config import settings
 import coloredlogs
@@ -37,6 +39,7 @@ if settings.LOG_FILE_PATH is not None:
     ),
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def get_microscope(session: aiohttp.ClientSession, name: str) -> Microscope:
     headers = {
@@ -64,6 +67,7 @@ async def get_microscope(session: aiohttp.ClientSession, name: str) -> Microscop
     ),
     wait=tenacity.wait_exponential(max=10),
     stop=tenacity.stop_after_attempt(10),
+    before_sleep=metrics.count_retry,
 )
 async def get_microscope_by_id(session: aiohttp.ClientSession, id: int) -> Microscope:
     headers = {
@@ -81,4 +85,10 @@ async def get_microscope_by_id(session: aiohttp.ClientSession, id: int) -> Micro
         if json is None:
             raise Exception("Unable to fetch microscopy")
 
-        return Microscope(**json)
\ No newline at end of file
+        return Microscope(**json)
+
+def find_mount_point(path):
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
@@ -4,6 +4,7 @@ import platform
 import re
 import signal
 import sys
+import time
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
 from typing import List
@@ -12,6 +13,7 @@ import platform
 import aiohttp
 
 import coloredlogs
+import metrics
 import tenacity
 from aiopath import AsyncPath
 from pathlib import Path
@@ -20,14 +22,16 @@ from cachetools import TTLCache
 from config import settings
 from schemas import File, WatchMode
 from schemas import FileSystemEvent as FileSystemEventModel
-from schemas import SyncEvent, Microscope
+from schemas import SyncEvent, Microscope, ObserverMode
 from watchdog.events import (EVENT_TYPE_MODIFIED, EVENT_TYPE_CREATED)
-
-if settings.POLL or settings.MODE in [WatchMode.SCAN_4D_FILES, WatchMode.SCAN_4D_HAADF_FILES]:
-    from watchdog.observers.polling import PollingObserver as Observer
-else:
-    from watchdog.observers import Observer
-
+from watchdog.observers import Observer
+from watchdog.observers.api import BaseObserver
+from watchdog.observers.polling import PollingObserver
+
+from observers import (InotifyCloseWriteObserver, StatusFilePollingObserver,
+                       delivers_events)
+from outbox import outbox
+from shards import Shard, create_shards
 from utils import logger, get_microscope
 from modes import ModeHandler
 
@@ -41,22 +45,68 @@ def get_host():
     return host
 
 
-async def watch(host: str,
-    microscope_id: int, dirs: List[str], queue: asyncio.Queue, loop: asyncio.BaseEventLoop
-) -> None:
-    handler = AIOEventHandler(queue, loop)
+def schedule_observers(handler: AIOEventHandler, dirs: List[str]) -> List[BaseObserver]:
+    """
+    Schedule the watches for dirs, returning the started observers.
+    """
+    if settings.MODE not in [WatchMode.SCAN_4D_FILES, WatchMode.SCAN_4D_HAADF_FILES]:
+        observer = PollingObserver() if settings.POLL else Observer()
+        for d in dirs:
+            observer.schedule(handler, str(d), recursive=settings.RECURSIVE)
+        observer.start()
+
+        return [observer]
 
-    observer = Observer()
+    # For status files we only need to poll the status files themselves
+    if settings.MODE == WatchMode.SCAN_4D_FILES:
+        polling = StatusFilePollingObserver()
+    else:
+        polling = PollingObserver()
+    inotify = InotifyCloseWriteObserver()
+    # Emitters scheduled on a running observer are started straight away, so
+    # a watch that can't be added fails here, rather than when we start it.
+    inotify.start()
     for d in dirs:
-        observer.schedule(handler, str(d), recursive=settings.RECURSIVE)
-    observer.start()
+        d = str(d)
+        use_inotify = not settings.POLL and settings.OBSERVER != ObserverMode.POLLING
+        if use_inotify and settings.OBSERVER == ObserverMode.AUTO and not delivers_events(d):
+            logger.warning(f"Mount for {d} does not deliver inotify events, polling.")
+            use_inotify = False
+
+        if use_inotify:
+            try:
+                inotify.schedule(handler, d, recursive=settings.RECURSIVE)
+                logger.info(f"Using inotify for {d}")
+                continue
+            except OSError:
+                logger.exception(f"Unable to add inotify watch for {d}, polling.")
+
+        polling.schedule(handler, d, recursive=settings.RECURSIVE)
+        logger.info(f"Using polling for {d}")
+
+    if not inotify.emitters:
+        inotify.stop()
+    if polling.emitters:
+        polling.start()
+
+    return [o for o in [inotify, polling] if o.emitters]
+
+
+async def watch(host: str, microscope_id: int, shards: List[Shard]) -> None:
+    for shard in shards:
+        handler = AIOEventHandler(shard.queue)
+        logger.info(f"Shard {shard.name}: {shard.dirs}")
+        schedule_observers(handler, shard.dirs)
 
     if settings.SYNC:
         mode = settings.MODE
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
             handler = get_mode_handler(mode, session, microscope_id, host)
             logger.info("Running sync.")
-            await handler.sync()
+            try:
+                await handler.sync()
+            finally:
+                await handler.close()
 
 
 def get_mode_handler(mode: WatchMode, session: aiohttp.ClientSession, microscope_id: int, host: str) -> ModeHandler:
@@ -73,19 +123,62 @@ def get_mode_handler(mode: WatchMode, session: aiohttp.ClientSession, microscope
         raise Exception(f"Unrecognized mode: {mode}")
 
 
-async def monitor(microscope_id: int, queue: asyncio.Queue) -> None:
+async def log_queue_stats(shards: List[Shard]) -> None:
+    previous = None
+    while True:
+        await asyncio.sleep(settings.EVENT_QUEUE_STATS_INTERVAL)
+        stats = {shard.name: shard.queue.stats() for shard in shards}
+        stats["outbox"] = len(outbox)
+        if stats != previous:
+            logger.info(f"Event queue: {stats}")
+            previous = stats
+
+
+async def drain_outbox() -> None:
+    try:
+        async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
+            await outbox.drain(session)
+    except asyncio.CancelledError:
+        logger.info("Outbox drain canceled.")
+
+
+async def serve_metrics() -> None:
+    runner = await metrics.serve(settings.METRICS_HOST, settings.METRICS_PORT)
+    logger.info(f"Serving metrics on {settings.METRICS_HOST}:{settings.METRICS_PORT}")
+    try:
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        logger.info("Metrics server canceled.")
+    finally:
+        await runner.cleanup()
+
+
+async def handle_events(shard: Shard, handler: ModeHandler) -> None:
+    async for event in AIOEventIterator(shard.queue):
+        metrics.events.inc(shard=shard.name, type=event.event_type)
+        start = time.monotonic()
+        await handler.on_event(event)
+        metrics.event_duration.observe(time.monotonic() - start, shard=shard.name)
+
+
+async def monitor(microscope_id: int, shards: List[Shard]) -> None:
     host = get_host()
 
     cache = TTLCache(maxsize=100000, ttl=30)
 
     try:
-        async with aiohttp.ClientSession() as session:
+        async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
             # Select handler based on mode
             mode = settings.MODE
             handler = get_mode_handler(mode, session, microscope_id, host)
-            while True:
-                async for event in AIOEventIterator(queue):
-                    await handler.on_event(event)
+            await handler.start()
+            try:
+                # The shards share the handler, they watch different paths
+                await asyncio.gather(
+                    *[handle_events(shard, handler) for shard in shards]
+                )
+            finally:
+                await handler.close()
 
 
     except asyncio.CancelledError:
@@ -94,7 +187,7 @@ async def monitor(microscope_id: int, queue: asyncio.Queue) -> None:
         logger.exception("Exception in monitoring loop.")
 
 async def get_microscope_id(name: str) -> int:
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(trace_configs=[metrics.trace_config()]) as session:
         microscope = await get_microscope(session, name)
 
         return microscope.id
@@ -103,10 +196,14 @@ async def shutdown(signal, loop, monitor_task):
     logger.info(f"Received exit signal {signal.name}...")
     logger.info(f"Canceling monitoring task.")
     monitor_task.cancel()
+    await asyncio.gather(monitor_task, return_exceptions=True)
 
+    # The remaining tasks ( outbox drain, stats etc. ) run until canceled
     tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
-    logger.info(f"Waiting for {len(tasks)} to complete.")
-    await asyncio.gather(*tasks)
+    logger.info(f"Canceling {len(tasks)} remaining tasks.")
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
     logger.info(f"Stopping event loop.")
     loop = asyncio.get_event_loop()
     loop.stop()
@@ -114,16 +211,20 @@ async def shutdown(signal, loop, monitor_task):
 def main():
     loop = asyncio.get_event_loop()
 
-    queue = asyncio.Queue()
+    shards = create_shards(loop, settings.WATCH_DIRECTORIES)
 
     logger.info(f"Monitoring: {settings.WATCH_DIRECTORIES}")
     logger.info(f"Watch mode: {settings.MODE}")
-    logger.info(f"Using: {Observer.__name__}")
     logger.info(f"Microscopy: {settings.MICROSCOPE}")
     microscope_id = asyncio.run(get_microscope_id(settings.MICROSCOPE))
 
-    loop.create_task(watch(get_host(), microscope_id, settings.WATCH_DIRECTORIES, queue, loop))
-    monitor_task = loop.create_task(monitor(microscope_id, queue))
+    loop.create_task(watch(get_host(), microscope_id, shards))
+    loop.create_task(log_queue_stats(shards))
+    loop.create_task(drain_outbox())
+    metrics.outbox_depth.set_function(lambda: len(outbox))
+    if settings.METRICS_PORT is not None:
+        loop.create_task(serve_metrics())
+    monitor_task = loop.create_task(monitor(microscope_id, shards))
 
     # Install signal handler ( not in Windows )
     if platform.system() != "Windows":